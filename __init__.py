@@ -21,6 +21,20 @@ def cacheFile(filename, verbose=True):
     LogLevel.set(loglevel)
     return cachedFile
 
+def cacheFiles(filenames, verbose=True):
+    """convenience function to cache several files to the local disk.
+    returns the paths of the cached files.
+    """
+    loglevel = LogLevel.level
+    if not verbose:
+        LogLevel.level = 0
+    config = ClientConfiguration()
+    config.loadDefault()
+    client = CmClient(config)
+    cachedFiles = [ f for f, ok in client.fetchMany(filenames) ]
+    LogLevel.set(loglevel)
+    return cachedFiles
+
 def copyFile(source, destination, verbose=True):
     """convenience function to copy a file from the local disk to a file server.
     returns true if the file was copied.
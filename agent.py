@@ -0,0 +1,181 @@
+"""
+node agent for the cache manager client.
+keeps connections to the server and serves cm-client.py requests
+received on a local Unix socket
+"""
+
+import os
+import io
+import copy
+import time
+import select
+import socket
+import threading
+from shared import Message, Connection, agentSocket, peerUid
+from cmlogging import *
+from client import CmClient
+from fetcher import CacheFetcher
+from filesystem import FileSystem, CacheCleaner
+
+
+class ClientPool:
+    """idle CmClient objects, each with a connection to the server"""
+
+    def __init__(self, config):
+        self.config = config
+        self.clients = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        """return a connected client. idle clients are reused if the
+        connection is still usable"""
+        while True:
+            with self.lock:
+                if not self.clients:
+                    break
+                client, lastUsed = self.clients.pop()
+            if self._isUsable(client, lastUsed):
+                return client
+            debug("closing idle connection")
+            client.connection.close()
+        return CmClient(self.config, False)
+
+    def put(self, client):
+        if client.isConnected():
+            with self.lock:
+                self.clients.append((client, time.time()))
+
+    def _isUsable(self, client, lastUsed):
+        if time.time() - lastUsed > self.config.AGENT_MAX_IDLE:
+            return False
+        # an idle connection is readable only if it has been closed by the server
+        readable, w, x = select.select([ client.connection.conn ], [], [], 0)
+        return not readable
+
+
+class AgentThread (threading.Thread):
+    """handle the requests of one cm-client.py process"""
+
+    def __init__(self, agent, conn):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.agent = agent
+        self.conn = conn
+
+    def run(self):
+        while True:
+            msg = self.conn.receiveMessage()
+            if msg is None:
+                break
+            if msg.type != Message.AGENT_REQUEST:
+                error("unexpected message: %s" % str(msg))
+                break
+            status, out, err = self.agent.execute(msg.content)
+            if not self.conn.sendMessage(Message(Message.AGENT_RESULT, [ str(status), out, err ])):
+                break
+        self.conn.close()
+
+
+class NodeAgent:
+    """serve cm-client.py requests using pooled server connections.
+    a CacheCleaner keeps space free in the cache directory.
+
+    run is called with the parsed command line arguments, a client,
+    and the output stream for each request. it returns the exit status.
+    log messages of the request are sent back to the cm-client.py process.
+    """
+
+    QUEUE = 64
+
+    def __init__(self, config, run, parseArguments):
+        self.config = config
+        self.run = run
+        self.parseArguments = parseArguments
+        self.pool = ClientPool(config)
+        self.path = agentSocket(True)
+
+    def execute(self, args):
+        out = io.StringIO()
+        err = io.StringIO()
+        setOutput(err)
+        client = None
+        try:
+            # options like --nobundle modify the configuration
+            config = copy.copy(self.config)
+            client = self.pool.get()
+            client.config = config
+            status = self.run(self.parseArguments(args), config, client, out)
+        except Exception as e:
+            error("unknown error: %s" % str(e))
+            status = 1
+        finally:
+            setOutput(None)
+        if client is not None:
+            self.pool.put(client)
+        return status, out.getvalue(), err.getvalue()
+
+    def reportRemoved(self, removed):
+        """report files removed by the cache cleaner to the server"""
+        client = self.pool.get()
+        if client.isConnected():
+            fetcher = CacheFetcher(self.config, FileSystem(self.config), client.connection)
+            fetcher.sendFilesRemoved(removed)
+        self.pool.put(client)
+
+    def isRunning(self):
+        """return True if another agent serves the socket"""
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self.path)
+            return True
+        except socket.error:
+            return False
+        finally:
+            s.close()
+
+    def _checkPeer(self, conn):
+        """accept connections of processes of the same user only.
+        connections of unknown processes are rejected"""
+        return peerUid(conn) == os.getuid()
+
+    def serve(self):
+        if self.path is None:
+            error("no directory for the agent socket")
+            return False
+        if self.isRunning():
+            error("agent is already running on %s" % self.path)
+            return False
+        try:
+            if os.path.lexists(self.path):
+                os.remove(self.path)
+        except OSError as e:
+            error("cannot remove %s: %s" % (self.path, str(e)))
+            return False
+        serverSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        oldMask = os.umask(0o077)
+        try:
+            serverSocket.bind(self.path)
+        finally:
+            os.umask(oldMask)
+        serverSocket.listen(self.QUEUE)
+        log("agent listening on %s" % self.path)
+        if self.config.CLEANER_INTERVAL > 0:
+            FileSystem.cleaner = CacheCleaner(self.config, self.reportRemoved)
+            FileSystem.cleaner.start()
+        try:
+            while True:
+                conn, address = serverSocket.accept()
+                if not self._checkPeer(conn):
+                    warning("rejected connection of another user")
+                    conn.close()
+                    continue
+                connection = Connection(conn, self.path)
+                connection.setProtocolVersion(Message.PROTOCOL_V2)
+                AgentThread(self, connection).start()
+        finally:
+            if FileSystem.cleaner is not None:
+                FileSystem.cleaner.stop()
+            serverSocket.close()
+            os.remove(self.path)
+        return True
+
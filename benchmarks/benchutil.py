@@ -0,0 +1,99 @@
+"""
+helper functions for the cache manager benchmarks
+"""
+
+import os
+import sys
+import time
+import socket
+import resource
+import subprocess
+import importlib.util
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASEDIR)
+
+__version__ = "$Rev$"
+__author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
+__copyright__ = "Copyright 2012, RWTH Aachen University"
+
+
+def loadServerModule():
+    """import cm-server.py as module cmserver"""
+    if "cmserver" in sys.modules:
+        return sys.modules["cmserver"]
+    spec = importlib.util.spec_from_file_location("cmserver", os.path.join(BASEDIR, "cm-server.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["cmserver"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def freePort():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def raiseFileLimit():
+    """allow as many open file descriptors as possible.
+    returns the new limit"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def writeConfig(filename, settings):
+    fp = open(filename, "w")
+    for key, value in settings.items():
+        if isinstance(value, str):
+            value = '"%s"' % value
+        fp.write("%s = %s\n" % (key, value))
+    fp.close()
+
+
+def startServer(tmpdir, **settings):
+    """start cm-server.py in a subprocess.
+    returns (process, port)"""
+    port = freePort()
+    config = { "PORT": port,
+               "DB_FILE": os.path.join(tmpdir, "bench.%d.db" % port),
+               "CONNECTION_QUEUE": 1024 }
+    config.update(settings)
+    configFile = os.path.join(tmpdir, "server.%d.config" % port)
+    writeConfig(configFile, config)
+    devNull = open(os.devnull, "w")
+    process = subprocess.Popen([ sys.executable, os.path.join(BASEDIR, "cm-server.py"), configFile ],
+                               stdout=devNull, stderr=devNull)
+    for i in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except socket.error:
+            time.sleep(0.1)
+    return process, port
+
+
+def stopServer(process):
+    process.terminate()
+    process.wait()
+
+
+def processStatus(pid):
+    """return (rss in KB, number of threads) of a process"""
+    rss, threads = 0, 0
+    for line in open("/proc/%d/status" % pid).readlines():
+        if line.startswith("VmRSS:"):
+            rss = int(line.split()[1])
+        elif line.startswith("Threads:"):
+            threads = int(line.split()[1])
+    return rss, threads
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+simulation of the distribution of one file to many nodes.
+
+stand-in nodes request the same file at about the same time (like the
+tasks of a job array). the requests are planned by the FileDatabase
+and CopyCounter of cm-server.py like ClientHandler.handleFileRequest
+does, the copies are simulated with a fixed duration. reports the time
+until 50%, 90% and all nodes have the file and the number of copies
+read from the file server, for
+
+  poll:   random node copy, clients without slot retry after CLIENT_WAIT
+          (QUEUE_WAIT = 0, COALESCE_REQUESTS = False)
+  queue:  random node copy, requests wait in the queues of the hosts
+          (COALESCE_REQUESTS = False)
+  random: DISTRIBUTION = "random" (default)
+  tree:   DISTRIBUTION = "tree"
+  chain:  model of chains of nodes pipelining chunks of the file.
+          requires nodes serving partially copied files, not
+          available in the server
+
+with --cached, the file has already been copied to some nodes before.
+
+  broadcast.py [--copy-time S] [--server-slots N] [--node-slots N] [--chunks N]
+               [--cached N] [nodes ...]
+"""
+
+import sys
+import heapq
+import random
+import benchutil
+
+__version__ = "$Rev$"
+__author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
+__copyright__ = "Copyright 2012, RWTH Aachen University"
+
+FILENAME = "/u/corpora/models/am.model"
+FILESERVER = "fileserver"
+SIZE = 4 * 1024 ** 3
+MTIME = 1300000000
+
+MODES = {
+    "poll":   { "QUEUE_WAIT": 0, "COALESCE_REQUESTS": False, "DISTRIBUTION": "random" },
+    "queue":  { "QUEUE_WAIT": 60, "COALESCE_REQUESTS": False, "DISTRIBUTION": "random" },
+    "random": { "QUEUE_WAIT": 60, "COALESCE_REQUESTS": True, "DISTRIBUTION": "random" },
+    "tree":   { "QUEUE_WAIT": 60, "COALESCE_REQUESTS": True, "DISTRIBUTION": "tree" },
+}
+
+
+class Simulation:
+    """nodes fetching FILENAME, the simulated time is in seconds"""
+
+    def __init__(self, server, config, nNodes, copyTime, cached = 0, seed = 1):
+        self.server = server
+        self.config = config
+        self.copyTime = copyTime
+        self.rand = random.Random(seed)
+        self.db = server.FileDatabase()
+        self.copycount = server.CopyCounter(config)
+        self.source = (FILENAME, SIZE, MTIME)
+        self.destination = "/var/tmp" + FILENAME
+        self.now = 0.0
+        self.events = []
+        self.seq = 0
+        # (node, CopyWaiter)
+        self.waiting = []
+        self.finished = []
+        self.serverCopies = 0
+        for i in range(cached):
+            self.db.addLocation(FILENAME, server.Location(self.destination, SIZE, MTIME, "cached%03d" % i))
+        for i in range(nNodes):
+            self.schedule(self.rand.uniform(0, 1), self.request, "node%03d" % i)
+
+    def schedule(self, when, action, *args):
+        self.seq += 1
+        heapq.heappush(self.events, (when, self.seq, action, args))
+
+    def run(self):
+        while self.events:
+            self.now, seq, action, args = heapq.heappop(self.events)
+            action(*args)
+        return self.finished
+
+    def request(self, node):
+        loc = self.db.getLocation(FILENAME, node, self.copycount)
+        busyLocation = None
+        if loc is not None:
+            token = self.copycount.startCopyFromNode(loc.host, node, self.destination, None, self.source)
+            if token:
+                self.startCopy(node, loc.host, token)
+                return
+            busyLocation = loc
+        # copyFromOrigin
+        fileserver = FILESERVER
+        token = 0
+        if busyLocation is not None and self.copycount.isDistributing(self.source):
+            fileserver = None
+        else:
+            token = self.copycount.startCopyFromServer(FILESERVER, node, self.destination, None,
+                                                       self.source)
+        if token:
+            self.startCopy(node, FILESERVER, token)
+        elif self.config.QUEUE_WAIT <= 0:
+            self.schedule(self.now + self.config.CLIENT_WAIT, self.request, node)
+        else:
+            waiter = self.copycount.enqueue(node, self.destination, fileserver, busyLocation,
+                                            None, 0, SIZE, self.source)
+            self.waiting.append((node, waiter))
+            self.checkWaiters()
+
+    def checkWaiters(self):
+        waiting = []
+        for node, waiter in self.waiting:
+            if not waiter.granted:
+                waiting.append((node, waiter))
+            elif waiter.token == 0:
+                # follower or copied by another request: request again
+                self.schedule(self.now, self.request, node)
+            else:
+                self.startCopy(node, waiter.host, waiter.token)
+        self.waiting = waiting
+
+    def startCopy(self, node, host, token):
+        if host == FILESERVER:
+            self.serverCopies += 1
+        self.schedule(self.now + self.copyTime * self.rand.uniform(0.9, 1.1), self.endCopy,
+                      node, host, token)
+
+    def endCopy(self, node, host, token):
+        self.db.addLocation(FILENAME, self.server.Location(self.destination, SIZE, MTIME, node))
+        self.copycount.endCopy(host, node, token)
+        self.finished.append(self.now)
+        self.checkWaiters()
+
+
+def chainTimes(nNodes, copyTime, nChains, chunks):
+    """completion times of nChains chains of nodes. each node forwards
+    a chunk to the next node as soon as it has received it"""
+    chunkTime = copyTime / float(chunks)
+    return sorted([ copyTime + (i // nChains) * chunkTime for i in range(nNodes) ])
+
+
+def main(argv):
+    copyTime = 60.0
+    serverSlots = 4
+    nodeSlots = 1
+    chunks = 64
+    cached = 0
+    sizes = []
+    i = 1
+    while i < len(argv):
+        if argv[i] == "--copy-time":
+            copyTime = float(argv[i + 1])
+            i += 1
+        elif argv[i] == "--server-slots":
+            serverSlots = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--node-slots":
+            nodeSlots = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--cached":
+            cached = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--chunks":
+            chunks = int(argv[i + 1])
+            i += 1
+        else:
+            sizes.append(int(argv[i]))
+        i += 1
+    sizes = sizes or [ 50, 200, 500 ]
+    server = benchutil.loadServerModule()
+    print("copy time: %0.0fs, MAX_COPY_SERVER = %d, MAX_COPY_NODE = %d, cached: %d" %
+          (copyTime, serverSlots, nodeSlots, cached))
+    print("%6s %-7s %10s %10s %10s %14s" % ("nodes", "mode", "50%[s]", "90%[s]", "100%[s]", "server copies"))
+    for nNodes in sizes:
+        for mode in [ "poll", "queue", "random", "tree", "chain" ]:
+            if mode == "chain":
+                times = chainTimes(nNodes, copyTime, cached or serverSlots, chunks)
+                serverCopies = 0 if cached else min(nNodes, serverSlots)
+            else:
+                config = server.ServerConfiguration()
+                config.MAX_COPY_SERVER = serverSlots
+                config.MAX_COPY_NODE = nodeSlots
+                for key, value in MODES[mode].items():
+                    setattr(config, key, value)
+                sim = Simulation(server, config, nNodes, copyTime, cached)
+                times = sim.run()
+                serverCopies = sim.serverCopies
+            print("%6d %-7s %10.0f %10.0f %10.0f %14d" % (nNodes, mode, benchutil.percentile(times, 50),
+                                                         benchutil.percentile(times, 90), times[-1],
+                                                         serverCopies))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+benchmark of the startup-to-answer latency of cm-client.py.
+
+requests a file which is already cached N times, each time in a new
+cm-client.py process (like the cf calls of a job script). the
+latency is measured without and with a running node agent
+(cm-client.py --agent).
+
+  client-latency.py [requests]
+"""
+
+import os
+import sys
+import time
+import getpass
+import tempfile
+import subprocess
+import benchutil
+
+__version__ = "$Rev$"
+__author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
+__copyright__ = "Copyright 2012, RWTH Aachen University"
+
+CLIENT = os.path.join(benchutil.BASEDIR, "cm-client.py")
+
+
+def runClient(env, filename):
+    start = time.time()
+    p = subprocess.run([ sys.executable, CLIENT, filename ], env=env,
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return time.time() - start, p.stdout.decode().strip()
+
+
+def measure(env, filename, nRequests):
+    latencies = []
+    for i in range(nRequests):
+        latency, destination = runClient(env, filename)
+        if not destination.startswith(env["CACHE"]):
+            sys.stderr.write("file not cached: %s\n" % destination)
+        latencies.append(latency)
+    return latencies
+
+
+def main(argv):
+    nRequests = int(argv[1]) if len(argv) > 1 else 50
+    tmpdir = tempfile.mkdtemp(prefix="cm-bench-")
+    process, port = benchutil.startServer(tmpdir)
+    env = dict(os.environ)
+    env["HOME"] = tmpdir
+    env.setdefault("USER", getpass.getuser())
+    env["CACHE"] = os.path.join(tmpdir, "cache")
+    env["CM_AGENT_SOCKET"] = os.path.join(tmpdir, "agent.socket")
+    benchutil.writeConfig(os.path.join(tmpdir, ".cmclient"),
+                          { "MASTER_HOST_I6": "127.0.0.1", "MASTER_HOST_CLUSTER": "127.0.0.1",
+                            "MASTER_PORT": port, "CACHE_DIR_I6": env["CACHE"],
+                            "CACHE_DIR_CLUSTER": env["CACHE"] })
+    filename = os.path.join(tmpdir, "data")
+    open(filename, "w").write("x" * 1024)
+    agent = None
+    try:
+        runClient(env, filename)
+        print("%-8s %10s %10s %10s" % ("mode", "p50[ms]", "p90[ms]", "mean[ms]"))
+        for mode in [ "direct", "agent" ]:
+            if mode == "agent":
+                agent = subprocess.Popen([ sys.executable, CLIENT, "--agent" ], env=env,
+                                         stderr=subprocess.DEVNULL)
+                while not os.path.exists(env["CM_AGENT_SOCKET"]):
+                    time.sleep(0.1)
+            latencies = measure(env, filename, nRequests)
+            print("%-8s %10.1f %10.1f %10.1f" % (mode, 1000 * benchutil.percentile(latencies, 50),
+                                                 1000 * benchutil.percentile(latencies, 90),
+                                                 1000 * sum(latencies) / len(latencies)))
+    finally:
+        if agent is not None:
+            agent.terminate()
+            agent.wait()
+        benchutil.stopServer(process)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+benchmark of local file copies (NfsRemoteFileSystem.copyFile, copies
+from the file server).
+
+copies many small and a few large files with the CopyEngine of
+filesystem.py and with the former implementation (flock, cp and chmod
+started by a shell for each file) and reports files/s and MB/s. the
+source files are in the page cache, the destination files are removed
+after each run.
+
+  copy-throughput.py [--small N,KB] [--large N,MB] [directory]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import filesystem
+
+__version__ = "$Rev$"
+__author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
+__copyright__ = "Copyright 2012, RWTH Aachen University"
+
+MB = 1024 * 1024
+
+
+class Config:
+    COPY_BUFFER = 16 * MB
+    SLOW_COPY = False
+
+
+def shellCopy(source, destination):
+    """copy as done before the CopyEngine"""
+    cmd = '/bin/cp --preserve=ownership,timestamps "%s" "%s"' % (source, destination)
+    fd = os.popen('/usr/bin/flock -e -n %s -c "%s" 2>&1' % (destination, cmd))
+    fd.read()
+    r = (fd.close() is None)
+    os.system('/bin/chmod -f --reference="%s" "%s"' % (source, destination))
+    return (r, "")
+
+
+def createFiles(directory, prefix, n, size):
+    data = os.urandom(min(size, MB))
+    files = []
+    for i in range(n):
+        filename = os.path.join(directory, "%s-%d" % (prefix, i))
+        fp = open(filename, "wb")
+        written = 0
+        while written < size:
+            fp.write(data[:size - written])
+            written += len(data)
+        fp.close()
+        # read into the page cache
+        open(filename, "rb").read()
+        files.append(filename)
+    return files
+
+
+def measure(copy, files, destDir):
+    start = time.time()
+    for filename in files:
+        ok, msg = copy(filename, os.path.join(destDir, os.path.basename(filename)))
+        assert ok, msg
+    duration = time.time() - start
+    for filename in files:
+        os.remove(os.path.join(destDir, os.path.basename(filename)))
+    return duration
+
+
+def main(argv):
+    nSmall, smallSize = 2000, 16 * 1024
+    nLarge, largeSize = 4, 256 * MB
+    directory = None
+    i = 1
+    while i < len(argv):
+        if argv[i] == "--small":
+            n, kb = argv[i + 1].split(",")
+            nSmall, smallSize = int(n), int(kb) * 1024
+            i += 1
+        elif argv[i] == "--large":
+            n, mb = argv[i + 1].split(",")
+            nLarge, largeSize = int(n), int(mb) * MB
+            i += 1
+        else:
+            directory = argv[i]
+        i += 1
+    tmpdir = tempfile.mkdtemp(prefix="cm-bench-", dir=directory)
+    srcDir = os.path.join(tmpdir, "src")
+    destDir = os.path.join(tmpdir, "dest")
+    os.mkdir(srcDir)
+    os.mkdir(destDir)
+    engine = filesystem.NfsRemoteFileSystem(Config())
+    methods = [ ("shell", shellCopy), ("engine", engine.copyLocal) ]
+    print("%-6s %-6s %8s %10s %10s %10s" % ("files", "method", "count", "time[s]", "files/s", "MB/s"))
+    try:
+        for name, n, size in [ ("small", nSmall, smallSize), ("large", nLarge, largeSize) ]:
+            files = createFiles(srcDir, name, n, size)
+            for method, copy in methods:
+                duration = measure(copy, files, destDir)
+                print("%-6s %-6s %8d %10.2f %10.1f %10.1f" % (name, method, n, duration, n / duration,
+                                                              n * size / float(MB) / duration))
+            for filename in files:
+                os.remove(filename)
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
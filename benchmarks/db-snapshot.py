@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+benchmark of the database snapshots of cm-server.py.
+
+fills a FileDatabase with the given numbers of records (one location
+each) and writes it with and without a forked writer process. reports
+the maximum time a lock of the database is held, i.e. the time client
+threads are blocked.
+
+  db-snapshot.py [records ...]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import benchutil
+
+__version__ = "$Rev$"
+__author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
+__copyright__ = "Copyright 2012, RWTH Aachen University"
+
+
+class TimedLock:
+    """lock recording the maximum time it is held"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.maxHeld = 0.0
+
+    def acquire(self, blocking = True):
+        r = self.lock.acquire(blocking)
+        if r:
+            self.acquired = time.time()
+        return r
+
+    def release(self):
+        self.maxHeld = max(self.maxHeld, time.time() - self.acquired)
+        self.lock.release()
+
+
+def fillDatabase(server, db, nRecords):
+    now = int(time.time())
+    for i in range(nRecords):
+        filename = "/u/corpora/audio/%d/segment-%d.wav" % (i % 1000, i)
+        loc = server.Location("/var/tmp/cache" + filename, i % 100000, now, "node%03d" % (i % 500))
+        record = server.FileDatabaseRecord([], now, filename)
+        record.append(loc)
+        db._shard(filename).files[filename] = record
+    db.changed = True
+
+
+def measure(db, filename, forkWriter):
+    db.forkWriter = forkWriter
+    db.changed = True
+    for shard in db.shards:
+        shard.lock = TimedLock()
+    start = time.time()
+    db.write(filename)
+    return max([ shard.lock.maxHeld for shard in db.shards ]), time.time() - start
+
+
+def main(argv):
+    sizes = [ int(n) for n in argv[1:] ] or [ 1000000, 5000000, 10000000 ]
+    server = benchutil.loadServerModule()
+    tmpdir = tempfile.mkdtemp(prefix="cm-bench-")
+    filename = os.path.join(tmpdir, "snapshot.db")
+    print("%10s %-6s %14s %10s" % ("records", "writer", "lock held[ms]", "write[s]"))
+    for nRecords in sizes:
+        db = server.FileDatabase()
+        fillDatabase(server, db, nRecords)
+        for forkWriter in [ True, False ]:
+            held, duration = measure(db, filename, forkWriter)
+            print("%10d %-6s %14.1f %10.1f" % (nRecords, "fork" if forkWriter else "copy",
+                                               1000 * held, duration))
+        del db
+    os.remove(filename)
+    os.rmdir(tmpdir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
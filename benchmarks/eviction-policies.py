@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+trace-driven simulation of the eviction policies of the client cache.
+
+replays a fetch log (see FETCH_LOG in the client configuration, one
+request per line: "time size filename") against a cache of the given
+capacity and reports hit ratio, byte hit ratio, and the bytes
+transferred for each policy. without a trace, a synthetic workload
+of a few large shared models and many small per-task files is used.
+
+  eviction-policies.py [--capacity GB] [--policies lru,lfu,gdsf] [fetch-log ...]
+"""
+
+import os
+import sys
+import heapq
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import filesystem
+
+__version__ = "$Rev$"
+__author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
+__copyright__ = "Copyright 2012, RWTH Aachen University"
+
+GB = 1024 ** 3
+MB = 1024 ** 2
+
+
+class CacheSimulator:
+    """cache of a fixed capacity, evicting files using an EvictionPolicy"""
+
+    def __init__(self, policy, capacity):
+        self.policy = policy
+        self.capacity = capacity
+        self.used = 0
+        self.inflation = 0
+        # filename -> [size, hits, priority]
+        self.files = {}
+        self.heap = []
+        self.requests = 0
+        self.hits = 0
+        self.bytesRequested = 0
+        self.bytesHit = 0
+        self.bytesTransferred = 0
+
+    def _setPriority(self, filename, entry, now):
+        entry[2] = self.policy.priority(entry[0], now, entry[1], self.inflation)
+        heapq.heappush(self.heap, (entry[2], filename))
+
+    def _evict(self):
+        while True:
+            priority, filename = heapq.heappop(self.heap)
+            entry = self.files.get(filename)
+            # skip outdated heap entries
+            if entry is not None and entry[2] == priority:
+                break
+        del self.files[filename]
+        self.used -= entry[0]
+        self.inflation = self.policy.inflation(priority, self.inflation)
+
+    def request(self, now, size, filename):
+        self.requests += 1
+        self.bytesRequested += size
+        entry = self.files.get(filename)
+        if entry is not None and entry[0] == size:
+            self.hits += 1
+            self.bytesHit += size
+            entry[1] += 1
+            self._setPriority(filename, entry, now)
+            return
+        if entry is not None:
+            # file has changed
+            del self.files[filename]
+            self.used -= entry[0]
+        self.bytesTransferred += size
+        if size > self.capacity:
+            return
+        while self.used + size > self.capacity:
+            self._evict()
+        entry = [ size, 1, 0 ]
+        self.files[filename] = entry
+        self.used += size
+        self._setPriority(filename, entry, now)
+
+
+def readTrace(filenames):
+    for filename in filenames:
+        for line in open(filename):
+            fields = line.rstrip("\n").split(" ", 2)
+            if len(fields) == 3:
+                yield float(fields[0]), int(fields[1]), fields[2]
+
+
+def syntheticTrace(nJobs = 20000, seed = 1):
+    """jobs using one of a few large models and some small feature files.
+    some models and feature files are more popular than others"""
+    rand = random.Random(seed)
+    models = [ ("/models/model-%d" % i, rand.randint(2, 8) * GB) for i in range(8) ]
+    nFeatures = 50000
+    now = 1.0e9
+    for job in range(nJobs):
+        now += 10
+        model, size = models[min(int(rand.expovariate(0.7)), len(models) - 1)]
+        yield now, size, model
+        for i in range(rand.randint(5, 20)):
+            feature = min(int(rand.paretovariate(1.2)) - 1, nFeatures - 1) \
+                      if rand.random() < 0.5 else rand.randrange(nFeatures)
+            yield now, (feature % 50 + 1) * MB, "/features/%d" % feature
+
+
+def main(argv):
+    capacity = 40 * GB
+    policies = sorted(filesystem.EVICTION_POLICIES.keys())
+    traces = []
+    i = 1
+    while i < len(argv):
+        if argv[i] == "--capacity":
+            capacity = int(float(argv[i + 1]) * GB)
+            i += 1
+        elif argv[i] == "--policies":
+            policies = argv[i + 1].split(",")
+            i += 1
+        else:
+            traces.append(argv[i])
+        i += 1
+    print("capacity: %0.1f GB, trace: %s" % (capacity / float(GB), ", ".join(traces) or "synthetic"))
+    print("%-6s %10s %10s %10s %16s" % ("policy", "requests", "hits[%]", "bytes[%]", "transferred[GB]"))
+    for name in policies:
+        sim = CacheSimulator(filesystem.evictionPolicy(name), capacity)
+        for now, size, filename in (readTrace(traces) if traces else syntheticTrace()):
+            sim.request(now, size, filename)
+        print("%-6s %10d %10.2f %10.2f %16.1f" % (name, sim.requests,
+                                                 100.0 * sim.hits / max(1, sim.requests),
+                                                 100.0 * sim.bytesHit / max(1, sim.bytesRequested),
+                                                 sim.bytesTransferred / float(GB)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
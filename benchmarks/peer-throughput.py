@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+benchmark of node to node copies with the peer transfer service
+(peer.py, PeerRemoteFileSystem).
+
+starts several PeerServer instances on local ports, each serving its
+own directory with a copy of a test file, and copies the file with
+PeerRemoteFileSystem without and with digests (PEER_CHECKSUM), and as
+striped copy from all instances. if an SSH login to localhost is
+possible, SshRemoteFileSystem is measured for comparison.
+
+  peer-throughput.py [--size MB] [--instances N] [--port P] [directory]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import settings
+import filesystem
+import fetcher
+from peer import PeerServer
+
+__version__ = "$Rev$"
+__author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
+__copyright__ = "Copyright 2012, RWTH Aachen University"
+
+MB = 1024 * 1024
+
+
+def startServers(config, roots, port):
+    """one PeerServer per root, the hosts node0, node1, ... are mapped
+    to their ports"""
+    hosts = []
+    for i, root in enumerate(roots):
+        c = settings.ClientDefaultConfiguration()
+        c.PEER_ROOT = root
+        c.PEER_PORT = port + i
+        c.PEER_USER_PORTS = 0
+        threading.Thread(target=PeerServer(c).serve, daemon=True).start()
+        config.PEER_HOSTS["node%d" % i] = "127.0.0.1:%d" % (port + i)
+        hosts.append("node%d" % i)
+    time.sleep(0.5)
+    return hosts
+
+
+def sshAvailable():
+    return subprocess.call([ "/usr/bin/ssh", "-n", "-o", "BatchMode=yes", "-o", "ConnectTimeout=2",
+                             "localhost", "true" ], stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL) == 0
+
+
+def measure(copy, destination):
+    start = time.time()
+    ok, msg = copy(destination)
+    assert ok, msg
+    duration = time.time() - start
+    os.remove(destination)
+    return duration
+
+
+def main(argv):
+    size = 512 * MB
+    instances = 3
+    port = 10400
+    directory = None
+    i = 1
+    while i < len(argv):
+        if argv[i] == "--size":
+            size = int(argv[i + 1]) * MB
+            i += 1
+        elif argv[i] == "--instances":
+            instances = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--port":
+            port = int(argv[i + 1])
+            i += 1
+        else:
+            directory = argv[i]
+        i += 1
+    tmpdir = tempfile.mkdtemp(prefix="cm-bench-", dir=directory)
+    roots = [ os.path.join(tmpdir, "node%d" % n) for n in range(instances) ]
+    data = os.urandom(MB)
+    for root in roots:
+        os.mkdir(root)
+        with open(os.path.join(root, "file"), "wb") as fp:
+            for n in range(size // MB):
+                fp.write(data)
+    destination = os.path.join(tmpdir, "copy")
+    config = settings.ClientDefaultConfiguration()
+    config.PEER_HOSTS = {}
+    hosts = startServers(config, roots, port)
+    sources = [ (h, os.path.join(r, "file")) for h, r in zip(hosts, roots) ]
+    methods = []
+    for checksum in [ "", "sha1", "md5" ]:
+        c = settings.ClientDefaultConfiguration()
+        c.PEER_HOSTS = config.PEER_HOSTS
+        c.PEER_CHECKSUM = checksum
+        peer = filesystem.PeerRemoteFileSystem(c)
+        methods.append(("peer %s" % (checksum or "-"),
+                        lambda d, peer=peer: peer.copyFile(hosts[0], sources[0][1], d)))
+    peer = filesystem.PeerRemoteFileSystem(config)
+    methods.append(("peer striped x%d" % instances,
+                    lambda d: fetcher.StripedCopy(config, peer, sources, size, 0, 0o644, d).run()))
+    if sshAvailable():
+        ssh = filesystem.SshRemoteFileSystem(config)
+        methods.append(("ssh", lambda d: ssh.copyFile("localhost", sources[0][1], d)))
+    print("%-20s %10s %10s" % ("method", "time[s]", "MB/s"))
+    try:
+        for name, copy in methods:
+            duration = measure(copy, destination)
+            print("%-20s %10.2f %10.1f" % (name, duration, size / float(MB) / duration))
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
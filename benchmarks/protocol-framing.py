@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+microbenchmark of the message framing in shared.Connection.
+
+measures messages per second for sending and receiving REQUEST_FILE
+messages over a socket pair, for the current implementation (protocol
+version 1 and 2) and for the previous one (recv per field, sendall per
+field).
+
+  protocol-framing.py [messages]
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared import Message, Connection
+
+__version__ = "$Rev$"
+__author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
+__copyright__ = "Copyright 2012, RWTH Aachen University"
+
+
+class UnbufferedConnection (Connection):
+    """previous implementation: one recv call per field and
+    sendall calls for the type and for each length and field"""
+
+    def _readAll(self, size):
+        result = ""
+        while size > 0:
+            buffer = self.conn.recv(size)
+            buffer = str(buffer.decode('ascii'))
+            if len(buffer) == 0:
+                return None
+            size -= len(buffer)
+            result += buffer
+        return result
+
+    def sendMessage(self, msg):
+        self.conn.sendall((("%%0%dd" % Message.SIZE_MSG_TYPE) % msg.type).encode('ascii'))
+        for m in msg.content:
+            self.conn.sendall((("%%0%dd" % Message.SIZE_STRLEN) % len(m)).encode('ascii'))
+            self.conn.sendall(m.encode('ascii'))
+        return True
+
+
+def createMessage():
+    return Message(Message.REQUEST_FILE, [ "/work/speech/corpus/features/part-0042/feature.cache.042",
+                                           "1073741824", "1349172932", "fileserver-3",
+                                           "/var/tmp/user/work/speech/corpus/features/part-0042/feature.cache.042",
+                                           "9999" ])
+
+
+def discard(sock):
+    while sock.recv(1 << 16):
+        pass
+
+
+def benchmarkSend(connectionClass, version, nMessages):
+    a, b = socket.socketpair()
+    reader = threading.Thread(target=discard, args=(b,))
+    reader.start()
+    conn = connectionClass(a)
+    conn.setProtocolVersion(version)
+    msg = createMessage()
+    start = time.time()
+    for i in range(nMessages):
+        conn.sendMessage(msg)
+    a.shutdown(socket.SHUT_WR)
+    reader.join()
+    elapsed = time.time() - start
+    b.close()
+    return nMessages / elapsed
+
+
+def benchmarkReceive(connectionClass, version, nMessages):
+    a, b = socket.socketpair()
+    data = bytes(createMessage().serialize(version)) * nMessages
+    writer = threading.Thread(target=a.sendall, args=(data,))
+    conn = connectionClass(b)
+    conn.setProtocolVersion(version)
+    start = time.time()
+    writer.start()
+    for i in range(nMessages):
+        msg = conn.receiveMessage()
+        assert(msg.type == Message.REQUEST_FILE)
+    elapsed = time.time() - start
+    writer.join()
+    a.close()
+    return nMessages / elapsed
+
+
+def main(argv):
+    nMessages = int(argv[1]) if len(argv) > 1 else 100000
+    print("%-12s %14s %14s" % ("framing", "send [msg/s]", "recv [msg/s]"))
+    for name, connectionClass, version in [ ("unbuffered", UnbufferedConnection, Message.PROTOCOL_V1),
+                                            ("buffered", Connection, Message.PROTOCOL_V1),
+                                            ("v2", Connection, Message.PROTOCOL_V2) ]:
+        send = benchmarkSend(connectionClass, version, nMessages)
+        recv = benchmarkReceive(connectionClass, version, nMessages)
+        print("%-12s %14.0f %14.0f" % (name, send, recv))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( main(sys.argv) )
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+benchmark of the concurrent connection capacity of cm-server.py.
+
+opens N client connections which are kept alive at the same time (like
+the cf calls of a starting job array), measures the resources used by
+the server and the latency of a GET_LOCATIONS request on each of them.
+the threaded and the event-driven server mode are compared.
+
+  server-connections.py [connections] [modes]
+  e.g. server-connections.py 2000 threads,async
+"""
+
+import sys
+import time
+import asyncio
+import tempfile
+import benchutil
+from shared import Message
+
+__version__ = "$Rev$"
+__author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
+__copyright__ = "Copyright 2012, RWTH Aachen University"
+
+
+async def openClient(port, connected):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    conn = benchutil.loadServerModule().AsyncConnection(reader, writer, timeout=120)
+    conn.sendMessage(Message(Message.KEEP_ALIVE, []))
+    await conn.drain()
+    connected.append(conn)
+    return conn
+
+
+async def request(conn, latencies):
+    start = time.time()
+    conn.sendMessage(Message(Message.GET_LOCATIONS, [ "/bench/none", "1", "1", "1" ]))
+    await conn.drain()
+    msg = await conn.receiveMessage()
+    if msg is not None and msg.type == Message.EXIT:
+        latencies.append(time.time() - start)
+
+
+async def runClients(process, port, nConnections):
+    connected = []
+    start = time.time()
+    await asyncio.gather(*[ openClient(port, connected) for i in range(nConnections) ],
+                         return_exceptions=True)
+    # give the server the time to accept all connections
+    await asyncio.sleep(1.0)
+    connectTime = time.time() - start
+    rss, threads = benchutil.processStatus(process.pid)
+    latencies = []
+    start = time.time()
+    await asyncio.gather(*[ request(c, latencies) for c in connected ], return_exceptions=True)
+    requestTime = time.time() - start
+    for c in connected:
+        c.sendMessage(Message(Message.EXIT, []))
+        await c.drain()
+        c.close()
+    return { "connected": len(connected), "served": len(latencies),
+             "connectTime": connectTime, "requestTime": requestTime,
+             "rss": rss, "threads": threads,
+             "p50": benchutil.percentile(latencies, 50), "p99": benchutil.percentile(latencies, 99) }
+
+
+def main(argv):
+    nConnections = int(argv[1]) if len(argv) > 1 else 2000
+    modes = argv[2].split(",") if len(argv) > 2 else [ "threads", "async" ]
+    limit = benchutil.raiseFileLimit()
+    if limit < nConnections * 2 + 64:
+        sys.stderr.write("warning: file descriptor limit %d is too low\n" % limit)
+    tmpdir = tempfile.mkdtemp()
+    print("%-8s %9s %7s %9s %8s %9s %9s %9s" % ("mode", "connected", "served", "threads",
+                                                 "rss[MB]", "total[s]", "p50[ms]", "p99[ms]"))
+    for mode in modes:
+        process, port = benchutil.startServer(tmpdir, SERVER_MODE=mode, SOCKET_TIMEOUT=120,
+                                              DB_SAVE_INTERVAL=3600, STAT_INTERVAL=3600)
+        try:
+            r = asyncio.run(runClients(process, port, nConnections))
+        finally:
+            benchutil.stopServer(process)
+        print("%-8s %9d %7d %9d %8.1f %9.2f %9.2f %9.2f" % (mode, r["connected"], r["served"], r["threads"],
+              r["rss"] / 1024.0, r["requestTime"], r["p50"] * 1000, r["p99"] * 1000))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( main(sys.argv) )
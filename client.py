@@ -5,6 +5,8 @@ CacheManager client implementation
 import socket
 import os, time
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from shared import Message, Connection, Configuration
 from cmlogging import *
 from filesystem import FileSystem
@@ -30,14 +32,23 @@ class ClientConfiguration (settings.ClientDefaultConfiguration):
 
 class CmClient:
     """ CacheManager Client"""
-    def __init__(self, config, single=True):
+    def __init__(self, config, single=True, jobs=None):
         """initialize client.
         set single=False if you need to fetch several files.
+        jobs: number of parallel transfers for bundles and batch requests
+        (default: FETCH_JOBS)
         """
         self.config = config
         self.single = single
+        self.setJobs(jobs)
         self.connection = self._connectToServer(config)
         self.locateLimit = 999999
+        self.requestClass = None
+        self.sendRequestClass()
+
+    def setJobs(self, jobs):
+        """number of parallel transfers (None: FETCH_JOBS)"""
+        self.jobs = max(1, jobs or self.config.FETCH_JOBS)
 
     def __del__(self):
         if not self.single:
@@ -46,7 +57,7 @@ class CmClient:
             except Exception:
                 pass
 
-    def _connectToServer(self, config):
+    def _openSocket(self, config):
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             server = settings.clientEnvironment().server(config)
@@ -54,14 +65,41 @@ class CmClient:
                 server = socket.gethostbyname(server)
             s.connect((server, config.MASTER_PORT))
             s.settimeout(config.SOCKET_TIMEOUT)
+            # messages are small, don't wait for the acknowledgement of the previous one
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         except Exception as e:
             error(str(e))
             return None
+        return s
+
+    def _connectToServer(self, config):
+        s = self._openSocket(config)
+        if s is None:
+            return None
         conn = Connection(s)
+        if config.PROTOCOL_VERSION > Message.PROTOCOL_V1 and \
+                not conn.handshake(min(config.SOCKET_TIMEOUT, config.HANDSHAKE_TIMEOUT),
+                                   config.PROTOCOL_VERSION):
+            # servers without protocol negotiation close the connection
+            debug("protocol negotiation failed. using version 1")
+            s = self._openSocket(config)
+            if s is None:
+                return None
+            conn = Connection(s)
         if not self.single:
             r = conn.sendMessage(Message(Message.KEEP_ALIVE, []))
         return conn
 
+    def sendRequestClass(self):
+        """send the user and the priority class (PRIORITY) of the following
+        requests to the server, if they have changed"""
+        if self.connection is None or self.connection.version < Message.PROTOCOL_V3:
+            return
+        requestClass = [ os.environ.get("USER") or str(os.getuid()), self.config.PRIORITY ]
+        if requestClass != self.requestClass:
+            self.connection.sendMessage(Message(Message.REQUEST_CLASS, requestClass))
+            self.requestClass = requestClass
+
     def isConnected(self):
         """return True if the client is connected to the cache manager server"""
         return not self.connection is None
@@ -119,6 +157,7 @@ class CmClient:
         destination = self.getDestination(fileSystem, filename)
         if destination is None:
             return (filename, 1)
+        fileSystem.logFetch(fileinfo)
         log("destination: " + str(destination))
 
         if os.path.isfile(destination):
@@ -143,6 +182,7 @@ class CmClient:
                 return (destination, 0)
 
         freeSpace, removed = fileSystem.checkFreeSpace(int(fileinfo[1]), destination)
+        fetcher.sendFilesRemoved(removed)
         if not freeSpace:
             log("not enough free space in %s" % fileSystem.cacheDir)
             if closeOnError and self.single: fetcher.sendExit()
@@ -159,6 +199,165 @@ class CmClient:
         return (resultFile, 0)
 
 
+    def fetchMany(self, files, locateLimit=9999):
+        """request local copies of several files using batch requests.
+        the server plans the transfers of all files at once, the copies
+        are executed in parallel (see jobs).
+
+        returns a list of tuples (f, r) in the order of files, with f the
+        cached filename (or the original filename) and r = True if the
+        file was successfully cached.
+        """
+        files = [ os.path.realpath(f) for f in files ]
+        if not self.isConnected():
+            return [ (f, False) for f in files ]
+        try:
+            fileSystem = FileSystem(self.config)
+            fetcher = CacheFetcher(self.config, fileSystem, self.connection)
+            fetcher.sendKeepAlive()
+            result = self._fetchFiles(files, fileSystem, fetcher, locateLimit)
+            if self.single: fetcher.sendExit()
+            return [ (f, (r == 0)) for f, r in result ]
+        except Exception as e:
+            error("unknown error: %s" % str(e))
+        return [ (f, False) for f in files ]
+
+    def _fetchFiles(self, files, fileSystem, fetcher, locateLimit=9999, conjunct=False):
+        """fetch several files, using a batch request if supported by the server.
+        with conjunct=True, the transfers are stopped after the first error.
+        returns a list of tuples (filename, retval) in the order of files"""
+        if self.connection.version >= Message.PROTOCOL_V2:
+            # the server plans up to 'jobs' parallel transfers
+            return self._fetchBatch(files, fileSystem, fetcher, locateLimit)
+        if self.jobs > 1 and len(files) > 1:
+            return self._fetchParallel(files, locateLimit, conjunct)
+        result = [ (f, 1) for f in files ]
+        for i, filename in enumerate(files):
+            result[i] = self._fetchFile(filename, fileSystem, fetcher, False, locateLimit)
+            if conjunct and result[i][1] != 0:
+                break
+        return result
+
+    def _fetchParallel(self, files, locateLimit=9999, conjunct=False):
+        """fetch files using a pool of 'jobs' connections to the server
+        (for servers without batch requests).
+        each connection fetches chunks of files taken from a common list"""
+        debug("fetchParallel: %d files, %d jobs" % (len(files), self.jobs))
+        result = [ (f, 1) for f in files ]
+        chunkSize = max(1, len(files) // (4 * self.jobs))
+        chunks = [ range(i, min(i + chunkSize, len(files))) for i in range(0, len(files), chunkSize) ]
+        chunks.reverse()
+        lock = threading.Lock()
+        failed = threading.Event()
+
+        def worker():
+            client = CmClient(self.config, False, 1)
+            if not client.isConnected():
+                return
+            fileSystem = FileSystem(self.config)
+            fetcher = CacheFetcher(self.config, fileSystem, client.connection)
+            while not (conjunct and failed.is_set()):
+                with lock:
+                    if not chunks:
+                        break
+                    chunk = chunks.pop()
+                fetched = client._fetchFiles([ files[i] for i in chunk ], fileSystem, fetcher,
+                                             locateLimit, conjunct)
+                for i, r in zip(chunk, fetched):
+                    result[i] = r
+                    if r[1] != 0:
+                        failed.set()
+
+        workers = [ threading.Thread(target=worker) for i in range(min(self.jobs, len(chunks))) ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return result
+
+    def _fetchBatch(self, files, fileSystem, fetcher, locateLimit=9999):
+        debug("fetchBatch: %d files" % len(files))
+        result = [ (f, 1) for f in files ]
+        requests = []
+        totalSize = 0
+        for i, filename in enumerate(files):
+            if not os.path.isfile(filename):
+                error("file not found '%s'" % filename)
+                continue
+            fileinfo = fileSystem.getFileInfo(filename)
+            destination = self.getDestination(fileSystem, filename)
+            if fileinfo is None or destination is None:
+                continue
+            fileSystem.logFetch(fileinfo)
+            fileExists, canCopy, removed = fileSystem.destinationExists(fileinfo, destination)
+            if removed:
+                log("removed " + destination)
+                fetcher.sendFileRemoved(fileinfo, destination)
+            if not canCopy:
+                error("cannot copy file to %s" % destination)
+            elif fileExists:
+                debug("using existing file " + destination)
+                fileSystem.setATime(destination)
+                fetcher.sendFileLocation(fileinfo, destination)
+                result[i] = (destination, 0)
+            else:
+                requests.append((i, fileinfo, destination))
+                totalSize += int(fileinfo[1])
+        if not requests:
+            return result
+
+        freeSpace, removed = fileSystem.checkFreeSpace(totalSize, requests[0][2])
+        fetcher.sendFilesRemoved(removed)
+        if not freeSpace:
+            log("not enough free space in %s" % fileSystem.cacheDir)
+            return result
+
+        jobs = self.jobs
+        pt = PingThread.create(self.connection, self.config)
+        try:
+            while requests:
+                log("request: %d files" % len(requests))
+                fetcher.requestFiles([ (r[1], r[2]) for r in requests ], locateLimit, jobs)
+                waiting = []
+                wait = 0
+                pool = ThreadPoolExecutor(jobs)
+                futures = {}
+                while True:
+                    msg = self.connection.receiveMessage()
+                    if msg is None:
+                        error("no connection to master")
+                        break
+                    elif msg.type == Message.EXIT:
+                        break
+                    elif msg.type != Message.FETCH_PLAN:
+                        error("unexpected message: %s" % str(msg))
+                        break
+                    index = int(msg.content[0])
+                    action = msg.content[1]
+                    i, fileinfo, destination = requests[index]
+                    if action == Message.PLAN_WAIT:
+                        waiting.append(requests[index])
+                        wait = max(wait, int(msg.content[2]))
+                    elif action == Message.PLAN_FALLBACK:
+                        log("no local cache available for %s" % fileinfo[0])
+                    else:
+                        futures[i] = pool.submit(fetcher.executePlan, index, fileinfo, destination,
+                                                 msg.content[1:])
+                pool.shutdown()
+                for i, future in futures.items():
+                    f = future.result()
+                    if f is not None:
+                        result[i] = (f, 0)
+                if msg is None:
+                    break
+                requests = waiting
+                if waiting:
+                    log("no copy slot available for %d files. wait %ds" % (len(waiting), wait))
+                    time.sleep(wait)
+        finally:
+            pt.stop()
+        return result
+
     def _getBundleSourceFiles(self, bundleFile, fileSystem):
         """ return: files, total size """
         srcFiles = []
@@ -204,6 +403,7 @@ class CmClient:
 
         if conjunct:
             freeSpace, removed = fileSystem.checkFreeSpace(int(totalSize), destination)
+            fetcher.sendFilesRemoved(removed)
             if not freeSpace or not srcFiles:
                 log("not enough free space in %s" % fileSystem.cacheDir)
                 log("result is not cached")
@@ -211,8 +411,8 @@ class CmClient:
                 return (filename, 1)
         cachedFiles = []
         dstFiles = []
-        for fileItem in srcFiles:
-            dst, retval = self._fetchFile(fileItem, fileSystem, fetcher, False, locateLimit)
+        fetched = self._fetchFiles(srcFiles, fileSystem, fetcher, locateLimit, conjunct)
+        for fileItem, (dst, retval) in zip(srcFiles, fetched):
             if retval != 0:
                 warning("cannot cache bundle content: %s" % fileItem)
                 dst = fileItem
@@ -233,6 +433,7 @@ class CmClient:
             out.write("\n".join(dstFiles))
             out.write("\n")
             out.close()
+            fileSystem.addCachedFile(destination, filename)
             return (destination, 0)
 
     def getLocations(self, files, locations, forceBundle=False, locateLimit=99999):
@@ -252,6 +453,17 @@ class CmClient:
         try:
             fileSystem = FileSystem(self.config)
             fetcher = CacheFetcher(self.config, fileSystem, self.connection)
+            if self.connection.version >= Message.PROTOCOL_V2:
+                filenames = []
+                for f in files:
+                    filename = os.path.realpath(f)
+                    if forceBundle or self._isBundleFile(filename):
+                        filenames += self._getBundleSourceFiles(filename, fileSystem)[0]
+                    else:
+                        filenames.append(filename)
+                loc, retval = self._findLocationsBatch(filenames, fileSystem, fetcher)
+                locations += loc
+                return (retval == 0)
             nFiles = len(files)
             for i in range(nFiles):
                 filename = os.path.realpath(files[i])
@@ -301,6 +513,61 @@ class CmClient:
             fetcher.sendExit()
         return (locations, 0)
 
+    def _findLocationsBatch(self, files, fileSystem, fetcher):
+        """find the locations of several files using a single request.
+        the locations are validated in parallel"""
+        debug("findLocationsBatch: %d files" % len(files))
+        retval = 0
+        fileinfos = []
+        for filename in files:
+            if not os.path.isfile(filename):
+                error("file not found '%s'" % filename)
+                retval = 1
+                continue
+            fileinfo = fileSystem.getFileInfo(filename)
+            if fileinfo:
+                fileinfos.append(fileinfo)
+            else:
+                retval = 1
+        hostname = socket.gethostname()
+        fetcher.sendKeepAlive()
+        fetcher.requestLocationsMany(fileinfos, self.locateLimit)
+        candidates = []
+        while True:
+            msg = self.connection.receiveMessage()
+            if msg is None:
+                error("no connection to master")
+                return ([], 1)
+            elif msg.type == Message.EXIT:
+                break
+            elif msg.type != Message.LOCATIONS:
+                error("unexpected message: %s" % str(msg))
+                return ([], 1)
+            fileinfo = fileinfos[int(msg.content[0])]
+            for j in range(1, len(msg.content), 3):
+                candidates.append((fileinfo, msg.content[j], msg.content[j+1], msg.content[j+2] == "1"))
+
+        def validate(candidate):
+            fileinfo, host, path, isLocal = candidate
+            if isLocal:
+                valid = fetcher.checkLocal(fileinfo, path)
+                host = hostname
+            else:
+                valid = fetcher.checkRemote(fileinfo, host, path)
+                if valid:
+                    fetcher.brandFile(host, path)
+            if not valid:
+                fetcher.sendInvalidCopy(fileinfo, candidate[1], path)
+                return None
+            return (host, path, fileinfo[1])
+
+        pool = ThreadPoolExecutor(self.jobs)
+        locations = [ l for l in pool.map(validate, candidates) if l is not None ]
+        pool.shutdown()
+        if self.single:
+            fetcher.sendExit()
+        return (locations, retval)
+
     def _findBundleLocations(self, filename, fileSystem, fetcher, sendExit):
         debug("findBundleLocations: " + filename)
         allLocations = []
@@ -325,6 +592,76 @@ class CmClient:
             fetcher.sendExit()
         return (allLocations, 0)
 
+    def _query(self, request):
+        """send a request to the server. returns the content of the reply
+        messages, None on error. requires protocol version 2"""
+        if not self.isConnected():
+            return None
+        if self.connection.version < Message.PROTOCOL_V2:
+            error("request requires protocol version 2")
+            return None
+        if not self.connection.sendMessage(request):
+            error("no connection to master")
+            return None
+        content = []
+        while True:
+            msg = self.connection.receiveMessage()
+            if msg is None:
+                error("no connection to master")
+                return None
+            elif msg.type == Message.EXIT:
+                return content
+            elif msg.type != request.type:
+                error("unexpected message: %s" % str(msg))
+                return None
+            content += msg.content
+
+    def hostFiles(self, host):
+        """return (filename, path, size, mtime) of the copies on a host"""
+        content = self._query(Message(Message.HOST_FILES, [ host ]))
+        if content is None:
+            return None
+        return [ (content[i], content[i+1], int(content[i+2]), int(content[i+3]))
+                 for i in range(0, len(content) - 3, 4) ]
+
+    def removeHost(self, host):
+        """remove all copies on a host from the server database.
+        returns the number of removed locations"""
+        content = self._query(Message(Message.REMOVE_HOST, [ host ]))
+        if content == []:
+            error("request rejected by the server (ADMIN_HOSTS)")
+        if not content:
+            return None
+        return int(content[0])
+
+    def hostUsage(self):
+        """return (host, number of copies, bytes) for all hosts,
+        sorted by decreasing size"""
+        content = self._query(Message(Message.HOST_USAGE, []))
+        if content is None:
+            return None
+        usage = [ (content[i], int(content[i+1]), int(content[i+2]))
+                  for i in range(0, len(content) - 2, 3) ]
+        return sorted(usage, key = lambda u: -u[2])
+
+    def prefixFiles(self, prefix):
+        """return (filename, number of copies) of the known files starting with prefix"""
+        content = self._query(Message(Message.PREFIX_FILES, [ prefix ]))
+        if content is None:
+            return None
+        return [ (content[i], int(content[i+1])) for i in range(0, len(content) - 1, 2) ]
+
+    def removePrefix(self, prefix):
+        """remove all files starting with prefix from the server database,
+        e.g. after a directory has been regenerated.
+        returns the number of removed files"""
+        content = self._query(Message(Message.REMOVE_PREFIX, [ prefix ]))
+        if content == []:
+            error("request rejected by the server (ADMIN_HOSTS)")
+        if not content:
+            return None
+        return int(content[0])
+
     def copy(self, filename, destination, register=True, forceBundle=False):
         """ copy a file from the local disk (filename) to a file server (destination).
         filename: source file name
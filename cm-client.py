@@ -6,9 +6,11 @@ load balanced file caching on local harddisks
 
 import sys
 import os
+import socket
 from cmlogging import *
-from client import CmClient, ClientConfiguration
-from filesystem import FileSystem
+from shared import Message, Connection, agentSocket, peerUid
+# client and filesystem are imported on demand, requests served by
+# the node agent do not need them
 
 __version__ = "$Rev: 837 $"
 __author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
@@ -18,7 +20,7 @@ def usage():
     p = os.path.basename(sys.argv[0])
     sys.stderr.write("usage: \n" +\
                      "  get local copy:\n" +\
-                     "      %s [options] <filename>\n" % p +\
+                     "      %s [options] <filenames>\n" % p +\
                      "  copy local file to file server:\n" +\
                      "      %s [options] -cp [-n|--noregister] [-m|--maxloc N] <source> <destination>\n" % p +\
                      "       --noregister    don't register local copy\n" +\
@@ -28,11 +30,25 @@ def usage():
                      "      %s [options] -ll <location-limit-per-file> <filenames> \n" % p +\
                      "  get destination for local copy (do not copy):\n" +\
                      "      %s [options] -d <filename>\n" % p +\
+                     "  list the copies on a host, remove them from the database:\n" +\
+                     "      %s [options] --host-files <host>\n" % p +\
+                     "      %s [options] --remove-host <host>\n" % p +\
+                     "  list the known files in a directory, remove them from the database:\n" +\
+                     "      %s [options] --prefix-files <prefix>\n" % p +\
+                     "      %s [options] --remove-prefix <prefix>\n" % p +\
+                     "  cached bytes per host:\n" +\
+                     "      %s [options] --host-usage\n" % p +\
+                     "  run node agent (serves the requests of the user on a Unix socket):\n" +\
+                     "      %s [--config <file>] --agent\n" % p +\
+                     "  run peer transfer service (serves the cache directory to other nodes):\n" +\
+                     "      %s [--config <file>] --peer\n" % p +\
                      "  options:\n"+\
                      "       --config <file> use alternative configuration\n" +\
                      "       --debug         enable debug output\n"+\
                      "       --bundle        treat file as bundle\n"+\
                      "       --conjunct      cache all files or none (for bundles)\n"+\
+                     "       --jobs N        fetch up to N files in parallel (for bundles)\n"+\
+                     "       --priority C    priority class of the requests (e.g. high, normal, low)\n"+\
                      "       --nobundle      ignore special meaning of *.bundle files\n")
 
 class Options:
@@ -48,7 +64,16 @@ class Options:
         self.nobundle = False
         self.bundle = False
         self.conjunct = False
+        self.jobs = None
+        self.priority = None
         self.printDestination = False
+        self.agent = False
+        self.peer = False
+        self.hostFiles = None
+        self.removeHost = None
+        self.hostUsage = False
+        self.prefixFiles = None
+        self.removePrefix = None
         self.arg = []
         self.parseArguments(argv)
 
@@ -58,9 +83,8 @@ class Options:
         while i < n:
             a = argv[i]
             if a == "--":
-                try:
-                    self.arg = argv[i+1:]
-                except Exception: pass
+                self.arg += argv[i+1:]
+                break
             elif a == "--help" or a == "-h":
                 self.help = True
             elif a == "--version" or a == "-V":
@@ -90,12 +114,52 @@ class Options:
                 self.printDestination = True
             elif a == "--debug":
                 self.debug = True
+            elif a == "--agent":
+                self.agent = True
+            elif a == "--peer":
+                self.peer = True
+            elif a == "--host-files" or a == "--remove-host":
+                try:
+                    if a == "--host-files":
+                        self.hostFiles = argv[i+1]
+                    else:
+                        self.removeHost = argv[i+1]
+                    i += 1
+                except IndexError:
+                    error("%s expects a host name" % a)
+                    return 1
+            elif a == "--host-usage":
+                self.hostUsage = True
+            elif a == "--prefix-files" or a == "--remove-prefix":
+                try:
+                    if a == "--prefix-files":
+                        self.prefixFiles = argv[i+1]
+                    else:
+                        self.removePrefix = argv[i+1]
+                    i += 1
+                except IndexError:
+                    error("%s expects a path" % a)
+                    return 1
             elif a == "--nobundle":
                 self.nobundle = True
             elif a == "--bundle":
                 self.bundle = True
             elif a == "--conjunct":
                 self.conjunct = True
+            elif a == "--jobs" or a == "-j":
+                try:
+                    self.jobs = int(argv[i+1])
+                    i += 1
+                except:
+                    error("--jobs (-j) expects an int")
+                    return 1
+            elif a == "--priority":
+                try:
+                    self.priority = argv[i+1]
+                    i += 1
+                except IndexError:
+                    error("--priority expects a priority class")
+                    return 1
             elif a == "--config":
                 try:
                     self.config = argv[i+1]
@@ -109,12 +173,147 @@ class Options:
             i += 1
 
 
+    def agentArguments(self):
+        """arguments of the request sent to the node agent.
+        file names are made absolute"""
+        args = []
+        for flag, isSet in [ ("-cp", self.copy), ("-n", not self.register), ("-l", self.locate),
+                             ("-d", self.printDestination), ("--nobundle", self.nobundle),
+                             ("--bundle", self.bundle), ("--conjunct", self.conjunct) ]:
+            if isSet:
+                args.append(flag)
+        args += [ "-m", str(self.locateLimit) ]
+        if self.jobs:
+            args += [ "-j", str(self.jobs) ]
+        if self.priority:
+            args += [ "--priority", self.priority ]
+        if self.hostFiles is not None:
+            args += [ "--host-files", self.hostFiles ]
+        if self.removeHost is not None:
+            args += [ "--remove-host", self.removeHost ]
+        if self.hostUsage:
+            args.append("--host-usage")
+        if self.prefixFiles is not None:
+            args += [ "--prefix-files", self.prefixFiles ]
+        if self.removePrefix is not None:
+            args += [ "--remove-prefix", self.removePrefix ]
+        return args + [ "--" ] + [ os.path.abspath(a) for a in self.arg ]
+
+    def isAdminRequest(self):
+        return self.hostFiles is not None or self.removeHost is not None or self.hostUsage or \
+               self.prefixFiles is not None or self.removePrefix is not None
+
+    def useAgent(self):
+        """requests with a custom configuration or debug output are not
+        sent to the node agent"""
+        return not (self.agent or self.peer or self.config or self.debug)
+
+
+def requestAgent(options):
+    """let the node agent execute the request.
+    returns the exit status or None if no agent of the user is running"""
+    path = agentSocket()
+    if path is None:
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error:
+        s.close()
+        return None
+    if peerUid(s) != os.getuid():
+        warning("%s is not served by an agent of the user" % path)
+        s.close()
+        return None
+    conn = Connection(s)
+    conn.setProtocolVersion(Message.PROTOCOL_V2)
+    msg = None
+    if conn.sendMessage(Message(Message.AGENT_REQUEST, options.agentArguments())):
+        msg = conn.receiveMessage()
+    conn.close()
+    if msg is None or msg.type != Message.AGENT_RESULT:
+        return None
+    sys.stderr.write(msg.content[2])
+    sys.stdout.write(msg.content[1])
+    return int(msg.content[0])
+
+
+def runAdminRequest(options, client, out):
+    """execute --host-files, --remove-host, --host-usage, --prefix-files
+    or --remove-prefix"""
+    if options.hostFiles is not None:
+        r = client.hostFiles(options.hostFiles)
+        for f in r or []:
+            out.write("%s:%s:%d:%d\n" % f)
+    elif options.removeHost is not None:
+        r = client.removeHost(options.removeHost)
+        if r is not None:
+            log("removed %d copies on %s" % (r, options.removeHost))
+    elif options.prefixFiles is not None:
+        r = client.prefixFiles(options.prefixFiles)
+        for f in r or []:
+            out.write("%s %d\n" % f)
+    elif options.removePrefix is not None:
+        r = client.removePrefix(options.removePrefix)
+        if r is not None:
+            log("removed %d files below %s" % (r, options.removePrefix))
+    else:
+        r = client.hostUsage()
+        for u in r or []:
+            out.write("%s %d %d\n" % u)
+    return int(r is None)
+
+
+def runClient(options, config, client, out):
+    """execute the request. output is written to out.
+    returns the exit status"""
+    from client import CmClient
+    from filesystem import FileSystem
+
+    if options.priority:
+        config.PRIORITY = options.priority
+    if client is not None:
+        client.sendRequestClass()
+
+    if options.isAdminRequest():
+        return runAdminRequest(options, client, out)
+
+    filename = options.arg[0]
+    if options.nobundle:
+        config.IGNORE_BUNDLE = True
+
+    if options.printDestination:
+        out.write(CmClient.getDestination(FileSystem(config), os.path.realpath(filename)) + "\n")
+        return 0
+
+    client.setJobs(options.jobs)
+    r = False
+    if options.copy:
+        r = client.copy(filename, options.arg[1], options.register, options.bundle)
+    elif options.locate:
+        locations = []
+        r = client.getLocations(options.arg, locations, options.bundle, options.locateLimit)
+        log("%d locations found" % len(locations))
+        for l in locations:
+            out.write("%s:%s:%s\n" % l)
+    elif len(options.arg) > 1 and not options.bundle:
+        r = True
+        for f, ok in client.fetchMany(options.arg, options.locateLimit):
+            out.write(f + "\n")
+            r = r and ok
+    else:
+        f, r = client.fetch(filename, options.bundle, options.conjunct, options.locateLimit)
+        out.write(f + "\n")
+    return int(not r)
+
+
 def main(argc, argv):
     options = Options(argv)
     if options.version:
         sys.stderr.write("%s\n" % __version__)
         return 1
-    if options.help or len(options.arg) < 1:
+    if options.help or (len(options.arg) < 1 and not (options.agent or options.peer) and
+                         not options.isAdminRequest()):
         usage()
         return 1
     if options.debug:
@@ -124,7 +323,12 @@ def main(argc, argv):
             usage()
             return 1
 
-    filename = options.arg[0]
+    if options.useAgent():
+        r = requestAgent(options)
+        if r is not None:
+            return r
+
+    from client import CmClient, ClientConfiguration
     config = ClientConfiguration(options.config)
 
     if options.config:
@@ -134,33 +338,28 @@ def main(argc, argv):
         if not config.loadDefault():
             error("cannot read default config file. using build-in defaults")
 
-    if options.nobundle:
-        config.IGNORE_BUNDLE = True
-
-    if options.printDestination:
-        print(CmClient.getDestination(FileSystem(config), os.path.realpath(filename)))
-        return 0
+    if options.agent:
+        import signal
+        from agent import NodeAgent
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        agent = NodeAgent(config, runClient, lambda args: Options([ argv[0] ] + args))
+        return not agent.serve()
 
-    client = CmClient(config)
+    if options.peer:
+        import signal
+        from peer import PeerServer
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        return not PeerServer(config).serve()
 
-    if not client.isConnected():
-        error("cannot connect to server")
-    else:
-        log("connected to %s" % str(client.connection.getPeerName()))
+    client = None
+    if not options.printDestination:
+        client = CmClient(config, jobs=options.jobs)
+        if not client.isConnected():
+            error("cannot connect to server")
+        else:
+            log("connected to %s" % str(client.connection.getPeerName()))
 
-    r = False
-    if options.copy:
-        r = client.copy(filename, options.arg[1], options.register, options.bundle)
-    elif options.locate:
-        locations = []
-        r = client.getLocations(options.arg, locations, options.bundle, options.locateLimit)
-        log("%d locations found" % len(locations))
-        for l in locations:
-            print("%s:%s:%s" % l)
-    else:
-        f, r = client.fetch(filename, options.bundle, options.conjunct, options.locateLimit)
-        print(f)
-    return not r
+    return runClient(options, config, client, sys.stdout)
 
 if __name__ == "__main__":
     sys.exit( main(len(sys.argv), sys.argv) )
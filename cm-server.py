@@ -4,15 +4,21 @@ cache management server
 supervises load balanced file caching on local harddisks
 """
 
+import os
 import sys
+import glob
 import socket
 import threading
 import copy
 import time
 import pickle as cpickle
 import random
+import collections
 import signal
 import gzip
+import marshal
+import sqlite3
+import asyncio
 from shared import Message, Configuration, Connection
 from cmlogging import *
 
@@ -33,6 +39,14 @@ class ServerConfiguration (Configuration):
     DB_FILE             = "/u/rybach/temp/test.db"
     # interval between database writes (seconds)
     DB_SAVE_INTERVAL    = 60
+    # interval between commits of the database log (seconds). 0: no log
+    DB_LOG_COMMIT_INTERVAL = 1.0
+    # size of the database log triggering a database write (bytes)
+    DB_LOG_MAX_SIZE     = 256 * 1024 * 1024
+    # write the database in a forked process
+    DB_FORK_WRITER      = True
+    # number of independently locked parts of the database
+    DB_SHARDS           = 16
     # interval between statistics writes (seconds)
     STAT_INTERVAL       = 10
     # interval between database cleanups (seconds)
@@ -43,49 +57,386 @@ class ServerConfiguration (Configuration):
     MAX_WAIT_COPY       = 10*60
     # time a client has to wait before next copy attempt (seconds)
     CLIENT_WAIT         = 10
+    # maximum time a request waits in the queue for a copy slot (seconds).
+    # has to be less than SOCKET_TIMEOUT of the clients. 0: no queue
+    QUEUE_WAIT          = 60
+    # maximum number of parallel transfers from/to a host used by one user. 0: no limit
+    MAX_COPY_USER       = 0
+    # MAX_COPY_USER of individual users, e.g. { "alice" : 10 }
+    USER_MAX_COPY       = {}
+    # maximum number of parallel transfers from/to a host used by all
+    # users of one client node. 0: no limit
+    MAX_COPY_CLIENT     = 0
+    # priority classes of the requests, highest priority first
+    PRIORITY_CLASSES    = [ "high", "normal", "low" ]
+    # priority class of requests without class
+    DEFAULT_PRIORITY    = "normal"
+    # hosts (short names) allowed to request a class higher than
+    # DEFAULT_PRIORITY, e.g. { "high" : [ "node1" ] }. the requests of
+    # other hosts get DEFAULT_PRIORITY
+    PRIORITY_HOSTS      = {}
+    # requests for a file copied from the file server by another client
+    # wait for this copy and use it or the copies made from it
+    COALESCE_REQUESTS   = True
+    # distribution of a file requested by many nodes:
+    # random: requests finding busy node copies read the file from the
+    # file server, unless it has just been copied from there
+    # tree: while the file is copied, requests finding busy node copies
+    # wait for the next copy that finishes
+    DISTRIBUTION        = "random"
+    # maximum number of nodes a file is copied from at once (striped
+    # copy, clients with protocol version 4). 1: disabled
+    MAX_STRIPE_SOURCES  = 1
+    # minimum size of files copied from several nodes (bytes)
+    STRIPE_MIN_SIZE     = 1024 ** 3
     # time after a record in the database is deleted (seconds)
     # this number should be synchronized with the interval of /etc/cron.daily/cleanuptmp
     MAX_AGE             = 60 * 60 * 24 * 7
+    # hosts (short names) allowed to remove the copies of other hosts and
+    # the files below a prefix from the database. other clients may only
+    # remove their own copies
+    ADMIN_HOSTS         = []
+    # "threads": one thread per client connection
+    # "async": all connections are handled by a single event loop
+    SERVER_MODE         = "threads"
+
+
+class CopyWaiter:
+    """request waiting for a copy slot of one of several hosts (file server
+    or node). granted is set when a slot has been assigned to the request,
+    token is 0 if the destination file is copied by another request.
+
+    a follower waits for the copy of its source file from the file server
+    by another request, or for any copy of its source file. it is granted (token 0) when this copy has finished.
+    """
+
+    def __init__(self, destNode, file, sources, location = None, user = None, priority = 0, cost = 0,
+                 source = None):
+        self.destNode = destNode
+        self.file = file
+        # (filename, size, mtime) of the requested file
+        self.source = source
+        self.follower = False
+        # list of followers containing the waiter
+        self.followed = None
+        self.user = user or destNode
+        self.priority = priority
+        # size of the file
+        self.cost = cost
+        # [ (host, maximum number of copies) ]
+        self.sources = sources
+        self.location = location
+        self.granted = False
+        self.host = None
+        self.token = 0
+        self.event = threading.Event()
+        self.callback = None
+
+    def notify(self):
+        self.event.set()
+        callback = self.callback
+        if callback is not None:
+            callback()
+
+    def wait(self, timeout):
+        self.event.wait(timeout)
+
+    async def waitAsync(self, timeout):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def wakeup():
+            if not future.done():
+                future.set_result(None)
+        self.callback = lambda: loop.call_soon_threadsafe(wakeup)
+        if self.event.is_set():
+            return
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class FairQueue:
+    """requests of several users sharing the copy slots of a host.
+    the users are served by deficit round robin, the cost of a request
+    is the size of the file. a user gets QUANTUM bytes per round."""
+
+    QUANTUM = 1024 ** 3
+
+    def __init__(self):
+        self.users = collections.deque()
+        # user -> deque of CopyWaiter
+        self.waiters = {}
+        self.deficit = {}
+        # the first user has received its quantum
+        self.started = False
+
+    def __len__(self):
+        return len(self.users)
+
+    def append(self, waiter):
+        if not waiter.user in self.waiters:
+            self.waiters[waiter.user] = collections.deque()
+            self.deficit[waiter.user] = 0
+            self.users.append(waiter.user)
+        self.waiters[waiter.user].append(waiter)
+
+    def remove(self, waiter):
+        waiters = self.waiters[waiter.user]
+        waiters.remove(waiter)
+        if not waiters:
+            if self.users[0] == waiter.user:
+                self.started = False
+            self.users.remove(waiter.user)
+            del self.waiters[waiter.user]
+            del self.deficit[waiter.user]
+
+    def pop(self, eligible):
+        """remove and return the next request of a user for which
+        eligible(user) is true. returns None if there is no such user"""
+        if not [ user for user in self.users if eligible(user) ]:
+            return None
+        while True:
+            user = self.users[0]
+            if eligible(user):
+                if not self.started:
+                    self.deficit[user] += self.QUANTUM
+                    self.started = True
+                waiter = self.waiters[user][0]
+                if waiter.cost <= self.deficit[user]:
+                    self.deficit[user] -= waiter.cost
+                    self.remove(waiter)
+                    return waiter
+            self.users.rotate(-1)
+            self.started = False
+
+
+class SlotQueue:
+    """requests waiting for the copy slots of a host. requests of a higher
+    priority class (lower number) are served first, the requests of a
+    class are served by a FairQueue"""
+
+    def __init__(self):
+        # priority -> FairQueue
+        self.classes = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, waiter):
+        if not waiter.priority in self.classes:
+            self.classes[waiter.priority] = FairQueue()
+        self.classes[waiter.priority].append(waiter)
+        self.size += 1
+
+    def remove(self, waiter):
+        """raises ValueError if the waiter is not queued"""
+        queue = self.classes.get(waiter.priority)
+        if queue is None or not waiter.user in queue.waiters:
+            raise ValueError("not queued")
+        queue.remove(waiter)
+        self.size -= 1
+        if not queue:
+            del self.classes[waiter.priority]
+
+    def waiters(self):
+        """list of all queued requests"""
+        return [ waiter for queue in self.classes.values()
+                 for waiters in queue.waiters.values() for waiter in waiters ]
+
+    def pop(self, eligible):
+        for priority in sorted(self.classes.keys()):
+            queue = self.classes[priority]
+            waiter = queue.pop(eligible)
+            if waiter is not None:
+                self.size -= 1
+                if not queue:
+                    del self.classes[priority]
+                return waiter
+        return None
 
 
 class CopyCounter:
+    """copy slots of the file servers and nodes.
+
+    requests which do not get a slot wait in a SlotQueue per host
+    (enqueue). a slot freed by endCopy is assigned to the next request in
+    the queue of the host, and the request is notified. new requests do
+    not get a slot of a host while requests are waiting for it.
+
+    the slots of a host used by one user can be limited (MAX_COPY_USER),
+    as well as the slots used by all users of a client node
+    (MAX_COPY_CLIENT). the user name is sent by the client and cannot be
+    verified, a user is therefore identified by (node, user name).
+    requests without user are accounted to the node.
+
+    requests for a source file which is copied from a file server are
+    coalesced (COALESCE_REQUESTS): they wait as followers of this copy
+    instead of reading the file from the file server again. after the
+    copy, the source file is distributed for MAX_WAIT_COPY seconds
+    (isDistributing). with DISTRIBUTION = "tree", a file is also
+    distributed while any copy of it is running.
+
+    requests for a distributed file finding only busy node copies wait
+    for the file instead of a node. each finished copy of the file wakes
+    up 1 + MAX_COPY_NODE of them: one for the freed slot of the source,
+    the others for the new copy. the nodes form a distribution tree, in
+    which each node serves further nodes as soon as it has the file,
+    instead of queueing at randomly chosen nodes.
+    """
 
     def __init__(self, config):
         self.config = config
+        # host -> [ free slots, { token : user }, { user : used slots } ]
         self.counters = {}
         self.activeTransfers = {}
+        # host -> SlotQueue
+        self.queues = {}
+        # source file -> [ copy token, [ followers ] ] of copies from file servers
+        self.originCopies = {}
+        self.originTokens = {}
+        # source file -> end of distribution
+        self.distributing = {}
+        # copy token -> source file, source file -> number of copies
+        self.sourceTokens = {}
+        self.sourceCopies = {}
+        # source file -> [ followers ] waiting for any copy (tree distribution)
+        self.fileWaiters = {}
+        self.lastToken = 0
         self.lock = threading.Lock()
 
-    def _startCopy(self, host, destNode, file):
+    def _newToken(self):
+        # tokens are unique, they identify the slot
+        self.lastToken = max(time.time(), self.lastToken + 0.001)
+        return self.lastToken
+
+    @staticmethod
+    def _node(user):
+        """client node of a user (node, user name) or node"""
+        return user[0] if isinstance(user, tuple) else user
+
+    def _maxCopyUser(self, user):
+        if isinstance(user, tuple):
+            return self.config.USER_MAX_COPY.get(user[1], self.config.MAX_COPY_USER)
+        return self.config.MAX_COPY_USER
+
+    def _belowUserLimit(self, item, user):
+        limit = self._maxCopyUser(user)
+        if limit > 0 and item[2].get(user, 0) >= limit:
+            return False
+        limit = self.config.MAX_COPY_CLIENT
+        if limit > 0:
+            node = self._node(user)
+            return sum([ n for u, n in item[2].items() if self._node(u) == node ]) < limit
+        return True
+
+    def _startCopy(self, host, destNode, file, user = None):
+        user = user or destNode
         i = self.counters[host]
         debug(str(i))
         self._cleanup(i)
         self._cleanupActiveTransfers(destNode, False)
         if i[0] <= 0:
             r = 0
+        elif not self._belowUserLimit(i, user):
+            r = 0
         elif destNode in self.activeTransfers and file in self.activeTransfers[destNode]:
             r = 0
         else:
-            token = int(time.time())
-            i[0] -= 1
-            i[1].append(token)
-            r = token
+            r = token = self._takeSlot(i, user)
             if (file in self.activeTransfers[destNode]):
                 error("copy constrained violated: %s %s %s" % (destNode, file, str(token)))
             self.activeTransfers[destNode][file] = token
         debug("end startCopy: => %s" % str(r))
         return r
 
+    def _takeSlot(self, item, user):
+        token = self._newToken()
+        item[0] -= 1
+        item[1][token] = user
+        item[2][user] = item[2].get(user, 0) + 1
+        return token
+
+    def _release(self, item, token):
+        """free the slot of token. returns False if the token is unknown"""
+        user = item[1].pop(token, None)
+        if user is None:
+            return False
+        item[0] += 1
+        item[2][user] -= 1
+        if item[2][user] <= 0:
+            del item[2][user]
+        if token in self.originTokens:
+            self._endOrigin(self.originTokens.pop(token))
+        source = self.sourceTokens.pop(token, None)
+        if source is not None:
+            self.sourceCopies[source] -= 1
+            if self.sourceCopies[source] <= 0:
+                del self.sourceCopies[source]
+            self._wakeFileWaiters(source, 1 + self.config.MAX_COPY_NODE)
+        return True
+
+    def _trackSource(self, source, token):
+        """count the copies of source"""
+        if source is not None and token:
+            self.sourceTokens[token] = source
+            self.sourceCopies[source] = self.sourceCopies.get(source, 0) + 1
+
+    def _wakeFileWaiters(self, source, n):
+        waiters = self.fileWaiters.get(source)
+        if not waiters:
+            return
+        for waiter in waiters[:n]:
+            waiter.granted = True
+            waiter.notify()
+        del waiters[:n]
+        if not waiters:
+            del self.fileWaiters[source]
+
+    def _startOrigin(self, host, source, token):
+        """source is copied from the file server host. requests for source
+        queued at host become followers of this copy"""
+        if source is None or not self.config.COALESCE_REQUESTS:
+            return
+        self.originCopies[source] = [ token, [] ]
+        self.originTokens[token] = source
+        if host in self.queues:
+            for waiter in self.queues[host].waiters():
+                if waiter.source == source:
+                    self._dequeue(waiter)
+                    self._follow(waiter, self.originCopies[source][1])
+
+    def _endOrigin(self, source):
+        """the copy of source from the file server has finished (or failed)"""
+        token, followers = self.originCopies.pop(source)
+        if not followers:
+            return
+        now = time.time()
+        for s in [ s for s, t in self.distributing.items() if t < now ]:
+            del self.distributing[s]
+        self.distributing[source] = now + self.config.MAX_WAIT_COPY
+        debug("coalesced %d requests for %s" % (len(followers), source[0]))
+        for waiter in followers:
+            waiter.granted = True
+            waiter.notify()
+
+    def isDistributing(self, source):
+        """return True if requests for source should use node copies"""
+        self.lock.acquire()
+        try:
+            r = self.distributing.get(source, 0) >= time.time() or \
+                (self.config.DISTRIBUTION == "tree" and source in self.sourceCopies)
+        finally:
+            self.lock.release()
+        return r
+
     def _cleanup(self, item):
         curTime = time.time()
-        new = []
-        for i in item[1]:
-            if curTime - i > self.config.MAX_WAIT_COPY:
-                item[0] += 1
+        for token in list(item[1].keys()):
+            if curTime - token > self.config.MAX_WAIT_COPY:
+                self._release(item, token)
                 debug("removed waiting")
-            else:
-                new.append(i)
-        item[1] = new
 
     def _cleanupActiveTransfers(self, destNode, removeNode):
         if not destNode in self.activeTransfers:
@@ -107,6 +458,8 @@ class CopyCounter:
             r = True
             if host in self.counters and self.counters[host][0] <= 0:
                 r = False
+            elif host in self.queues:
+                r = False
         finally:
             self.lock.release()
         return r
@@ -124,34 +477,57 @@ class CopyCounter:
         debug("isActiveTransfer %s %s %s" % (destNode, file, str(r)))
         return r
 
-    def startCopyFromNode(self, host, destNode, file):
+    def startCopyFromNode(self, host, destNode, file, user = None, source = None):
         self.lock.acquire()
         try:
             self._initCounter(host, destNode, self.config.MAX_COPY_NODE)
             self._initActiveTransfer(destNode)
-            r = self._startCopy(host, destNode, file)
+            r = 0
+            if not host in self.queues:
+                r = self._startCopy(host, destNode, file, user)
+                self._trackSource(source, r)
         finally:
                 self.lock.release()
         return r
 
-    def startCopyFromServer(self, host, destNode, file):
+    def startStripe(self, host, destNode, user = None):
+        """take a slot of host for a further source of a striped copy to
+        destNode. the copy is registered by its first source"""
+        self.lock.acquire()
+        try:
+            self._initCounter(host, destNode, self.config.MAX_COPY_NODE)
+            item = self.counters[host]
+            self._cleanup(item)
+            user = user or destNode
+            r = 0
+            if not host in self.queues and item[0] > 0 and self._belowUserLimit(item, user):
+                r = self._takeSlot(item, user)
+        finally:
+            self.lock.release()
+        return r
+
+    def startCopyFromServer(self, host, destNode, file, user = None, source = None):
+        """source: (filename, size, mtime), see COALESCE_REQUESTS"""
         self.lock.acquire()
         try:
             self._initCounter(host, destNode, self.config.MAX_COPY_SERVER)
             self._initActiveTransfer(destNode)
-            r = self._startCopy(host, destNode, file)
+            r = 0
+            if not host in self.queues and not source in self.originCopies:
+                r = self._startCopy(host, destNode, file, user)
+                if r:
+                    self._startOrigin(host, source, r)
+                    self._trackSource(source, r)
         finally:
             self.lock.release()
         return r
 
     def endCopy(self, host, destNode, token):
-        debug("endCopy: %s %s %d" % (host, destNode, token))
+        debug("endCopy: %s %s %f" % (host, destNode, token))
         self.lock.acquire()
         try:
-            self.counters[host][0] += 1
-            try:
-                self.counters[host][1].remove(token)
-            except ValueError: pass
+            # an expired token has already been released by _cleanup
+            self._release(self.counters[host], token)
             debug(str(self.counters[host]))
             try:
                 transfers = self.activeTransfers[destNode]
@@ -165,16 +541,123 @@ class CopyCounter:
                 if not transfers:
                     del self.activeTransfers[destNode]
             except KeyError: pass
+            self._grant(host)
+        finally:
+            self.lock.release()
+
+    def enqueue(self, destNode, file, fileserver, location = None, user = None, priority = 0, cost = 0,
+                source = None):
+        """return a CopyWaiter waiting for a slot of the file server or of
+        the node holding location (fileserver None: the node only).
+        if source is copied from a file server, the waiter is a follower
+        of this copy. a waiter for the node only follows all copies of
+        source. the waiter may be granted immediately"""
+        sources = []
+        if fileserver is not None:
+            sources.append((fileserver, self.config.MAX_COPY_SERVER))
+        if location is not None and location.host != fileserver:
+            sources.append((location.host, self.config.MAX_COPY_NODE))
+        waiter = CopyWaiter(destNode, file, sources, location, user, priority, cost, source)
+        self.lock.acquire()
+        try:
+            if source in self.originCopies:
+                self._follow(waiter, self.originCopies[source][1])
+                return waiter
+            if fileserver is None and source in self.sourceCopies:
+                self._follow(waiter, self.fileWaiters.setdefault(source, []))
+                return waiter
+            self._initActiveTransfer(destNode)
+            for host, maxCopy in sources:
+                self._initCounter(host, destNode, maxCopy)
+                self.queues.setdefault(host, SlotQueue()).append(waiter)
+            for host, maxCopy in sources:
+                self._grant(host)
         finally:
             self.lock.release()
+        return waiter
+
+    def cancel(self, waiter):
+        """remove the waiter from the queues. returns True if a slot has
+        been granted"""
+        self.lock.acquire()
+        try:
+            if not waiter.granted:
+                self._dequeue(waiter)
+            r = waiter.granted
+        finally:
+            self.lock.release()
+        return r
+
+    def queueDepth(self):
+        """return a dict host -> number of waiting requests"""
+        self.lock.acquire()
+        try:
+            r = dict([ (host, len(queue)) for host, queue in self.queues.items() ])
+        finally:
+            self.lock.release()
+        return r
+
+    def _follow(self, waiter, followers):
+        waiter.follower = True
+        waiter.followed = followers
+        followers.append(waiter)
+
+    def _dequeue(self, waiter):
+        if waiter.follower:
+            try:
+                waiter.followed.remove(waiter)
+            except ValueError: pass
+            if not self.fileWaiters.get(waiter.source, True):
+                del self.fileWaiters[waiter.source]
+            return
+        for host, maxCopy in waiter.sources:
+            queue = self.queues.get(host)
+            if queue is None:
+                continue
+            try:
+                queue.remove(waiter)
+            except ValueError: pass
+            if not queue:
+                del self.queues[host]
+
+    def _grant(self, host):
+        """assign the free slots of host to the waiting requests"""
+        queue = self.queues.get(host)
+        if not queue:
+            return
+        item = self.counters[host]
+        self._cleanup(item)
+        while host in self.queues and item[0] > 0:
+            waiter = self.queues[host].pop(lambda user: self._belowUserLimit(item, user))
+            if waiter is None:
+                break
+            # queued in the other hosts
+            self._dequeue(waiter)
+            isOrigin = waiter.location is None or host != waiter.location.host
+            if isOrigin and waiter.source in self.originCopies:
+                # copied by another request in the meantime
+                self._follow(waiter, self.originCopies[waiter.source][1])
+                continue
+            waiter.host = host
+            self._initActiveTransfer(waiter.destNode)
+            waiter.token = self._startCopy(host, waiter.destNode, waiter.file, waiter.user)
+            if waiter.token and isOrigin:
+                self._startOrigin(host, waiter.source, waiter.token)
+            self._trackSource(waiter.source, waiter.token)
+            waiter.granted = True
+            waiter.notify()
 
     def updateToken(self, host, destNode, token):
         debug("updateToken: %s %s %s" % (host, destNode, str(token)))
         self.lock.acquire()
-        newToken = int(time.time())
+        newToken = self._newToken()
         try:
-            self.counters[host][1].remove(token)
-            self.counters[host][1].append(newToken)
+            item = self.counters[host]
+            item[1][newToken] = item[1].pop(token)
+            if token in self.originTokens:
+                source = self.originTokens.pop(token)
+                self.originTokens[newToken] = source
+                self.originCopies[source][0] = newToken
             transfers = self.activeTransfers[destNode]
             for f in transfers:
                 if transfers[f] == token:
@@ -193,30 +676,83 @@ class CopyCounter:
 
     def _initCounter(self, host, destNode, maxCopy):
         if not host in self.counters:
-            self.counters[host] = [maxCopy, [] ]
+            self.counters[host] = [maxCopy, {}, {} ]
 
 
 
 class Location:
+    """location of a copy of a file.
+
+    size and mtime are stored as integers, host names are interned. if
+    the path ends with the filename of the record (compact()), only the
+    prefix (e.g. /var/tmp/<user>) is stored, which is shared by all
+    copies of a host, and the filename string of the record is referenced.
+    """
+
+    __slots__ = ("prefix", "filename", "size", "mtime", "host")
+
     def __init__(self, path, size, mtime, host):
-        self.path = path
-        self.size = size
-        self.mtime = mtime
-        self.host = host
+        self.prefix = path
+        self.filename = None
+        self.size = int(size)
+        self.mtime = int(float(mtime))
+        self.host = sys.intern(host)
+
+    @property
+    def path(self):
+        if self.filename is None:
+            return self.prefix
+        return self.prefix + self.filename
+
+    @path.setter
+    def path(self, path):
+        self.prefix = path
+        self.filename = None
+
+    def compact(self, filename):
+        if self.filename is None and len(self.prefix) > len(filename) and \
+           self.prefix.endswith(filename):
+            self.prefix = sys.intern(self.prefix[:-len(filename)])
+            self.filename = filename
+
+    def __getstate__(self):
+        return (self.prefix, self.filename, self.size, self.mtime, self.host)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # database written by a previous version
+            self.__init__(state["path"], state["size"], state["mtime"], state["host"])
+        else:
+            self.prefix, self.filename, self.size, self.mtime, self.host = state
 
     def __eq__(self, other):
         if other == None: return False
-        return self.path == other.path and self.size == other.size and \
-               self.mtime == other.mtime and self.host == other.host
+        return self.host == other.host and self.size == other.size and \
+               self.mtime == other.mtime and self.path == other.path
 
     def __str__(self):
         return str([self.path, self.size, self.mtime, self.host])
 
 
 class FileDatabaseRecord:
-    def __init__(self, loc, atime = int(time.time())):
-        self.loc = loc
+    """locations of a file. the locations are stored in a tuple, which is
+    replaced on modification, such that it can be iterated without lock"""
+
+    __slots__ = ("loc", "atime", "filename")
+
+    def __init__(self, loc, atime = int(time.time()), filename = None):
+        self.loc = tuple(loc)
         self.atime = atime
+        self.filename = filename
+
+    def __getstate__(self):
+        return (self.loc, self.atime, self.filename)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # database written by a previous version
+            state = (tuple(state["loc"]), state["atime"], None)
+        self.loc, self.atime, self.filename = state
 
     def __len__(self):
         return len(self.loc)
@@ -227,32 +763,533 @@ class FileDatabaseRecord:
     def __getitem__(self, key):
         return self.loc[key]
 
-    def __setitem__(self, key, value):
-        self.loc[key] = value
-
     def __contains__(self, item):
         return self.loc.__contains__(item)
 
     def append(self, item):
-        self.loc.append(item)
+        if self.filename is not None:
+            item.compact(self.filename)
+        self.loc = self.loc + (item,)
 
     def remove(self, item):
-        self.loc.remove(item)
+        loc = list(self.loc)
+        loc.remove(item)
+        self.loc = tuple(loc)
 
     def access(self):
         self.atime = int(time.time())
 
-class FileDatabase:
+class DatabaseLog:
+    """append-only log of the changes of the file database since the last
+    database write.
+
+    changes are buffered and written in batches (group commit) by the
+    DatabaseLogWriter. each write of the database starts a new log file
+    (DB_FILE.log.<generation>), older log files are removed once the
+    database is written. on startup, the database file is loaded and the
+    remaining log files are replayed. replaying a log twice is harmless,
+    the last change of a location wins.
+    access times are not logged, they are restored from the database file.
+    """
+
+    def __init__(self, dbFile):
+        self.prefix = dbFile + ".log."
+        self.lock = threading.Lock()
+        self.writeLock = threading.Lock()
+        self.pending = []
+        self.rotated = []
+        self.size = 0
+        self.generation = max(self.generations() + [ 0 ]) + 1
+        self.file = open(self.prefix + str(self.generation), 'ab')
+
+    def generations(self):
+        """generations of the existing log files, sorted"""
+        r = []
+        for f in glob.glob(glob.escape(self.prefix) + "*"):
+            try:
+                r.append(int(f[len(self.prefix):]))
+            except ValueError: pass
+        return sorted(r)
+
+    def append(self, entry):
+        with self.lock:
+            self.pending.append(entry)
+
+    def _write(self, sync = True):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return
+        cpickle.dump(batch, self.file, cpickle.HIGHEST_PROTOCOL)
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+        self.size = self.file.tell()
+
+    def commit(self):
+        """write all buffered changes to disk"""
+        with self.writeLock:
+            self._write()
+
+    def rotate(self):
+        """write the buffered changes and start a new log file.
+        returns the generation of the finished log file, which has
+        to be synced using syncRotated()"""
+        with self.writeLock:
+            self._write(False)
+            self.rotated.append(self.file)
+            self.generation += 1
+            self.file = open(self.prefix + str(self.generation), 'ab')
+            self.size = 0
+            return self.generation - 1
+
+    def syncRotated(self):
+        with self.writeLock:
+            rotated, self.rotated = self.rotated, []
+        for f in rotated:
+            os.fsync(f.fileno())
+            f.close()
+
+    def remove(self, generation):
+        """remove the log files up to the given generation"""
+        for g in self.generations():
+            if g <= generation:
+                os.remove(self.prefix + str(g))
+
+    def read(self, generation):
+        """iterate over the changes in a log file. stops at a partially
+        written batch"""
+        f = open(self.prefix + str(generation), 'rb')
+        try:
+            while True:
+                try:
+                    batch = cpickle.load(f)
+                except EOFError:
+                    break
+                except Exception as e:
+                    warning("truncated database log %s%d: %s" % (self.prefix, generation, str(e)))
+                    break
+                for entry in batch:
+                    yield entry
+        finally:
+            f.close()
+
+    def close(self):
+        self.syncRotated()
+        with self.writeLock:
+            self._write()
+            self.file.close()
+
+
+class DatabaseLogWriter (threading.Thread):
+    """commit the database log periodically. triggers a database write
+    (compaction) if the log becomes too large"""
+
+    def __init__(self, dblog, interval, maxSize, compact):
+        threading.Thread.__init__(self)
+        self.dblog = dblog
+        self.interval = interval
+        self.maxSize = maxSize
+        self.compact = compact
+        self.finished = threading.Event()
+
+    def run(self):
+        while not self.finished.is_set():
+            self.finished.wait(self.interval)
+            try:
+                self.dblog.commit()
+            except Exception as e:
+                error("error writing database log: %s" % str(e))
+            if self.dblog.size > self.maxSize:
+                self.compact()
+
+    def stop(self):
+        self.finished.set()
+
+
+class PathIndexNode:
+    __slots__ = ("dirs", "files")
+
+    def __init__(self):
+        # name -> PathIndexNode
+        self.dirs = {}
+        # filenames in this directory
+        self.files = set()
+
+
+class PathIndex:
+    """prefix index of filenames: a tree of the directories, each with
+    the set of (complete) filenames it contains.
+    the index has its own lock, which may be acquired while holding the
+    lock of a database shard, but not the other way round.
+    """
 
     def __init__(self):
+        self.lock = threading.Lock()
+        self.root = PathIndexNode()
+
+    def clear(self):
+        with self.lock:
+            self.root = PathIndexNode()
+
+    def add(self, filename):
+        with self.lock:
+            node = self.root
+            for name in filename.split("/")[:-1]:
+                child = node.dirs.get(name)
+                if child is None:
+                    child = node.dirs[name] = PathIndexNode()
+                node = child
+            node.files.add(filename)
+
+    def remove(self, filename):
+        with self.lock:
+            path = [ self.root ]
+            names = filename.split("/")[:-1]
+            for name in names:
+                node = path[-1].dirs.get(name)
+                if node is None:
+                    return
+                path.append(node)
+            path[-1].files.discard(filename)
+            # remove empty directories
+            for i in range(len(names), 0, -1):
+                if path[i].files or path[i].dirs:
+                    break
+                del path[i-1].dirs[names[i-1]]
+
+    def _collect(self, node, r):
+        r.extend(node.files)
+        for child in node.dirs.values():
+            self._collect(child, r)
+
+    def find(self, prefix):
+        """return all filenames starting with prefix"""
+        r = []
+        head, sep, tail = prefix.rpartition("/")
+        with self.lock:
+            node = self.root
+            for name in head.split("/") if sep else []:
+                node = node.dirs.get(name)
+                if node is None:
+                    return r
+            for f in node.files:
+                if f.startswith(prefix):
+                    r.append(f)
+            for name, child in node.dirs.items():
+                if name.startswith(tail):
+                    self._collect(child, r)
+        return r
+
+
+class FileDatabaseShard:
+    """part of the file database with its own lock.
+
+    records are modified using add, remove, delete and access, which
+    maintain an index of the files and the used space per host, the
+    expiry index (the filenames in buckets of EXPIRY_BUCKET seconds of
+    access time), and the path index, which is shared by all shards.
+    the caller has to hold the lock.
+    """
+
+    EXPIRY_BUCKET = 60 * 60
+
+    def __init__(self, paths):
         self.lock = threading.Lock()
         self.files = {}
+        self.paths = paths
+        # host -> set of filenames with a location on the host
+        self.hosts = {}
+        # host -> [number of locations, bytes]
+        self.usage = {}
+        # atime // EXPIRY_BUCKET -> set of filenames
+        self.expiry = {}
+        # files read from the database file while loading (see FileDatabase.load)
+        self.faulted = set()
+
+    def _schedule(self, record):
+        self.expiry.setdefault(record.atime // self.EXPIRY_BUCKET, set()).add(record.filename)
+
+    def _unschedule(self, record):
+        bucket = record.atime // self.EXPIRY_BUCKET
+        files = self.expiry.get(bucket, set())
+        files.discard(record.filename)
+        if not files:
+            self.expiry.pop(bucket, None)
+
+    def access(self, record):
+        bucket = record.atime // self.EXPIRY_BUCKET
+        record.access()
+        if record.atime // self.EXPIRY_BUCKET != bucket:
+            self.expiry[bucket].discard(record.filename)
+            if not self.expiry[bucket]:
+                del self.expiry[bucket]
+            self._schedule(record)
+
+    def expired(self, minATime, limit):
+        """return up to limit filenames accessed before minATime"""
+        r = []
+        for bucket in sorted(self.expiry):
+            if bucket > minATime // self.EXPIRY_BUCKET:
+                break
+            for f in self.expiry[bucket]:
+                if self.files[f].atime < minATime:
+                    r.append(f)
+                    if len(r) == limit:
+                        return r
+        return r
+
+    def _index(self, record, location):
+        self.hosts.setdefault(location.host, set()).add(record.filename)
+        usage = self.usage.setdefault(location.host, [ 0, 0 ])
+        usage[0] += 1
+        usage[1] += location.size
+
+    def _unindex(self, filename, location, remaining):
+        usage = self.usage[location.host]
+        usage[0] -= 1
+        usage[1] -= location.size
+        if usage[0] == 0:
+            del self.usage[location.host]
+        for l in remaining:
+            if l.host == location.host:
+                return
+        files = self.hosts.get(location.host, set())
+        files.discard(filename)
+        if not files:
+            self.hosts.pop(location.host, None)
+
+    def _indexRecord(self, record):
+        self.paths.add(record.filename)
+        self._schedule(record)
+        for location in record:
+            self._index(record, location)
+
+    def reindex(self):
+        self.hosts = {}
+        self.usage = {}
+        self.expiry = {}
+        for record in self.files.values():
+            self._indexRecord(record)
+
+    def insert(self, record):
+        """add a record read from the database file"""
+        self.files[record.filename] = record
+        self._indexRecord(record)
+
+    def add(self, filename, location, atime):
+        """add a location. returns (record, True if the location is new)"""
+        record = self.files.get(filename)
+        if record is None:
+            record = self.files[filename] = FileDatabaseRecord([], atime, filename)
+            self._schedule(record)
+            self.paths.add(filename)
+        if location in record:
+            return record, False
+        record.append(location)
+        self._index(record, location)
+        return record, True
+
+    def remove(self, filename, location):
+        """remove a location. returns True if the location was known"""
+        record = self.files.get(filename)
+        if record is None or not location in record:
+            return False
+        record.remove(location)
+        if len(record) == 0:
+            del self.files[filename]
+            self._unschedule(record)
+            self.paths.remove(filename)
+        self._unindex(record.filename, location, record)
+        return True
+
+    def delete(self, filename):
+        """remove the record of a file"""
+        record = self.files.pop(filename, None)
+        if record is not None:
+            self._unschedule(record)
+            self.paths.remove(filename)
+            for location in record:
+                self._unindex(record.filename, location, ())
+        return record
+
+
+class DatabaseStore:
+    """database file in SQLite format, which can be opened without reading
+    all records.
+
+    the table files contains the filename and the marshalled record
+    (atime, ((prefix, compact, size, mtime, host), ...)). compact is True
+    if the path of the location is prefix + filename.
+    """
+
+    MAGIC = b"SQLite format 3\0"
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+
+    @staticmethod
+    def isStore(filename):
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return False
+        try:
+            return f.read(len(DatabaseStore.MAGIC)) == DatabaseStore.MAGIC
+        finally:
+            f.close()
+
+    @staticmethod
+    def encode(record):
+        return marshal.dumps((record.atime, tuple([ (l.prefix, l.filename is not None, l.size, l.mtime, l.host)
+                                                    for l in record ])))
+
+    @staticmethod
+    def decode(filename, data):
+        atime, locations = marshal.loads(data)
+        loc = []
+        for prefix, compact, size, mtime, host in locations:
+            l = Location.__new__(Location)
+            if compact:
+                l.__setstate__((sys.intern(prefix), filename, size, mtime, sys.intern(host)))
+            else:
+                l.__setstate__((prefix, None, size, mtime, sys.intern(host)))
+            loc.append(l)
+        return FileDatabaseRecord(loc, atime, filename)
+
+    @staticmethod
+    def create(filename, records):
+        """write the records [(filename, record)] to a new database file"""
+        if os.path.exists(filename):
+            os.remove(filename)
+        db = sqlite3.connect(filename, isolation_level = None)
+        try:
+            # the file is synced and renamed by the caller
+            db.execute("PRAGMA journal_mode = OFF")
+            db.execute("PRAGMA synchronous = OFF")
+            db.execute("CREATE TABLE files (filename TEXT PRIMARY KEY, record BLOB) WITHOUT ROWID")
+            db.execute("BEGIN")
+            db.executemany("INSERT INTO files VALUES (?, ?)",
+                           ((f, DatabaseStore.encode(r)) for f, r in records))
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def get(self, filename):
+        with self.lock:
+            if self.db is None:
+                return None
+            row = self.db.execute("SELECT record FROM files WHERE filename = ?", (filename,)).fetchone()
+        if row is None:
+            return None
+        return self.decode(filename, row[0])
+
+    def records(self, batchSize = 10000):
+        """iterate over lists of at most batchSize records"""
+        last = ""
+        while True:
+            with self.lock:
+                rows = self.db.execute("SELECT filename, record FROM files WHERE filename > ? "
+                                       "ORDER BY filename LIMIT ?", (last, batchSize)).fetchall()
+            if not rows:
+                break
+            yield [ self.decode(f, data) for f, data in rows ]
+            last = rows[-1][0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+            self.db = None
+
+
+class DatabaseLoader (threading.Thread):
+    """read the records of a database file in the background"""
+
+    def __init__(self, db, store):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.db = db
+        self.store = store
+
+    def run(self):
+        self.db.loadStore(self.store)
+
+
+class FileDatabase:
+    """locations of the cached files.
+
+    the records are distributed to independently locked shards by the
+    hash of the filename. operations on the whole database (statistics,
+    cleanup) lock one shard at a time.
+
+    write() saves a consistent snapshot of the database (DatabaseStore).
+    with forkWriter, the snapshot is written by a forked process, which
+    holds the locks only for the duration of fork(). otherwise the records
+    of each shard are copied while holding the lock of the shard.
+
+    the database file can be loaded in the background. until all records
+    are loaded, a file is read from the database file when it is accessed
+    for the first time (fault). operations on all files wait for the
+    loading to finish.
+    """
+
+    def __init__(self, forkWriter = False, nShards = 16):
+        self.paths = PathIndex()
+        self.shards = [ FileDatabaseShard(self.paths) for i in range(max(1, nShards)) ]
         self.changed = False
+        self.dblog = None
+        self.forkWriter = forkWriter and hasattr(os, "fork")
+        self.writeLock = threading.Lock()
+        self.store = None
+        self.loaded = threading.Event()
+        self.loaded.set()
+
+    def _shard(self, filename):
+        return self.shards[hash(filename) % len(self.shards)]
+
+    def lockAll(self, blocking = True):
+        """acquire the locks of all shards. returns False if not blocking
+        and a lock is held"""
+        for i, shard in enumerate(self.shards):
+            if not shard.lock.acquire(blocking):
+                self.unlockAll(i)
+                return False
+        return True
+
+    def unlockAll(self, nShards = None):
+        for shard in self.shards[:nShards]:
+            shard.lock.release()
+
+    def _fault(self, shard, filename):
+        """while loading: read the record of the file from the database file,
+        if it has not been loaded yet. the caller holds the lock of the shard"""
+        if self.store is None or filename in shard.faulted:
+            return
+        shard.faulted.add(filename)
+        if not filename in shard.files:
+            record = self.store.get(filename)
+            if record is not None:
+                shard.insert(record)
+
+    def isLoading(self):
+        return self.store is not None
+
+    def fault(self, filenames):
+        """while loading: read the records of the files from the database
+        file, such that later accesses do not block"""
+        for filename in filenames:
+            shard = self._shard(filename)
+            shard.lock.acquire()
+            self._fault(shard, filename)
+            shard.lock.release()
 
     def hasFile(self, filename):
-        self.lock.acquire()
-        r = (filename in self.files)
-        self.lock.release()
+        shard = self._shard(filename)
+        shard.lock.acquire()
+        self._fault(shard, filename)
+        r = (filename in shard.files)
+        shard.lock.release()
         return r
 
     def hasChanged(self):
@@ -260,14 +1297,16 @@ class FileDatabase:
 
     def getLocation(self, filename, preferedHost = "", counter = None):
         r = None
-        self.lock.acquire()
-        if not filename in self.files:
-            self.lock.release()
+        shard = self._shard(filename)
+        shard.lock.acquire()
+        self._fault(shard, filename)
+        if not filename in shard.files:
+            shard.lock.release()
             return None
-        record = self.files[filename]
+        record = shard.files[filename]
         nFiles = len(record)
         if nFiles == 0:
-            self.lock.release()
+            shard.lock.release()
             return None
         if preferedHost != "":
             for l in record:
@@ -280,62 +1319,180 @@ class FileDatabase:
                     r = locList[random.randint(0, len(locList)-1)]
         if r == None:
             r = record[random.randint(0, nFiles-1)]
-        record.access()
-        self.lock.release()
+        shard.access(record)
+        shard.lock.release()
         return r
 
     def getAllLocations(self, filename):
         r = []
-        self.lock.acquire()
-        if (not filename in self.files) or (len(self.files[filename]) == 0):
-            self.lock.release()
+        shard = self._shard(filename)
+        shard.lock.acquire()
+        self._fault(shard, filename)
+        if (not filename in shard.files) or (len(shard.files[filename]) == 0):
+            shard.lock.release()
             return r
-        r = self.files[filename]
-        self.files[filename].access()
-        self.lock.release()
+        r = shard.files[filename]
+        shard.access(shard.files[filename])
+        shard.lock.release()
         return r
 
     def addLocation(self, filename, location):
         debug("addLocation: %s %s" % (filename, str(location)))
-        self.lock.acquire()
-        if not filename in self.files:
-            self.files[filename] = FileDatabaseRecord([], int(time.time()))
-        if not location in self.files[filename]:
-            self.files[filename].append(location)
+        shard = self._shard(filename)
+        shard.lock.acquire()
+        self._fault(shard, filename)
+        record, added = shard.add(filename, location, int(time.time()))
+        if added:
             self.changed = True
-        self.files[filename].access()
-        self.lock.release()
+            if self.dblog:
+                self.dblog.append(("add", filename, location.path, location.size,
+                                   location.mtime, location.host))
+        shard.access(record)
+        shard.lock.release()
 
     def removeLocation(self, filename, location):
         debug("removeLocation: %s %s" % (filename, str(location)))
-        self.lock.acquire()
-        if filename in self.files:
-            try:
-                self.files[filename].remove(location)
-            except ValueError: pass
-            if len(self.files[filename]) == 0:
-                del self.files[filename]
+        shard = self._shard(filename)
+        shard.lock.acquire()
+        self._fault(shard, filename)
+        if shard.remove(filename, location):
             self.changed = True
-        self.lock.release()
+            if self.dblog:
+                self.dblog.append(("remove", filename, location.path, location.size,
+                                   location.mtime, location.host))
+        shard.lock.release()
+
+    def hostLocations(self, host):
+        """return (filename, location) of all copies on the given host"""
+        self.loaded.wait()
+        r = []
+        for shard in self.shards:
+            shard.lock.acquire()
+            for f in shard.hosts.get(host, ()):
+                r += [ (f, l) for l in shard.files[f] if l.host == host ]
+            shard.lock.release()
+        return r
+
+    def removeHost(self, host):
+        """remove all locations on the given host.
+        returns the number of removed locations"""
+        removed = 0
+        for f, location in self.hostLocations(host):
+            shard = self._shard(f)
+            shard.lock.acquire()
+            if shard.remove(f, location):
+                removed += 1
+                if self.dblog:
+                    self.dblog.append(("remove", f, location.path, location.size,
+                                       location.mtime, location.host))
+            shard.lock.release()
+        if removed:
+            self.changed = True
+        log("removed %d locations on %s" % (removed, host))
+        return removed
+
+    def hostUsage(self):
+        """return a dict host -> (number of locations, bytes)"""
+        self.loaded.wait()
+        usage = {}
+        for shard in self.shards:
+            shard.lock.acquire()
+            for host, u in shard.usage.items():
+                total = usage.get(host, (0, 0))
+                usage[host] = (total[0] + u[0], total[1] + u[1])
+            shard.lock.release()
+        return usage
+
+    def records(self):
+        """iterate over (filename, record) of all files, shard by shard"""
+        self.loaded.wait()
+        for shard in self.shards:
+            shard.lock.acquire()
+            items = list(shard.files.items())
+            shard.lock.release()
+            for item in items:
+                yield item
+
+    def _dump(self, records, filename):
+        DatabaseStore.create(filename, records)
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _forkDump(self, filename):
+        """write the database in a child process.
+        returns the pid of the child, None if fork failed.
+        the child must not acquire any lock, it may be held by another thread
+        """
+        try:
+            pid = os.fork()
+        except OSError as e:
+            warning("cannot fork database writer: %s" % str(e))
+            return None
+        if pid == 0:
+            status = 1
+            try:
+                self._dump((item for shard in self.shards for item in shard.files.items()),
+                           filename)
+                status = 0
+            finally:
+                os._exit(status)
+        return pid
+
+    def __len__(self):
+        return sum([ len(shard.files) for shard in self.shards ])
 
     def write(self, filename):
-        self.lock.acquire()
+        with self.writeLock:
+            return self._write(filename)
+
+    def _write(self, filename):
         if not self.changed:
-            self.lock.release()
             return True
-        # pickle a copy of the actual data such
-        # that the lock is released early
-        dbcopy = copy.copy(self.files)
-        self.lock.release()
-        f = gzip.open(filename, 'wb')
-        if not f:
+        if self.store is not None:
+            # the database file is still read. the changes are kept in the log
+            debug("database is loading, not written")
             return False
+        start = time.time()
+        tmpname = filename + ".tmp"
+        self.changed = False
+        generation = None
+        if self.dblog:
+            generation = self.dblog.rotate()
+        pid = None
+        if self.forkWriter:
+            self.lockAll()
+            pid = self._forkDump(tmpname)
+            self.unlockAll()
+            debug("database snapshot: locks held for %0.1fms" % ((time.time() - start) * 1000))
+        if pid is None:
+            # copy the records such that the locks are released early.
+            # the tuples of locations are not modified and can be shared.
+            # changes after the log rotation are replayed again on recovery
+            dbcopy = {}
+            for shard in self.shards:
+                shard.lock.acquire()
+                for f, r in shard.files.items():
+                    dbcopy[f] = FileDatabaseRecord(r.loc, r.atime, f)
+                shard.lock.release()
+        nFiles = len(self)
         try:
-            cpickle.dump(dbcopy, f)
-            debug("wrote database. %d files" % len(dbcopy))
-            self.changed = False
-        except Exception:
+            if self.dblog:
+                self.dblog.syncRotated()
+            if pid is None:
+                self._dump(dbcopy.items(), tmpname)
+            elif os.waitpid(pid, 0)[1] != 0:
+                raise IOError("database writer process failed")
+            os.rename(tmpname, filename)
+            debug("wrote database. %d files" % nFiles)
+        except Exception as e:
+            error("cannot write database to %s: %s" % (filename, str(e)))
+            self.changed = True
             return False
+        if generation is not None:
+            self.dblog.remove(generation)
         return True
 
     def loadPlain(self, filename):
@@ -346,7 +1503,29 @@ class FileDatabase:
         fd = gzip.open(filename, 'rb')
         return cpickle.load(fd)
 
-    def load(self, filename):
+    def load(self, filename, background = False):
+        """load the database file. a legacy pickle file is read completely,
+        it is converted when the database is written. a DatabaseStore is
+        read in the background if requested"""
+        if DatabaseStore.isStore(filename):
+            try:
+                store = DatabaseStore(filename)
+            except sqlite3.Error as e:
+                warning("cannot open database file %s: %s" % (filename, str(e)))
+                return False
+            self.lockAll()
+            for shard in self.shards:
+                shard.files = {}
+                shard.reindex()
+            self.paths.clear()
+            self.store = store
+            self.loaded.clear()
+            self.unlockAll()
+            if background:
+                DatabaseLoader(self, store).start()
+            else:
+                self.loadStore(store)
+            return True
         db = None
         try:
             try:
@@ -358,127 +1537,396 @@ class FileDatabase:
             warning("cannot open database file %s: %s" % (filename, str(e)))
         if not db:
             return False
-        self.lock.acquire()
-        self.files = db
+        self.lockAll()
         converted = False
-        for f in self.files.keys():
-            if type(self.files[f]) == list:
-                self.files[f] = FileDatabaseRecord(self.files[f])
+        for shard in self.shards:
+            shard.files = {}
+        for f, record in db.items():
+            if type(record) == list:
+                record = FileDatabaseRecord(record)
                 converted = True
+            if record.filename is None:
+                for loc in record:
+                    loc.compact(f)
+            record.filename = f
+            self._shard(f).files[f] = record
+        self.paths.clear()
+        for shard in self.shards:
+            shard.reindex()
         if converted:
             log("converted database")
-        debug("%d files" % len(self.files))
-        self.lock.release()
+        # write in the current format
+        self.changed = True
+        debug("%d files" % len(db))
+        self.unlockAll()
         return True
 
+    def loadStore(self, store):
+        """insert the records of the store, except the records already read
+        by _fault(). the locks of the shards are released between batches"""
+        start = time.time()
+        n = 0
+        try:
+            for batch in store.records():
+                byShard = {}
+                for record in batch:
+                    byShard.setdefault(self._shard(record.filename), []).append(record)
+                for shard, records in byShard.items():
+                    shard.lock.acquire()
+                    for record in records:
+                        if not record.filename in shard.faulted and not record.filename in shard.files:
+                            shard.insert(record)
+                    shard.lock.release()
+                n += len(batch)
+        except sqlite3.Error as e:
+            # keep reading single records from the store. the database
+            # is not written, it would lack the remaining records
+            error("cannot read database file: %s" % str(e))
+            self.loaded.set()
+            return
+        self.lockAll()
+        self.store = None
+        for shard in self.shards:
+            shard.faulted = set()
+        self.unlockAll()
+        store.close()
+        log("loaded %d files in %0.2fs" % (n, time.time() - start))
+        self.loaded.set()
+
+    def replay(self, dblog):
+        """apply the changes recorded in the existing log files.
+        subsequent changes are recorded in dblog"""
+        start = time.time()
+        n = 0
+        self.lockAll()
+        for generation in dblog.generations():
+            if generation >= dblog.generation:
+                break
+            for entry in dblog.read(generation):
+                n += 1
+                shard = self._shard(entry[1])
+                self._fault(shard, entry[1])
+                if entry[0] == "delete":
+                    shard.delete(entry[1])
+                elif entry[0] == "add":
+                    shard.add(entry[1], Location(*entry[2:]), int(start))
+                else:
+                    shard.remove(entry[1], Location(*entry[2:]))
+        if n:
+            self.changed = True
+        self.dblog = dblog
+        self.unlockAll()
+        log("replayed %d database changes in %0.2fs" % (n, time.time() - start))
+
     def getStat(self):
-        self.lock.acquire()
-        numFiles = len(self.files)
+        self.loaded.wait()
+        numFiles = 0
         numLoc = 0
-        if numFiles:
-            # numLoc = reduce(lambda x,y: x+y, [ len(i) for i in self.files.values() ])
-            for i in self.files.values():
+        for shard in self.shards:
+            shard.lock.acquire()
+            numFiles += len(shard.files)
+            for i in shard.files.values():
                 numLoc += len(i)
-        self.lock.release()
+            shard.lock.release()
         return (numFiles, numLoc)
 
-    def removeOldRecords(self, minATime):
+    def findPrefix(self, prefix):
+        """return (filename, number of locations) of all files starting with prefix"""
+        self.loaded.wait()
+        r = []
+        for f in self.paths.find(prefix):
+            shard = self._shard(f)
+            shard.lock.acquire()
+            record = shard.files.get(f)
+            if record is not None:
+                r.append((f, len(record)))
+            shard.lock.release()
+        return r
+
+    def removePrefix(self, prefix):
+        """remove the records of all files starting with prefix.
+        returns the number of removed records"""
+        self.loaded.wait()
         removed = 0
-        self.lock.acquire()
-        for f in self.files.keys():
-            if self.files[f].atime < minATime:
-                del self.files[f]
+        for f in self.paths.find(prefix):
+            shard = self._shard(f)
+            shard.lock.acquire()
+            if shard.delete(f) is not None:
                 removed += 1
+                if self.dblog:
+                    self.dblog.append(("delete", f))
+            shard.lock.release()
+        if removed:
+            self.changed = True
+        log("removed %d records below %s" % (removed, prefix))
+        return removed
+
+    def removeRecords(self, remove):
+        """remove the records for which remove(filename, record) is true.
+        returns the number of removed records"""
+        self.loaded.wait()
+        removed = 0
+        for shard in self.shards:
+            shard.lock.acquire()
+            for f in [ f for f, r in shard.files.items() if remove(f, r) ]:
+                shard.delete(f)
+                removed += 1
+                if self.dblog:
+                    self.dblog.append(("delete", f))
+            shard.lock.release()
+        if removed:
+            self.changed = True
+        return removed
+
+    def removeOldRecords(self, minATime, batchSize = 1000):
+        """remove the records accessed before minATime. the records are
+        found using the expiry index and removed in batches, the lock of
+        the shard is released between the batches"""
+        self.loaded.wait()
+        removed = 0
+        for shard in self.shards:
+            while True:
+                shard.lock.acquire()
+                expired = shard.expired(minATime, batchSize)
+                for f in expired:
+                    shard.delete(f)
+                    if self.dblog:
+                        self.dblog.append(("delete", f))
+                shard.lock.release()
+                removed += len(expired)
+                if len(expired) < batchSize:
+                    break
         if removed:
             self.changed = True
-        self.lock.release()
         log("removed %d records" % removed)
 
 
 class DatabaseWriter (threading.Thread):
+    """write the database periodically or on request (compact). with a
+    database log, a write compacts the log"""
 
     def __init__(self, db, dbFile, saveInterval):
         self.db = db
         self.dbFile = dbFile
         self.saveInterval = saveInterval
-        self.finished = threading.Event()
+        self.finished = False
+        self.wakeup = threading.Event()
         threading.Thread.__init__(self)
 
     def run(self):
-        while not self.finished.is_set():
+        while not self.finished:
             try:
                 self.db.write(self.dbFile)
             except Exception as e:
                 log("error writing database to %s: %s" % (self.dbFile, str(e)))
-            self.finished.wait(self.saveInterval)
+            self.wakeup.wait(self.saveInterval)
+            self.wakeup.clear()
+
+    def compact(self):
+        self.wakeup.set()
 
     def stop(self):
-        self.finished.set()
+        self.finished = True
+        self.wakeup.set()
 
 
-class ClientThread (threading.Thread):
+class Receive:
+    """operation yielded by the ClientHandler coroutines to receive the next
+    message from the client. the driver sends the message (or None) back."""
+    pass
 
-    def __init__(self, config, connection, clientAddress, db, copycount, stat):
-        threading.Thread.__init__(self)
+
+class WaitForSlot:
+    """operation yielded by the ClientHandler coroutines to wait until the
+    CopyWaiter is granted a copy slot or the timeout expires"""
+
+    def __init__(self, waiter, timeout):
+        self.waiter = waiter
+        self.timeout = timeout
+
+
+class Call:
+    """operation yielded by the ClientHandler coroutines to call a function
+    which may block, e.g. a database operation waiting until the database
+    is loaded. the driver sends the return value back. the event loop
+    calls the function in a thread of its executor"""
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+
+class ClientHandler:
+    """protocol state machines of a client connection.
+
+    all handlers are generators. they yield Receive whenever they need the
+    next message from the client and Call for database operations which
+    may block, such that the same code can be driven by a thread per
+    connection (ClientThread) or by an event loop (AsyncServer).
+    while the database is loaded, the records of the files in a received
+    message are read before the message is handled.
+    messages are sent directly using the connection object.
+    """
+
+    # maximum number of parts of a reply message (multiple of 3 and 4)
+    REPLY_SIZE = 12000
+
+    def __init__(self, config, connection, clientAddress, clientName, db, copycount, stat):
         self.config = config
         self.conn = connection
         self.clientIP = clientAddress
+        self.clientName = clientName
         self.db = db
         self.copycount = copycount
         self.stat = stat
-        self.clientName = ""
+        # (node, user name) set by REQUEST_CLASS. requests without user are
+        # accounted to the node
+        self.user = clientName
+        self.priority = self.priorityClass(config.DEFAULT_PRIORITY)
+
+    def priorityClass(self, name):
+        """index of the priority class in PRIORITY_CLASSES. classes higher
+        than DEFAULT_PRIORITY require an entry in PRIORITY_HOSTS"""
+        classes = self.config.PRIORITY_CLASSES
+        if self.config.DEFAULT_PRIORITY in classes:
+            default = classes.index(self.config.DEFAULT_PRIORITY)
+        else:
+            default = len(classes) // 2
+        if not name in classes:
+            return default
+        if classes.index(name) < default and \
+                not self.clientName in self.config.PRIORITY_HOSTS.get(name, ()):
+            warning("%s may not request priority class %s" % (self.clientName, name))
+            return default
+        return classes.index(name)
+
+    def isAdmin(self):
+        """the client may change the records of other hosts (ADMIN_HOSTS)"""
+        return self.clientName in self.config.ADMIN_HOSTS
+
+    @staticmethod
+    def resolveClientName(clientAddress):
+        return socket.gethostbyaddr(clientAddress[0])[0].split(".")[0]
 
     def run(self):
         try:
             self.stat.inc("threads")
             self.stat.inc("requests")
-            debug("starting client thread for " + str(self.clientIP))
-            self.clientName = socket.gethostbyaddr(self.clientIP[0])[0].split(".")[0]
             debug("clientName = " + str(self.clientName))
             disconnect = False
             keepAlive = False
             while not disconnect:
                 disconnect = not keepAlive
-                msg = self.conn.receiveMessage()
+                msg = yield from self.receive()
                 if msg == None:
                     debug("client died")
                     disconnect = True
                 elif msg.type == Message.REQUEST_FILE:
-                    retry = self.handleFileRequest(msg)
+                    retry = yield from self.handleFileRequest(msg)
                     while retry:
                         debug("retry!")
-                        msg = self.conn.receiveMessage()
+                        msg = yield from self.receive()
                         if msg != None:
-                            retry = self.handleFileRequest(msg)
+                            retry = yield from self.handleFileRequest(msg)
                         else:
                             retry = False
                 elif msg.type == Message.GET_LOCATIONS:
-                    self.handleGetLocations(msg)
+                    yield from self.handleGetLocations(msg)
+                elif msg.type == Message.REQUEST_FILES:
+                    yield from self.handleFileBatch(msg)
+                elif msg.type == Message.GET_LOCATIONS_MANY:
+                    self.handleGetLocationsMany(msg)
+                elif msg.type == Message.INVALID_COPY:
+                    self.handleInvalidCopy(msg)
+                    disconnect = False
                 elif msg.type == Message.HAVE_FILE:
                     self.handleHaveFile(msg)
                 elif msg.type == Message.DELETED_COPY:
                     self.handleDeletedFile(msg)
                     disconnect = False
+                elif msg.type == Message.DELETED_COPIES:
+                    self.handleDeletedFiles(msg)
+                    disconnect = False
                 elif msg.type == Message.IS_ACTIVE:
                     self.handleIsActive(msg)
                     disconnect = False
+                elif msg.type == Message.HOST_FILES:
+                    yield from self.handleHostFiles(msg)
+                elif msg.type == Message.REMOVE_HOST:
+                    yield from self.handleRemoveHost(msg)
+                elif msg.type == Message.HOST_USAGE:
+                    yield from self.handleHostUsage(msg)
+                elif msg.type == Message.PREFIX_FILES:
+                    yield from self.handlePrefixFiles(msg)
+                elif msg.type == Message.REMOVE_PREFIX:
+                    yield from self.handleRemovePrefix(msg)
                 elif msg.type == Message.KEEP_ALIVE:
                     keepAlive = True
                     disconnect = False
+                elif msg.type == Message.HELLO:
+                    self.handleHello(msg)
+                    disconnect = False
+                elif msg.type == Message.REQUEST_CLASS:
+                    self.handleRequestClass(msg)
+                    disconnect = False
                 elif msg.type == Message.EXIT:
                     debug("client send exit")
                     disconnect = True
                 elif msg.type == Message.REGISTER_COPY:
-                    retry = self.handleRegisterCopy(msg)
+                    retry = yield from self.handleRegisterCopy(msg)
                     while retry:
                         debug("retry register copy")
-                        msg = self.conn.receiveMessage()
-                        retry = self.handleRegisterCopy(msg)
+                        msg = yield from self.receive()
+                        retry = yield from self.handleRegisterCopy(msg)
         finally:
-            del self.conn
             debug("connection to " + self.clientName + " closed")
             self.stat.dec("threads")
 
+    def receive(self):
+        """receive the next message from the client"""
+        msg = yield Receive
+        if msg is not None and self.db.isLoading():
+            files = self.messageFiles(msg)
+            if files:
+                yield Call(self.db.fault, files)
+        return msg
+
+    @staticmethod
+    def messageFiles(msg):
+        """names of the files in the database used by the message"""
+        c = msg.content
+        if msg.type in (Message.REQUEST_FILE, Message.GET_LOCATIONS, Message.REGISTER_COPY,
+                        Message.HAVE_FILE, Message.DELETED_COPY, Message.INVALID_COPY,
+                        Message.COPY_OK):
+            return c[:1]
+        elif msg.type == Message.REQUEST_FILES:
+            return c[2::5]
+        elif msg.type == Message.GET_LOCATIONS_MANY:
+            return c[1::3]
+        elif msg.type == Message.DELETED_COPIES:
+            return c[0::4]
+        return []
+
+    def handleHello(self, msg):
+        debug("handleHello: " + str(msg))
+        assert(msg.type == Message.HELLO)
+        try:
+            version = min(int(msg.content[0]), Message.PROTOCOL_VERSION)
+        except ValueError:
+            version = Message.PROTOCOL_V1
+        # the reply is sent using the previous protocol version
+        if not self.conn.sendMessage(Message(Message.HELLO, [ str(version) ])):
+            debug("client died")
+        self.conn.setProtocolVersion(version)
+
+    def handleRequestClass(self, msg):
+        debug("handleRequestClass: " + str(msg))
+        assert(msg.type == Message.REQUEST_CLASS)
+        # the user name is not verified. users are distinguished per node,
+        # such that the requests of a node are limited by MAX_COPY_CLIENT
+        self.user = (self.clientName, msg.content[0]) if msg.content[0] else self.clientName
+        self.priority = self.priorityClass(msg.content[1])
+
     def handleHaveFile(self, msg):
         debug("handleHaveFile: " + str(msg))
         assert(msg.type == Message.HAVE_FILE)
@@ -502,6 +1950,69 @@ class ClientThread (threading.Thread):
         loc = Location(msg.content[3], msg.content[1], msg.content[2], self.clientName)
         self.db.removeLocation(msg.content[0], loc)
 
+    def handleDeletedFiles(self, msg):
+        debug("handleDeletedFiles: %d files" % (len(msg.content) // 4))
+        assert(msg.type == Message.DELETED_COPIES)
+        c = msg.content
+        for i in range(0, len(c) - 3, 4):
+            self.db.removeLocation(c[i], Location(c[i+3], c[i+1], c[i+2], self.clientName))
+
+    def sendReply(self, msgType, content):
+        """send content in messages of at most REPLY_SIZE parts, followed by EXIT"""
+        for i in range(0, len(content), self.REPLY_SIZE):
+            if not self.conn.sendMessage(Message(msgType, content[i:i+self.REPLY_SIZE])):
+                debug("client died")
+                return
+        self.conn.sendMessage(Message(Message.EXIT, []))
+
+    def handleHostFiles(self, msg):
+        debug("handleHostFiles: " + str(msg))
+        assert(msg.type == Message.HOST_FILES)
+        reply = []
+        for f, loc in (yield Call(self.db.hostLocations, msg.content[0])):
+            reply += [ f, loc.path, str(loc.size), str(loc.mtime) ]
+        self.sendReply(Message.HOST_FILES, reply)
+
+    def handleRemoveHost(self, msg):
+        log("remove host %s (request from %s)" % (msg.content[0], self.clientName))
+        assert(msg.type == Message.REMOVE_HOST)
+        if msg.content[0] != self.clientName and not self.isAdmin():
+            warning("%s may not remove the copies on %s" % (self.clientName, msg.content[0]))
+            self.sendReply(Message.REMOVE_HOST, [])
+            return
+        removed = yield Call(self.db.removeHost, msg.content[0])
+        self.sendReply(Message.REMOVE_HOST, [ str(removed) ])
+
+    def handleHostUsage(self, msg):
+        debug("handleHostUsage: " + str(msg))
+        assert(msg.type == Message.HOST_USAGE)
+        reply = []
+        for host, usage in (yield Call(self.db.hostUsage)).items():
+            reply += [ host, str(usage[0]), str(usage[1]) ]
+        self.sendReply(Message.HOST_USAGE, reply)
+
+    def handlePrefixFiles(self, msg):
+        debug("handlePrefixFiles: " + str(msg))
+        assert(msg.type == Message.PREFIX_FILES)
+        reply = []
+        for f, nLocations in (yield Call(self.db.findPrefix, msg.content[0])):
+            reply += [ f, str(nLocations) ]
+        self.sendReply(Message.PREFIX_FILES, reply)
+
+    def handleRemovePrefix(self, msg):
+        log("remove files below %s (request from %s)" % (msg.content[0], self.clientName))
+        assert(msg.type == Message.REMOVE_PREFIX)
+        if not self.isAdmin():
+            warning("%s may not remove files below %s" % (self.clientName, msg.content[0]))
+            self.sendReply(Message.REMOVE_PREFIX, [])
+            return
+        if not msg.content[0].strip("/"):
+            warning("refusing to remove all files (prefix '%s')" % msg.content[0])
+            self.sendReply(Message.REMOVE_PREFIX, [])
+            return
+        removed = yield Call(self.db.removePrefix, msg.content[0])
+        self.sendReply(Message.REMOVE_PREFIX, [ str(removed) ])
+
     def handleGetLocations(self, msg):
         debug("handleGetLocations: " + str(msg))
         assert(msg.type == Message.GET_LOCATIONS)
@@ -517,10 +2028,10 @@ class ClientThread (threading.Thread):
             foundCounter = 0
             for loc in locations:
                 if loc.host == self.clientName:
-                    found = self.checkLocal(loc, requestedFile)
+                    found = yield from self.checkLocal(loc, requestedFile)
                     foundCounter += 1
                 else:
-                    found, abort = self.checkRemote(loc, requestedFile)
+                    found, abort = yield from self.checkRemote(loc, requestedFile)
                     foundCounter += 1
                     if abort:
                         debug("client died")
@@ -528,16 +2039,219 @@ class ClientThread (threading.Thread):
                 if foundCounter == locateLimit: break
             self.conn.sendMessage(Message(Message.EXIT, []))
 
+    def handleGetLocationsMany(self, msg):
+        """send the known locations of several files.
+        the locations are validated by the client"""
+        debug("handleGetLocationsMany: %d files" % ((len(msg.content) - 1) / 3))
+        assert(msg.type == Message.GET_LOCATIONS_MANY)
+        locateLimit = int(msg.content[0])
+        files = msg.content[1:]
+        for i in range(len(files) // 3):
+            filename = files[3*i]
+            reply = [ str(i) ]
+            for loc in list(self.db.getAllLocations(filename))[:locateLimit]:
+                reply += [ loc.host, loc.path, str(int(loc.host == self.clientName)) ]
+            if not self.conn.sendMessage(Message(Message.LOCATIONS, reply)):
+                debug("client died")
+                return
+        self.conn.sendMessage(Message(Message.EXIT, []))
+
+    def handleInvalidCopy(self, msg):
+        debug("handleInvalidCopy: " + str(msg))
+        assert(msg.type == Message.INVALID_COPY)
+        loc = Location(msg.content[4], msg.content[1], msg.content[2], msg.content[3])
+        self.db.removeLocation(msg.content[0], loc)
+
+    def handleFileBatch(self, msg):
+        """plan the transfers of several files at once.
+
+        a FETCH_PLAN is sent for each file, copies are started for at most
+        'parallel' files at a time. the client reports the outcome of each
+        transfer with FETCH_RESULT. files whose source turned out to be
+        invalid are planned again. the batch is terminated with EXIT.
+        """
+        debug("handleFileBatch: %d files" % ((len(msg.content) - 2) / 5))
+        assert(msg.type == Message.REQUEST_FILES)
+        locateLimit = int(msg.content[0])
+        parallel = max(1, int(msg.content[1]))
+        files = [ msg.content[i:i+5] for i in range(2, len(msg.content), 5) ]
+        retries = [ locateLimit ] * len(files)
+        pending = list(range(len(files) - 1, -1, -1))
+        # index -> (source type, host, copy token, location)
+        active = {}
+        # file without copy slot, planned again when a transfer has finished
+        deferred = None
+        # no slot within QUEUE_WAIT: the client retries files without slot
+        timeout = False
+        while True:
+            while pending and len(active) < parallel and deferred is None:
+                i = pending.pop()
+                transfer = self.planFileTransfer(i, files[i], retries[i])
+                if transfer is None:
+                    pass
+                elif transfer[0] != Message.PLAN_WAIT:
+                    active[i] = transfer
+                elif timeout:
+                    self.sendPlanWait(i)
+                else:
+                    deferred = (i, transfer)
+            if not active:
+                if deferred is None:
+                    break
+                # no transfer to wait for, wait for a copy slot
+                i, (source, fileserver, token, loc) = deferred
+                deferred = None
+                waiter = yield from self.waitForSlot(fileserver, files[i][4], files[i][1], loc,
+                                                     self.sourceKey(files[i]))
+                if waiter is not None and waiter.follower:
+                    # the file has been copied by another request
+                    self.stat.inc("coalesced")
+                    pending.append(i)
+                elif waiter is not None:
+                    transfer = self.planFileTransfer(i, files[i], retries[i], waiter)
+                    if transfer is not None:
+                        active[i] = transfer
+                else:
+                    self.sendPlanWait(i)
+                    timeout = True
+                continue
+            msg = yield from self.receive()
+            if msg == None:
+                debug("client died")
+                self.abortFileBatch(active)
+                return
+            elif msg.type == Message.PING:
+                for i, (source, host, token, loc) in list(active.items()):
+                    if token and (time.time() - token) > self.config.MAX_WAIT_COPY / 2:
+                        token = self.copycount.updateToken(host, self.clientName, token)
+                        active[i] = (source, host, token, loc)
+            elif msg.type == Message.FETCH_RESULT and not self.isFetchResult(msg):
+                error("invalid fetch result from %s: %s" % (self.clientName, str(msg)))
+                self.abortFileBatch(active)
+                self.conn.sendMessage(Message(Message.EXIT, []))
+                return
+            elif msg.type == Message.FETCH_RESULT and int(msg.content[0]) in active:
+                i = int(msg.content[0])
+                if self.finishFileTransfer(files[i], active.pop(i), msg.content[1], msg.content[2]):
+                    retries[i] -= 1
+                    pending.append(i)
+                if deferred is not None:
+                    pending.append(deferred[0])
+                    deferred = None
+            else:
+                debug("unexpected message: " + str(msg))
+        self.conn.sendMessage(Message(Message.EXIT, []))
+
+    @staticmethod
+    def isFetchResult(msg):
+        """FETCH_RESULT has the parts index, result and destination"""
+        if len(msg.content) < 3:
+            return False
+        try:
+            int(msg.content[0])
+        except ValueError:
+            return False
+        return True
+
+    def abortFileBatch(self, active):
+        """release the copy slots of the active transfers of a batch request"""
+        self.stat.inc("aborted")
+        for source, host, token, loc in active.values():
+            if token:
+                self.copycount.endCopy(host, self.clientName, token)
+
+    def sendPlanWait(self, index):
+        self.stat.inc("wait")
+        self.conn.sendMessage(Message(Message.FETCH_PLAN, [ str(index), Message.PLAN_WAIT,
+                                                            str(self.retryWait()) ]))
+
+    def planFileTransfer(self, index, requestedFile, retries, waiter = None):
+        """send the FETCH_PLAN for a file of a batch request.
+        returns (source type, host, copy token, location) if the
+        client has to report a result, None otherwise.
+        if no copy slot is available, nothing is sent and
+        (PLAN_WAIT, file server, 0, location) is returned, the file
+        server is None if the request should wait for the node only.
+        waiter: CopyWaiter granted a slot for the file"""
+        localDestination = requestedFile[4]
+        fileserver = requestedFile[3]
+        if fileserver == "": fileserver = "unknown"
+        if waiter is not None and waiter.token:
+            if waiter.host == fileserver:
+                self.conn.sendMessage(Message(Message.FETCH_PLAN, [ str(index), Message.PLAN_SERVER ]))
+                return (Message.PLAN_SERVER, fileserver, waiter.token, None)
+            loc = waiter.location
+            self.conn.sendMessage(Message(Message.FETCH_PLAN, [ str(index), Message.PLAN_NODE,
+                                                                loc.host, loc.path ]))
+            return (Message.PLAN_NODE, loc.host, waiter.token, loc)
+        if waiter is not None or self.copycount.isActiveTransfer(self.clientName, localDestination):
+            self.conn.sendMessage(Message(Message.FETCH_PLAN, [ str(index), Message.PLAN_WAIT,
+                                                                str(self.config.CLIENT_WAIT) ]))
+            return None
+        loc = None
+        if retries > 0:
+            loc = self.findLocation(requestedFile)
+        if loc != None and loc.host == self.clientName:
+            self.conn.sendMessage(Message(Message.FETCH_PLAN, [ str(index), Message.PLAN_LOCAL,
+                                                                loc.host, loc.path ]))
+            return (Message.PLAN_LOCAL, loc.host, 0, loc)
+        source = self.sourceKey(requestedFile)
+        if loc != None:
+            copyToken = self.copycount.startCopyFromNode(loc.host, self.clientName, localDestination,
+                                                         self.user, source)
+            if copyToken != 0:
+                self.conn.sendMessage(Message(Message.FETCH_PLAN, [ str(index), Message.PLAN_NODE,
+                                                                    loc.host, loc.path ]))
+                return (Message.PLAN_NODE, loc.host, copyToken, loc)
+        if loc != None and self.copycount.isDistributing(source):
+            return (Message.PLAN_WAIT, None, 0, loc)
+        # if the file was not found on a node or if we would have to wait for it,
+        # check if we can get it without waiting from the server
+        copyToken = self.copycount.startCopyFromServer(fileserver, self.clientName, localDestination,
+                                                       self.user, source)
+        if copyToken != 0:
+            self.conn.sendMessage(Message(Message.FETCH_PLAN, [ str(index), Message.PLAN_SERVER ]))
+            return (Message.PLAN_SERVER, fileserver, copyToken, None)
+        return (Message.PLAN_WAIT, fileserver, 0, loc)
+
+    def finishFileTransfer(self, requestedFile, transfer, result, destination):
+        """process the FETCH_RESULT of a file of a batch request.
+        returns True if the file has to be planned again."""
+        source, host, copyToken, loc = transfer
+        debug("finishFileTransfer: %s %s %s" % (requestedFile[0], source, result))
+        replan = False
+        if result == Message.RESULT_OK:
+            if source == Message.PLAN_LOCAL:
+                self.db.addLocation(requestedFile[0], loc)
+            else:
+                newloc = Location(destination, requestedFile[1], requestedFile[2], self.clientName)
+                self.db.addLocation(requestedFile[0], newloc)
+                if source == Message.PLAN_NODE:
+                    self.stat.inc("copyFromNode")
+                else:
+                    self.stat.inc("copyFromServer")
+        elif source != Message.PLAN_SERVER:
+            # invalid copy or copy from node failed
+            self.db.removeLocation(requestedFile[0], loc)
+            replan = True
+        if copyToken:
+            self.copycount.endCopy(host, self.clientName, copyToken)
+        return replan
+
     def handleRegisterCopy(self, msg):
         debug("handleRegisterCopy: " + str(msg))
         assert(msg.type == Message.REGISTER_COPY)
         retval = False
         fileinfo   = msg.content[0:3]
         fileserver = msg.content[3]
-        copyToken = self.copycount.startCopyFromServer(fileserver, self.clientName, fileinfo[0])
+        copyToken = self.copycount.startCopyFromServer(fileserver, self.clientName, fileinfo[0], self.user)
+        if copyToken == 0:
+            waiter = yield from self.waitForSlot(fileserver, fileinfo[0], fileinfo[1])
+            if waiter is not None:
+                copyToken = waiter.token
         debug("copyToken: %d" % copyToken)
         if copyToken == 0:
-            if not self.conn.sendMessage(Message(Message.WAIT, [ str(self.config.CLIENT_WAIT) ])):
+            if not self.conn.sendMessage(Message(Message.WAIT, [ str(self.retryWait()) ])):
                 debug("client died")
             else:
                 retval = True
@@ -546,7 +2260,7 @@ class ClientThread (threading.Thread):
                 debug("client died")
                 self.copycount.endCopy(fileserver, self.clientName, copyToken)
             else:
-                msg, copyToken = self.waitForClient(fileserver, self.clientName, copyToken)
+                msg, copyToken = yield from self.waitForClient(fileserver, self.clientName, copyToken)
                 self.copycount.endCopy(fileserver, self.clientName, copyToken)
                 if msg == None:
                     debug("client died")
@@ -567,6 +2281,8 @@ class ClientThread (threading.Thread):
         found = False
         wait  = False
         forceWait = False
+        # location of a node without free copy slot
+        busyLocation = None
         while True and locateLimit > 0:
             loc = self.findLocation(requestedFile)
             debug("loc: " + str(loc))
@@ -576,12 +2292,14 @@ class ClientThread (threading.Thread):
             elif loc != None:
                 forceWait = False
                 if loc.host == self.clientName:
-                    found = self.checkLocal(loc, requestedFile)
+                    found = yield from self.checkLocal(loc, requestedFile)
                 else:
-                    found, abort = self.checkRemote(loc, requestedFile)
+                    found, abort = yield from self.checkRemote(loc, requestedFile)
                     debug("checkRemote -> found=%s, abort=%s" % (found, abort))
                     if not abort and found:
-                        found, wait = self.copyFromRemote(loc, requestedFile)
+                        found, wait = yield from self.copyFromRemote(loc, requestedFile)
+                        if wait:
+                            busyLocation = loc
                     locateLimit -= 1
                     debug("locateLimit=%d (=retries left)" %locateLimit)
             else:
@@ -594,15 +2312,53 @@ class ClientThread (threading.Thread):
             # if file was not found on a node or if we would have to wait for it,
             # check if we can get it without waiting from the server
             if not forceWait:
-                found, wait = self.copyFromOrigin(requestedFile)
+                found, wait = yield from self.copyFromOrigin(requestedFile, busyLocation)
                 if not found:
                     log("copyFromOrigin failed: " + requestedFile[0])
                     self.conn.sendMessage(Message(Message.FALLBACK))
             if wait:
                 debug("send wait")
-                self.conn.sendMessage(Message(Message.WAIT, [ str(self.config.CLIENT_WAIT) ] ))
+                waitTime = self.config.CLIENT_WAIT if forceWait else self.retryWait()
+                self.conn.sendMessage(Message(Message.WAIT, [ str(waitTime) ] ))
         return wait
 
+    def retryWait(self):
+        """waiting time sent to a client without copy slot. a queued request
+        has already waited, it is sent again immediately"""
+        if self.config.QUEUE_WAIT > 0:
+            return 0
+        return self.config.CLIENT_WAIT
+
+    def sourceKey(self, requestedFile):
+        """identifies the version of a requested file, see COALESCE_REQUESTS"""
+        return (requestedFile[0], int(requestedFile[1]), int(float(requestedFile[2])))
+
+    def waitForSlot(self, fileserver, destination, size, location = None, source = None):
+        """wait in the queues of the file server (if not None) and of the
+        node holding location until a copy slot is granted. if source is
+        copied from a file server, wait for this copy instead.
+        returns the CopyWaiter, None if no slot has been granted within
+        QUEUE_WAIT seconds"""
+        if self.config.QUEUE_WAIT <= 0:
+            return None
+        start = time.time()
+        waiter = self.copycount.enqueue(self.clientName, destination, fileserver, location,
+                                        self.user, self.priority, int(size), source)
+        self.stat.inc("queued")
+        if not waiter.granted:
+            debug("waiting for a copy slot")
+            yield WaitForSlot(waiter, self.config.QUEUE_WAIT)
+        granted = self.copycount.cancel(waiter)
+        self.stat.dec("queued")
+        self.stat.addQueueWait(time.time() - start, granted)
+        if waiter.follower:
+            debug("copied by another request after %0.2fs" % (time.time() - start))
+        else:
+            debug("copy slot: %s after %0.2fs" % (str(waiter.host), time.time() - start))
+        if not granted:
+            return None
+        return waiter
+
     def findLocation(self, requestedFile):
         location = None
         if self.db.hasFile(requestedFile[0]):
@@ -611,7 +2367,7 @@ class ClientThread (threading.Thread):
             l = self.db.getLocation(requestedFile[0], self.clientName, self.copycount)
             while l != None:
                 debug("location: " + str(l))
-                if l.size != requestedFile[1] or int(float(l.mtime)) != int(float(requestedFile[2])):
+                if l.size != int(requestedFile[1]) or l.mtime != int(float(requestedFile[2])):
                     debug("invalid location")
                     self.db.removeLocation(requestedFile[0], l)
                 else:
@@ -627,7 +2383,7 @@ class ClientThread (threading.Thread):
         debug("checkLocal")
         self.conn.sendMessage(Message(Message.CHECK_LOCAL, [ loc.path ]))
         debug("send")
-        msg = self.conn.receiveMessage()
+        msg = yield from self.receive()
         debug("recv: " + str(msg))
         if msg == None:
             return True # client died, don't care
@@ -642,7 +2398,7 @@ class ClientThread (threading.Thread):
         debug("check remote")
         self.conn.sendMessage(Message(Message.CHECK_REMOTE, [ loc.host, loc.path ]))
         debug("send")
-        msg = self.conn.receiveMessage()
+        msg = yield from self.receive()
         debug("recv: " + str(msg))
         if msg == None:
             return (True, True)
@@ -653,32 +2409,48 @@ class ClientThread (threading.Thread):
         else:
             return (True, False)
 
-    def waitForClient(self, host, destNode, copyToken):
+    def waitForClient(self, host, destNode, copyToken, stripes = ()):
         """ wait until the client finished copying.
+        the tokens of the further sources of a striped copy
+        (stripes: [ [ location, token ] ]) are updated in place.
         returns (last_message, copyToken )"""
         tokenRefreshInterval = self.config.MAX_WAIT_COPY / 2
-        msg = self.conn.receiveMessage()
+        msg = yield from self.receive()
         debug("recv: " + str(msg))
         while msg and msg.type == Message.PING:
             if (time.time() - copyToken) > tokenRefreshInterval:
                 # prevent token from expiring, for slow copies
                 copyToken = self.copycount.updateToken(host, destNode, copyToken)
-            msg = self.conn.receiveMessage()
+                for stripe in stripes:
+                    stripe[1] = self.copycount.updateToken(stripe[0].host, destNode, stripe[1])
+            msg = yield from self.receive()
             debug("recv ping: " + str(msg))
         debug("end copy: " + str(msg))
         return (msg, copyToken)
 
-    def copyFromRemote(self, loc, requestedFile):
+    def copyFromRemote(self, loc, requestedFile, copyToken = 0):
         """ return (copyOk, wait) """
         debug("copy from remote -> %s:%s" % (self.clientName, requestedFile[4]))
         cnt = 0
-        copyToken = self.copycount.startCopyFromNode(loc.host, self.clientName, requestedFile[4])
+        if copyToken == 0:
+            copyToken = self.copycount.startCopyFromNode(loc.host, self.clientName, requestedFile[4],
+                                                         self.user, self.sourceKey(requestedFile))
         if copyToken == 0:
             self.stat.inc("wait")
             return (True, True)
         debug("start copy")
-        self.conn.sendMessage(Message(Message.COPY_FROM_NODE, [ loc.host, loc.path ]))
-        msg, copyToken = self.waitForClient(loc.host, self.clientName, copyToken)
+        stripes = self.stripeSources(loc, requestedFile)
+        if stripes:
+            self.stat.inc("striped")
+            self.conn.sendMessage(Message(Message.COPY_FROM_NODES, [ loc.host, loc.path ] +
+                                          [ x for l, t in stripes for x in (l.host, l.path) ]))
+        else:
+            self.conn.sendMessage(Message(Message.COPY_FROM_NODE, [ loc.host, loc.path ]))
+        msg, copyToken = yield from self.waitForClient(loc.host, self.clientName, copyToken, stripes)
+        for l, t in stripes:
+            self.copycount.endCopy(l.host, self.clientName, t)
+        if msg is not None and stripes:
+            self.removeInvalidSources(requestedFile, msg.content[int(msg.type == Message.COPY_OK):])
         if msg == None:
             self.stat.inc("aborted")
             r = (True, False)
@@ -694,23 +2466,80 @@ class ClientThread (threading.Thread):
             debug("copy failed")
             #TODO: don't remove location if there is just not enogh disk space!
             #DONE: disk space is checked before sending the request
-            self.db.removeLocation(requestedFile[0], loc)
+            # a striped copy reports the invalid sources, including loc
+            if not stripes:
+                self.db.removeLocation(requestedFile[0], loc)
             r = (False, False)
         self.copycount.endCopy(loc.host, self.clientName, copyToken)
         return r
 
-    def copyFromOrigin(self, requestedFile):
+    def stripeSources(self, loc, requestedFile):
+        """further locations for a striped copy from loc, with a copy slot
+        taken for each. returns [ [ location, token ] ]"""
+        if self.conn.version < Message.PROTOCOL_V4 or self.config.MAX_STRIPE_SOURCES <= 1 or \
+                int(requestedFile[1]) < self.config.STRIPE_MIN_SIZE:
+            return []
+        hosts = set([ loc.host, self.clientName ])
+        candidates = []
+        for l in list(self.db.getAllLocations(requestedFile[0])):
+            if not l.host in hosts and l.size == int(requestedFile[1]) and \
+                    l.mtime == int(float(requestedFile[2])):
+                hosts.add(l.host)
+                candidates.append(l)
+        random.shuffle(candidates)
+        stripes = []
+        for l in candidates:
+            if len(stripes) + 1 >= self.config.MAX_STRIPE_SOURCES:
+                break
+            token = self.copycount.startStripe(l.host, self.clientName, self.user)
+            if token:
+                stripes.append([ l, token ])
+        debug("stripe sources: %s" % " ".join([ l.host for l, t in stripes ]))
+        return stripes
+
+    def removeInvalidSources(self, requestedFile, invalid):
+        """remove the sources reported invalid by the client: [ (host, path)* ]"""
+        for i in range(0, len(invalid) - 1, 2):
+            debug("invalid source: %s:%s" % (invalid[i], invalid[i+1]))
+            self.db.removeLocation(requestedFile[0], Location(invalid[i+1], requestedFile[1],
+                                                              requestedFile[2], invalid[i]))
+
+    def copyFromOrigin(self, requestedFile, busyLocation = None):
+        """ return (copyOk, wait).
+        without free slot, the request waits for a slot of the file server
+        or of the node holding busyLocation. if the file is copied from the
+        file server by another request, the request waits for this copy.
+        a file distributed from this copy is not read from the file server
+        again while busyLocation is available """
         debug("copy from origin -> %s:%s" % (self.clientName, requestedFile[4]))
         cnt = 0
         fileserver = requestedFile[3]
         if fileserver == "": fileserver = "unknown"
-        copyToken = self.copycount.startCopyFromServer(fileserver, self.clientName, requestedFile[4])
+        source = self.sourceKey(requestedFile)
+        copyToken = 0
+        if busyLocation is not None and self.copycount.isDistributing(source):
+            fileserver = None
+        else:
+            copyToken = self.copycount.startCopyFromServer(fileserver, self.clientName, requestedFile[4],
+                                                           self.user, source)
         if copyToken == 0:
-            self.stat.inc("wait")
-            return (True, True)
+            waiter = yield from self.waitForSlot(fileserver, requestedFile[4], requestedFile[1],
+                                                 busyLocation, source)
+            if waiter is not None and waiter.follower:
+                # sent again, the client finds the new copy
+                self.stat.inc("coalesced")
+                return (True, True)
+            if waiter is None or waiter.token == 0:
+                self.stat.inc("wait")
+                return (True, True)
+            if waiter.host != fileserver:
+                found, wait = yield from self.copyFromRemote(waiter.location, requestedFile, waiter.token)
+                # the client is sent again after a failed copy
+                return (True, wait or not found)
+            copyToken = waiter.token
         debug("start copy")
         self.conn.sendMessage(Message(Message.COPY_FROM_SERVER))
-        msg, copyToken = self.waitForClient(fileserver, self.clientName, copyToken)
+        msg, copyToken = yield from self.waitForClient(fileserver, self.clientName, copyToken)
         if msg == None:
             self.stat.inc("aborted")
             r = (True, False)
@@ -729,6 +2558,230 @@ class ClientThread (threading.Thread):
         return r
 
 
+class ClientThread (threading.Thread):
+    """drives a ClientHandler in a separate thread using blocking I/O"""
+
+    def __init__(self, config, connection, clientAddress, db, copycount, stat):
+        threading.Thread.__init__(self)
+        self.config = config
+        self.conn = connection
+        self.clientIP = clientAddress
+        self.db = db
+        self.copycount = copycount
+        self.stat = stat
+
+    def run(self):
+        try:
+            debug("starting client thread for " + str(self.clientIP))
+            clientName = ClientHandler.resolveClientName(self.clientIP)
+            handler = ClientHandler(self.config, self.conn, self.clientIP, clientName,
+                                    self.db, self.copycount, self.stat)
+            coroutine = handler.run()
+            try:
+                op = next(coroutine)
+                while True:
+                    if op is Receive:
+                        op = coroutine.send(self.conn.receiveMessage())
+                    elif isinstance(op, Call):
+                        op = coroutine.send(op.function(*op.args))
+                    else:
+                        op.waiter.wait(op.timeout)
+                        op = coroutine.send(None)
+            except StopIteration:
+                pass
+        finally:
+            del self.conn
+
+
+class AsyncConnection:
+    """message transfer on asyncio streams.
+    used by the event-driven server."""
+
+    def __init__(self, reader, writer, address = "", timeout = None):
+        self.reader = reader
+        self.writer = writer
+        self.address = address
+        self.timeout = timeout
+        self.version = Message.PROTOCOL_V1
+
+    async def _read(self, size):
+        try:
+            return await asyncio.wait_for(self.reader.readexactly(size), self.timeout)
+        except asyncio.IncompleteReadError:
+            return None
+        except Exception as e:
+            error("cannot receive: " + str(e))
+            return None
+
+    async def _readAll(self, size):
+        r = await self._read(size)
+        if r is None:
+            return None
+        return r.decode('ascii')
+
+    async def _readVarint(self):
+        value = 0
+        shift = 0
+        for i in range(Message.MAX_VARINT_SIZE):
+            b = await self._read(1)
+            if b is None:
+                return None
+            value |= (b[0] & 0x7f) << shift
+            if b[0] < 0x80:
+                return value
+            shift += 7
+        error("invalid length from %s" % str(self.address))
+        self.close()
+        return None
+
+    def setProtocolVersion(self, version):
+        self.version = version
+
+    async def receiveMessage(self):
+        if self.version == Message.PROTOCOL_V1:
+            return await self._receiveMessageV1()
+        else:
+            return await self._receiveMessageV2()
+
+    async def _receiveMessageV1(self):
+        try:
+            msgType = int(await self._readAll(Message.SIZE_MSG_TYPE))
+        except TypeError:
+            return None
+        try:
+            nParts = Message.nMessageParts[msgType]
+        except KeyError:
+            error("unknown message type: '%d'" % msgType)
+            return None
+        if nParts is None:
+            error("message type %d requires protocol version 2" % msgType)
+            return None
+        msg = []
+        for i in range(nParts):
+            len = await self._readAll(Message.SIZE_STRLEN)
+            if len == None:
+                return None
+            s = await self._readAll(int(len))
+            if s == None:
+                return None
+            msg.append(s)
+        return Message(msgType, msg)
+
+    async def _receiveMessageV2(self):
+        msgType = await self._readVarint()
+        nParts = await self._readVarint()
+        if nParts is None:
+            return None
+        msg = []
+        # each part counts at least one byte, its length
+        size = nParts
+        for i in range(nParts):
+            if size > Message.MAX_MESSAGE_SIZE:
+                break
+            len = await self._readVarint()
+            if len is None:
+                return None
+            size += len
+            if size > Message.MAX_MESSAGE_SIZE:
+                break
+            s = await self._read(len)
+            if s is None:
+                return None
+            msg.append(s.decode(Message.ENCODING, 'surrogateescape'))
+        if size > Message.MAX_MESSAGE_SIZE:
+            error("message from %s exceeds %d bytes" % (str(self.address), Message.MAX_MESSAGE_SIZE))
+            self.close()
+            return None
+        return Message.create(msgType, msg)
+
+    def sendMessage(self, msg):
+        """queue the message for sending. the data is written
+        to the socket when the event loop gets control back."""
+        if self.writer.is_closing():
+            return False
+        try:
+            self.writer.write(msg.serialize(self.version))
+        except Exception as e:
+            error("send failed: " + str(e))
+            return False
+        return True
+
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except Exception as e:
+            debug("cannot send: " + str(e))
+            return False
+        return True
+
+    def getPeerName(self):
+        return self.address
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncServer:
+    """serves all client connections in a single thread using an asyncio
+    event loop. the ClientHandler coroutines are driven by awaiting the
+    incoming messages instead of blocking in a thread per connection."""
+
+    def __init__(self, config, db, copycount, stat):
+        self.config = config
+        self.db = db
+        self.copycount = copycount
+        self.stat = stat
+
+    def serve(self, serverSocket):
+        asyncio.run(self._serve(serverSocket))
+
+    async def _serve(self, serverSocket):
+        # SIGTERM stops the event loop instead of raising a SignalException
+        # somewhere inside of it
+        loop = asyncio.get_running_loop()
+        terminate = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, terminate.set_result, None)
+        server = await asyncio.start_server(self.handleClient, sock=serverSocket,
+                                            backlog=self.config.CONNECTION_QUEUE)
+        async with server:
+            await terminate
+        debug("event loop terminated")
+
+    async def handleClient(self, reader, writer):
+        clientAddress = writer.get_extra_info("peername")
+        conn = AsyncConnection(reader, writer, clientAddress, self.config.SOCKET_TIMEOUT)
+        try:
+            debug("starting client coroutine for " + str(clientAddress))
+            loop = asyncio.get_running_loop()
+            clientName = await loop.run_in_executor(None, ClientHandler.resolveClientName, clientAddress)
+            handler = ClientHandler(self.config, conn, clientAddress, clientName,
+                                    self.db, self.copycount, self.stat)
+            coroutine = handler.run()
+            try:
+                op = next(coroutine)
+                while True:
+                    if isinstance(op, Call):
+                        await conn.drain()
+                        op = coroutine.send(await loop.run_in_executor(None, op.function, *op.args))
+                    elif op is not Receive:
+                        await conn.drain()
+                        await op.waiter.waitAsync(op.timeout)
+                        op = coroutine.send(None)
+                    elif not await conn.drain():
+                        op = coroutine.send(None)
+                    else:
+                        op = coroutine.send(await conn.receiveMessage())
+            except StopIteration:
+                pass
+        except asyncio.CancelledError:
+            debug("server shutdown")
+        except Exception as e:
+            error("client %s: %s" % (str(clientAddress), str(e)))
+        finally:
+            await conn.drain()
+            conn.close()
+
+
 class Statistics:
 
     def __init__(self):
@@ -740,6 +2793,13 @@ class Statistics:
         self.aborted = 0
         self.changed = False
         self.wait = 0
+        self.queued = 0
+        self.queueWaits = 0
+        self.queueWaitTime = 0.0
+        self.maxQueueWait = 0.0
+        self.queueTimeouts = 0
+        self.coalesced = 0
+        self.striped = 0
 
     def inc(self, attr):
         self.lock.acquire()
@@ -755,6 +2815,17 @@ class Statistics:
         self.changed = True
         self.lock.release()
 
+    def addQueueWait(self, seconds, granted):
+        self.lock.acquire()
+        if granted:
+            self.queueWaits += 1
+            self.queueWaitTime += seconds
+            self.maxQueueWait = max(self.maxQueueWait, seconds)
+        else:
+            self.queueTimeouts += 1
+        self.changed = True
+        self.lock.release()
+
     def hasChanged(self):
         self.lock.acquire()
         r = self.changed
@@ -771,10 +2842,11 @@ class Statistics:
 
 class StatisticsWriter (threading.Thread):
 
-    def __init__(self, stat, db, interval):
+    def __init__(self, stat, db, copycount, interval):
         threading.Thread.__init__(self)
         self.stat = stat
         self.db = db
+        self.copycount = copycount
         self.interval = interval
         self.finished = threading.Event()
 
@@ -788,6 +2860,7 @@ class StatisticsWriter (threading.Thread):
                     locationsPerFile = db[1]/float(db[0])
                 else:
                     locationsPerFile = 0
+                queues = sorted([ (n, host) for host, n in self.copycount.queueDepth().items() ])[-3:]
                 log("statistics at " + time.strftime("%Y-%m-%d %H:%M:%S") + "\n" + \
                     "     requests:       %d\n" % stat.requests +\
                     "     active threads: %d\n" % stat.threads +\
@@ -795,7 +2868,14 @@ class StatisticsWriter (threading.Thread):
                                                          stat.copyFromServer*100.0/total) +\
                     "     node copy:      %d = %0.2f\n" % (stat.copyFromNode, \
                                                          stat.copyFromNode*100.0/total) +\
+                    "     striped copy:   %d\n" % stat.striped +\
                     "     waits:          %d\n" % stat.wait +\
+                    "     queued:         %d %s\n" % (stat.queued, " ".join([ "%s=%d" % (h, n)
+                                                                            for n, h in queues[::-1] ])) +\
+                    "     queue waits:    %d, %0.1fs average, %0.1fs max, %d timeouts\n" % \
+                    (stat.queueWaits, stat.queueWaitTime / max(1, stat.queueWaits), stat.maxQueueWait,
+                     stat.queueTimeouts) +\
+                    "     coalesced:      %d\n" % stat.coalesced +\
                     "     aborted:        %d\n" % stat.aborted +\
                     "     files:          %d\n" % db[0] +\
                     "     locations:      %d = %0.2f per file\n" % (db[1], locationsPerFile))
@@ -835,6 +2915,24 @@ class SignalException (BaseException):
     def handler(signal, frame):
         raise SignalException(signal)
 
+def serveThreads(serverSocket, config, filedb, copycount, stat):
+    """accept client connections and start a ClientThread for each"""
+    while True:
+        startClientThread = True
+        clientSocket = None
+        try:
+            clientSocket, clientAddress = serverSocket.accept()
+        except Exception as e:
+            error("socket accept failed: %s" % str(e))
+            del clientSocket
+            startClientThread = False
+        if startClientThread:
+            clientSocket.settimeout(config.SOCKET_TIMEOUT)
+            clientSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            clientConnection = Connection(clientSocket, clientAddress)
+            clientThread = ClientThread(config, clientConnection, clientAddress, filedb, copycount, stat)
+            clientThread.start()
+
 def main(argc, argv):
     config = ServerConfiguration()
     # LogLevel.enableDebug()
@@ -851,43 +2949,45 @@ def main(argc, argv):
     except Exception as e:
         error("cannot create server socket: %s" % str(e))
         return 1
-    filedb = FileDatabase()
-    if filedb.load(config.DB_FILE):
-        log("loaded file database from %s" % config.DB_FILE)
+    filedb = FileDatabase(config.DB_FORK_WRITER, config.DB_SHARDS)
+    # without log, changes made while loading could be lost on shutdown
+    if filedb.load(config.DB_FILE, config.DB_LOG_COMMIT_INTERVAL > 0):
+        log("loading file database from %s" % config.DB_FILE)
     writer = DatabaseWriter(filedb, config.DB_FILE, config.DB_SAVE_INTERVAL)
+    logWriter = None
+    if config.DB_LOG_COMMIT_INTERVAL > 0:
+        dblog = DatabaseLog(config.DB_FILE)
+        filedb.replay(dblog)
+        logWriter = DatabaseLogWriter(dblog, config.DB_LOG_COMMIT_INTERVAL,
+                                      config.DB_LOG_MAX_SIZE, writer.compact)
     dbCleaner = DatabaseCleaner(filedb, config.CLEANUP_INTERVAL, config.MAX_AGE)
     copycount = CopyCounter(config)
     stat = Statistics()
-    statWriter = StatisticsWriter(stat, filedb, config.STAT_INTERVAL)
+    statWriter = StatisticsWriter(stat, filedb, copycount, config.STAT_INTERVAL)
 
     signal.signal(signal.SIGTERM, SignalException.handler)
 
     try:
         try:
             writer.start()
+            if logWriter:
+                logWriter.start()
             dbCleaner.start()
             statWriter.start()
-            while True:
-                startClientThread = True
-                clientSocket = None
-                try:
-                        clientSocket, clientAddress = serverSocket.accept()
-                except Exception as e:
-                    error("socket accept failed: %s" % str(e))
-                    del clientSocket
-                    startClientThread = False
-                if startClientThread:
-                    clientSocket.settimeout(config.SOCKET_TIMEOUT)
-                    clientConnection = Connection(clientSocket, clientAddress)
-                    clientThread = ClientThread(config, clientConnection, clientAddress, filedb, copycount, stat)
-                    clientThread.start()
+            if config.SERVER_MODE == "async":
+                log("using event-driven server")
+                AsyncServer(config, filedb, copycount, stat).serve(serverSocket)
+            else:
+                serveThreads(serverSocket, config, filedb, copycount, stat)
         finally:
             serverSocket.close()
             writer.stop()
+            if logWriter:
+                logWriter.stop()
             dbCleaner.stop()
             statWriter.stop()
-            if filedb.lock.acquire(False):
-                filedb.lock.release()
+            if filedb.lockAll(False):
+                filedb.unlockAll()
                 filedb.write(config.DB_FILE)
             log("exit")
     except (SignalException, KeyboardInterrupt) as e:
@@ -17,22 +17,31 @@ class LogLevel:
         LogLevel.level = level
 
 
+_output = threading.local()
+
+def setOutput(stream):
+    """redirect the messages of the current thread (None: sys.stderr)"""
+    _output.stream = stream
+
+def _stream():
+    return getattr(_output, "stream", None) or sys.stderr
+
 def _getCaller():
     return sys._getframe(2).f_code.co_name
 
 def error(msg):
     if LogLevel.level > 0:
-        sys.stderr.write("ERROR: " + msg + " [%s]\n" % _getCaller())
+        _stream().write("ERROR: " + msg + " [%s]\n" % _getCaller())
 
 def log(msg):
     if LogLevel.level > 2:
-        sys.stderr.write("LOG: " + msg + "\n")
+        _stream().write("LOG: " + msg + "\n")
 
 def warning(msg):
     if LogLevel.level > 1:
-        sys.stderr.write("WARN: " + msg + "\n")
+        _stream().write("WARN: " + msg + "\n")
 
 def debug(msg):
     if LogLevel.debug:
-        sys.stderr.write("DEBUG: " + threading.currentThread().getName() + " " + msg + " [%s]\n" % _getCaller())
+        _stream().write("DEBUG: " + threading.currentThread().getName() + " " + msg + " [%s]\n" % _getCaller())
 
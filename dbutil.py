@@ -1,60 +1,78 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 database utility for cache-manager databases
 """
 
+import os
 import sys
-from cachemanager import *
-from cmserver import *
+import time
+import random
+import importlib.util
+from cmlogging import *
 
 __version__ = "$Rev: 821 $"
 __author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
 __copyright__ = "Copyright 2012, RWTH Aachen University"
 
 
+def loadServerModule():
+    """import cm-server.py as module cmserver"""
+    spec = importlib.util.spec_from_file_location(
+        "cmserver", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cm-server.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["cmserver"] = module
+    spec.loader.exec_module(module)
+    return module
+
+cmserver = loadServerModule()
+
+
+def residentMemory():
+    """resident set size of the process (bytes)"""
+    return int(open("/proc/self/statm").read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
 def main(argv):
     if len(argv) < 3:
-        print "usage: %s <db-file> <action>" % argv[0]
-        print "action: stat | filestat | dump | convert <file> | clean <max-age> | delete <prefix>"
+        print("usage: %s <db-file> <action>" % argv[0])
+        print("action: stat | filestat | dump | convert <file> | clean <max-age> | delete <prefix>")
+        print("        fill <files> <locations per file>")
         return 1
-    enableDebug()
-    db = FileDatabase()
-    if not db.load(argv[1]):
-        print "cannot load database from " + argv[1]
     action = argv[2]
+    if action != "fill":
+        LogLevel.enableDebug()
+    db = cmserver.FileDatabase()
+    if not db.load(argv[1]):
+        print("cannot load database from " + argv[1])
 
     if action == "stat":
         numFiles, numLoc = db.getStat()
-        print "numFiles: ", numFiles
-        print "numLoc:   ", numLoc
+        print("numFiles: ", numFiles)
+        print("numLoc:   ", numLoc)
     elif action == "filestat":
-        for f in db.files:
-            print f, len(db.files[f])
+        for f, record in db.records():
+            print(f, len(record))
     elif action == "dump":
-        for f in db.files:
-            for l in db.files[f]:
-                print f, l
+        for f, record in db.records():
+            for l in record:
+                print(f, l)
     elif action == "convert":
+        db.changed = True
         db.write(sys.argv[3])
 
     elif action == "clean":
-        # db.getLocation( db.files.keys()[1] )
         db.removeOldRecords(int(time.time()) - int(sys.argv[3]))
         db.write(sys.argv[1])
     elif action == "delete":
-	prefix = sys.argv[3]
-	deleted = 0
-	scanned = 0
-	for f in db.files.keys():
-	    scanned += 1
-	    if f.startswith(prefix):
-		del db.files[f]
-		deleted += 1
-	print "deleted %d / %d records" % (deleted, scanned)
-	db.write(sys.argv[1])
+        prefix = sys.argv[3]
+        scanned = len(db)
+        deleted = db.removePrefix(prefix)
+        print("deleted %d / %d records" % (deleted, scanned))
+        db.write(sys.argv[1])
     elif action == "fill":
         nFiles = int(sys.argv[3])
         nLoc = int(sys.argv[4])
+        memory = residentMemory()
         for f in range(nFiles):
             length = random.randint(4, 20)
             name = []
@@ -66,14 +84,16 @@ def main(argv):
                 host = "HOST_%d" % random.randint(0, 150)
                 user = "USER_%d" % random.randint(0, 100)
                 path = "/var/tmp/%s%s" % (user, filepath)
-                loc = Location(path, 1, int(time.time()), host)
+                loc = cmserver.Location(path, "1", str(int(time.time())), host)
                 db.addLocation(filepath, loc)
+        numFiles, numLoc = db.getStat()
+        print("%d files, %d locations, %0.1f bytes per location" %
+              (numFiles, numLoc, (residentMemory() - memory) / float(max(1, numLoc))))
         db.write(sys.argv[1])
     else:
-        print "unknwon action: " + action
+        print("unknwon action: " + action)
         return 1
     return 0
 
 if __name__ == "__main__":
     sys.exit( main(sys.argv) )
-
@@ -4,6 +4,7 @@ environment settings for CacheManager client
 
 import socket
 import filesystem
+from cmlogging import *
 
 __version__ = "$Rev: 822 $"
 __author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
@@ -36,7 +37,21 @@ class GenericClientEnvironment:
         use filesystem.NfsRemoteFileSystem if hard disks on other nodes
         are accessible by a network file system (e.g. NFS) and mounted
         on the compute nodes
+
+        use filesystem.PeerRemoteFileSystem if the nodes run the peer
+        transfer service (cm-client.py --peer), which avoids the
+        encryption of SSH. files which are not served are copied with SSH
+
+        the implementation is selected by REMOTE_FILE_SYSTEM
+        ("ssh", "nfs" or "peer")
         """
+        system = config.REMOTE_FILE_SYSTEM.lower()
+        if system == "peer":
+            return filesystem.PeerRemoteFileSystem(config)
+        elif system == "nfs":
+            return filesystem.NfsRemoteFileSystem(config)
+        elif system != "ssh":
+            warning("unknown remote file system '%s'. using ssh" % config.REMOTE_FILE_SYSTEM)
         return filesystem.SshRemoteFileSystem(config)
 
 
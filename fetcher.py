@@ -2,9 +2,12 @@
 file fetcher for cache manager client
 """
 
+import os
 import os.path
 import time
+import fcntl
 import threading
+import collections
 from shared import Message
 from cmlogging import *
 import settings
@@ -43,6 +46,174 @@ class PingThread (threading.Thread):
         pt.start()
         return pt
 
+class StripeReader (threading.Thread):
+    """reads chunks of a striped copy from one source"""
+
+    BLOCK = 1024 * 1024
+
+    def __init__(self, copy, host, filename):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.copy = copy
+        self.host = host
+        self.filename = filename
+        self.stream = None
+        # (offset, length) of the current chunk and the bytes written of it
+        self.chunk = None
+        self.done = 0
+        self.lastProgress = time.time()
+        self.cancelled = False
+        # the source is invalid
+        self.failed = False
+
+    def run(self):
+        try:
+            while True:
+                chunk = self.copy.nextChunk(self)
+                if chunk is None:
+                    break
+                self.readChunk(chunk)
+        except Exception as e:
+            if not self.cancelled:
+                log("reading from %s:%s failed: %s" % (self.host, self.filename, str(e)))
+        finally:
+            self.copy.readerFinished(self)
+
+    def readChunk(self, chunk):
+        offset, length = chunk
+        self.stream = self.copy.remoteSystem.readRange(self.host, self.filename, offset, length)
+        try:
+            while self.done < length:
+                data = self.stream.read(min(self.BLOCK, length - self.done))
+                if not data:
+                    raise IOError("unexpected end of file")
+                if not self.copy.write(self, data):
+                    break
+        finally:
+            self.stream.close()
+
+
+class StripedCopy:
+    """copy a file from several sources in parallel.
+
+    the file is split into chunks of STRIPE_CHUNK bytes, each source is
+    read by a StripeReader taking the next chunk. the destination is
+    locked while the chunks are written at their offsets. the rest of
+    the chunk of a source which fails or makes no progress for
+    STRIPE_STALL_TIMEOUT seconds is read from the other sources.
+    """
+
+    def __init__(self, config, remoteSystem, sources, size, mtime, mode, destination):
+        self.config = config
+        self.remoteSystem = remoteSystem
+        self.sources = sources
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.destination = destination
+        self.chunks = collections.deque()
+        for offset in range(0, size, config.STRIPE_CHUNK):
+            self.chunks.append((offset, min(config.STRIPE_CHUNK, size - offset)))
+        self.remaining = size
+        self.readers = []
+        self.fd = None
+        # no more writes to the destination
+        self.finished = False
+        self.lock = threading.Condition()
+
+    def nextChunk(self, reader):
+        """return the next chunk for reader, None if there is none left.
+        waits for the chunks of failing readers"""
+        with self.lock:
+            reader.chunk = None
+            while not self.chunks and self.remaining > 0 and not (reader.cancelled or self.finished):
+                self.lock.wait()
+            if not self.chunks or reader.cancelled or self.finished:
+                return None
+            reader.chunk = self.chunks.popleft()
+            reader.done = 0
+            reader.lastProgress = time.time()
+            return reader.chunk
+
+    def write(self, reader, data):
+        """write data read by reader. returns False if the reader has been
+        cancelled"""
+        with self.lock:
+            if reader.cancelled or self.finished:
+                return False
+            os.pwrite(self.fd, data, reader.chunk[0] + reader.done)
+            reader.done += len(data)
+            reader.lastProgress = time.time()
+            self.remaining -= len(data)
+            self.lock.notify_all()
+            return True
+
+    def _requeue(self, reader):
+        """the rest of the chunk of reader is read by the other sources"""
+        if reader.chunk is not None and reader.done < reader.chunk[1]:
+            offset, length = reader.chunk
+            self.chunks.appendleft((offset + reader.done, length - reader.done))
+        reader.chunk = None
+
+    def readerFinished(self, reader):
+        with self.lock:
+            if reader.chunk is not None and reader.done < reader.chunk[1]:
+                reader.failed = True
+            self._requeue(reader)
+            self.lock.notify_all()
+
+    def _checkStalled(self):
+        now = time.time()
+        for reader in self.readers:
+            if reader.chunk is not None and not reader.cancelled and \
+                    now - reader.lastProgress > self.config.STRIPE_STALL_TIMEOUT:
+                log("no progress reading from %s:%s" % (reader.host, reader.filename))
+                reader.cancelled = True
+                self._requeue(reader)
+                self.lock.notify_all()
+                # the stream may block, close it in the background
+                if reader.stream is not None:
+                    threading.Thread(target=reader.stream.close, daemon=True).start()
+
+    def run(self):
+        """returns (success, message)"""
+        try:
+            self.fd = os.open(self.destination, os.O_WRONLY | os.O_CREAT, 0o644)
+        except OSError as e:
+            return (False, "cannot open %s: %s" % (self.destination, str(e)))
+        try:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return (False, "%s is locked" % self.destination)
+            os.ftruncate(self.fd, 0)
+            os.ftruncate(self.fd, self.size)
+            with self.lock:
+                for host, filename in self.sources:
+                    reader = StripeReader(self, host, filename)
+                    self.readers.append(reader)
+                    reader.start()
+                while self.remaining > 0:
+                    self._checkStalled()
+                    if not [ r for r in self.readers if r.is_alive() and not r.cancelled ]:
+                        break
+                    self.lock.wait(1.0)
+                self.finished = True
+                self.lock.notify_all()
+            if self.remaining == 0:
+                os.fchmod(self.fd, self.mode & 0o7777)
+        finally:
+            os.close(self.fd)
+        if self.remaining > 0:
+            return (False, "striped copy failed, %d bytes missing" % self.remaining)
+        os.utime(self.destination, (time.time(), self.mtime))
+        return (True, "")
+
+    def failedSources(self):
+        """sources which could not be read (stalled sources are not included)"""
+        return [ (r.host, r.filename) for r in self.readers if r.failed ]
+
+
 class CacheFetcher:
 
     def __init__(self, config, fileSystem, connection):
@@ -56,15 +227,21 @@ class CacheFetcher:
         self.remoteSystem.brandFile(host, filename)
 
     def checkRemote(self, originalFileInfo, host, filename):
+        return self.remoteStat(originalFileInfo, host, filename) is not None
+
+    def remoteStat(self, originalFileInfo, host, filename):
+        """returns (size, mtime, mode) of the remote file if it matches
+        originalFileInfo, None otherwise"""
         debug("checkRemote: " + filename)
         log("checking status of %s:%s" % (host, filename))
         stat = self.remoteSystem.getFileStat(host, filename)
         debug("stat:     %s" % str(stat))
         debug("original: %s" % str(originalFileInfo))
         if stat == None:
-            return False
-        return (int(float(originalFileInfo[1])) == stat[0] and \
-                int(float(originalFileInfo[2])) == stat[1])
+            return None
+        if int(float(originalFileInfo[1])) != stat[0] or int(float(originalFileInfo[2])) != stat[1]:
+            return None
+        return stat
 
     def checkLocal(self, originalFileInfo, filename):
         debug("checkLocal " + filename)
@@ -88,10 +265,44 @@ class CacheFetcher:
             error("cannot copy %s:%s to %s" % (host, filename, destination))
             return False
         else:
-            log("copied %s:%s" % (host, filename))
+            log("copied %s:%s (%s)" % (host, filename, self.remoteSystem.engine.rateInfo()))
             self.fileSystem.setATime(destination)
+            self.fileSystem.addCachedFile(destination, fileinfo[0])
             return True
 
+    def copyFromNodes(self, fileinfo, sources, destination):
+        """striped copy from several nodes. sources: [ (host, filename) ].
+        returns (success, invalid sources)"""
+        debug("copy from nodes: %s, %s" % (str(sources), destination))
+        valid = []
+        invalid = []
+        mode = 0o644
+        for host, filename in sources:
+            stat = self.remoteStat(fileinfo, host, filename)
+            if stat is not None:
+                valid.append((host, filename))
+                mode = stat[2]
+            else:
+                invalid.append((host, filename))
+        if not valid:
+            return (False, invalid)
+        log("start copying %s from %d nodes" % (fileinfo[0], len(valid)))
+        pt = PingThread.create(self.conn, self.config)
+        copy = StripedCopy(self.config, self.remoteSystem, valid, int(fileinfo[1]),
+                           int(float(fileinfo[2])), mode, destination)
+        copyOK, msg = copy.run()
+        pt.stop()
+        del pt
+        invalid += copy.failedSources()
+        if not copyOK:
+            log("%s" % msg)
+            error("cannot copy %s to %s" % (fileinfo[0], destination))
+            return (False, invalid)
+        log("copied %s from %d nodes" % (fileinfo[0], len(valid)))
+        self.fileSystem.setATime(destination)
+        self.fileSystem.addCachedFile(destination, fileinfo[0])
+        return (True, invalid)
+
     def copyFromServer(self, fileinfo, destination):
         filename = fileinfo[0]
         debug("copy from server: %s, %s" % (filename, destination))
@@ -99,13 +310,14 @@ class CacheFetcher:
         try:
             # shutil.copy2(filename, destination)
             pt = PingThread.create(self.conn, self.config)
-            copyOk, msg = self.remoteSystem.copyUsingCp(filename, destination)
+            copyOk, msg = self.remoteSystem.copyLocal(filename, destination)
             pt.stop()
             del pt
             if not copyOk:
                 raise Exception(msg)
-            log("copied %s" % filename)
+            log("copied %s (%s)" % (filename, self.remoteSystem.engine.rateInfo()))
             self.fileSystem.setATime(destination)
+            self.fileSystem.addCachedFile(destination, filename)
             return True
         except Exception as e:
             error("cannot copy %s to %s: %s" % (filename, destination, str(e)))
@@ -117,6 +329,58 @@ class CacheFetcher:
         debug("file server: " + fileserver)
         return self.conn.sendMessage(Message(Message.REQUEST_FILE, fileinfo + [fileserver, destination, str(locateLimit)]))
 
+    def requestFiles(self, requests, locateLimit=99999, parallel=1):
+        """batch request. requests: list of (fileinfo, destination)"""
+        debug("requestFiles: %d files" % len(requests))
+        content = [ str(locateLimit), str(parallel) ]
+        for fileinfo, destination in requests:
+            content += fileinfo + [ self.fileSystem.getFileServer(fileinfo[0]), destination ]
+        return self.conn.sendMessage(Message(Message.REQUEST_FILES, content))
+
+    def requestLocationsMany(self, fileinfos, locateLimit=999999):
+        debug("requestLocationsMany: %d files" % len(fileinfos))
+        content = [ str(locateLimit) ]
+        for fileinfo in fileinfos:
+            content += fileinfo
+        return self.conn.sendMessage(Message(Message.GET_LOCATIONS_MANY, content))
+
+    def sendFetchResult(self, index, result, destination=""):
+        debug("sendFetchResult: %d %s %s" % (index, result, destination))
+        return self.conn.sendMessage(Message(Message.FETCH_RESULT, [ str(index), result, destination ]))
+
+    def sendInvalidCopy(self, fileinfo, host, filename):
+        debug("sendInvalidCopy: %s, %s:%s" % (str(fileinfo), host, filename))
+        return self.conn.sendMessage(Message(Message.INVALID_COPY, fileinfo + [ host, filename ]))
+
+    def executePlan(self, index, fileinfo, destination, plan):
+        """execute a FETCH_PLAN of a batch request and report the result.
+        returns the local file name or None."""
+        action = plan[0]
+        retFile = None
+        if action == Message.PLAN_LOCAL:
+            if self.checkLocal(fileinfo, plan[2]):
+                log("using existing copy %s" % plan[2])
+                retFile = plan[2]
+                result = Message.RESULT_OK
+            else:
+                result = Message.RESULT_INVALID
+        elif action == Message.PLAN_NODE:
+            if not self.checkRemote(fileinfo, plan[1], plan[2]):
+                result = Message.RESULT_INVALID
+            elif self.copyFromNode(fileinfo, plan[1], plan[2], destination):
+                retFile = destination
+                result = Message.RESULT_OK
+            else:
+                result = Message.RESULT_FAILED
+        else:
+            if self.copyFromServer(fileinfo, destination):
+                retFile = destination
+                result = Message.RESULT_OK
+            else:
+                result = Message.RESULT_FAILED
+        self.sendFetchResult(index, result, retFile or "")
+        return retFile
+
     def requestFileLocations(self, fileinfo, locateLimit=999999):
         debug("requestFileLocations: %s, %d locations" % (str(fileinfo), locateLimit))
         return self.conn.sendMessage(Message(Message.GET_LOCATIONS, fileinfo + [str(locateLimit)]))
@@ -131,6 +395,18 @@ class CacheFetcher:
         r = self.conn.sendMessage(Message(Message.DELETED_COPY, fileinfo + [destination]))
         debug(" => " + str(r))
 
+    def sendFilesRemoved(self, removed):
+        """report removed files. removed: list of fileinfo + [destination]"""
+        debug("sendFilesRemoved: %d files" % len(removed))
+        if not removed:
+            return True
+        if self.conn.version >= Message.PROTOCOL_V2:
+            return self.conn.sendMessage(Message(Message.DELETED_COPIES, [ x for r in removed for x in r ]))
+        for r in removed:
+            if not self.conn.sendMessage(Message(Message.DELETED_COPY, r)):
+                return False
+        return True
+
     def sendExit(self):
         debug("sendExit")
         r = self.conn.sendMessage(Message(Message.EXIT, []))
@@ -190,6 +466,16 @@ class CacheFetcher:
                 retval = True
             else:
                 reply = Message(Message.COPY_FAILED)
+        elif msg.type == Message.COPY_FROM_NODES:
+            sources = [ (msg.content[i], msg.content[i+1]) for i in range(0, len(msg.content) - 1, 2) ]
+            copyOK, invalid = self.copyFromNodes(fileinfo, sources, destination)
+            invalid = [ x for source in invalid for x in source ]
+            if copyOK:
+                reply = Message(Message.COPY_OK, [destination] + invalid)
+                retFile = destination
+                retval = True
+            else:
+                reply = Message(Message.COPY_FAILED, invalid)
         elif msg.type == Message.COPY_FROM_SERVER:
             if self.copyFromServer(fileinfo, destination):
                 reply = Message(Message.COPY_OK, [destination])
@@ -10,7 +10,16 @@ import time
 import subprocess
 import datetime
 import signal
+import heapq
+import shlex
+import fcntl
+import errno
+import hashlib
+import re
+import pwd
 from cmlogging import *
+from shared import Message, Connection
+from manifest import CacheManifest
 import settings
 
 __version__ = "$Rev: 837 $"
@@ -31,12 +40,86 @@ def _popenWithTimeout(cmd, timeout):
     return process.stdout.readlines()
 
 
+class EvictionPolicy:
+    """order in which cached files are evicted.
+
+    each file gets a priority when it is added or accessed, files with
+    the lowest priority are evicted first. the inflation value is
+    maintained per cache directory and updated on each eviction.
+    the priority is the atime (least recently used) unless a policy
+    overrides priority().
+    """
+
+    name = None
+
+    # files are evicted in the order of their atime
+    ordersByATime = True
+
+    def priority(self, size, atime, hits, inflation):
+        return atime
+
+    def inflation(self, evictedPriority, inflation):
+        """return the new inflation value after an eviction"""
+        return inflation
+
+
+class LruPolicy (EvictionPolicy):
+    """least recently used"""
+
+    name = "lru"
+
+
+class LfuPolicy (EvictionPolicy):
+    """least frequently used. ties are broken by the atime"""
+
+    name = "lfu"
+    ordersByATime = False
+
+    def priority(self, size, atime, hits, inflation):
+        return hits + atime * 1e-10
+
+
+class GdsfPolicy (EvictionPolicy):
+    """greedy dual size frequency: priority = L + hits * cost / size with
+    L the priority of the last evicted file. the cost of a transfer is
+    the size plus a fixed overhead per file. prefers to keep small and
+    frequently used files, large files stay if they are used often"""
+
+    name = "gdsf"
+    ordersByATime = False
+
+    # fixed cost of a transfer (bytes)
+    FILE_COST = 64 * 1024 * 1024
+
+    def priority(self, size, atime, hits, inflation):
+        size = max(1, size)
+        return inflation + hits * float(size + self.FILE_COST) / size
+
+    def inflation(self, evictedPriority, inflation):
+        return max(inflation, evictedPriority)
+
+
+EVICTION_POLICIES = dict((p.name, p) for p in [ LruPolicy, LfuPolicy, GdsfPolicy ])
+
+def evictionPolicy(name):
+    try:
+        return EVICTION_POLICIES[name.lower()]()
+    except KeyError:
+        warning("unknown eviction policy '%s'. using lru" % name)
+        return LruPolicy()
+
+
 class FileSystem:
 
+    # CacheCleaner running in this process
+    cleaner = None
+
     def __init__(self, config):
         self.config = config
         self.cacheDir = self.getCacheDir()
         self.lsofFailed = False
+        self.manifest = None
+        self.policy = evictionPolicy(config.EVICTION_POLICY)
 
     def getCacheDir(self):
         cacheDir = settings.clientEnvironment().cacheDir(self.config)
@@ -51,6 +134,18 @@ class FileSystem:
             error("cannot get file info for %s: %s" % (filename, str(e)))
             return None
 
+    def logFetch(self, fileinfo):
+        """append the requested file to FETCH_LOG (input for
+        benchmarks/eviction-policies.py)"""
+        if not self.config.FETCH_LOG or fileinfo is None:
+            return
+        try:
+            fp = open(self.config.FETCH_LOG.replace("$(USER)", os.environ.get("USER", "")), "a")
+            fp.write("%d %s %s\n" % (time.time(), fileinfo[1], fileinfo[0]))
+            fp.close()
+        except IOError as e:
+            debug("cannot write fetch log: %s" % str(e))
+
     def getFileServer(self, filename):
         mounts = {}
         for line in open("/proc/mounts").readlines():
@@ -89,9 +184,58 @@ class FileSystem:
             used = int(du[0].split()[0])
         return used
 
+    def getManifest(self):
+        """return the manifest of the cache directory or None if it is
+        not available. the manifest is rebuilt if the last scan is older
+        than MANIFEST_SCAN_INTERVAL"""
+        if self.manifest is None and self.config.USE_MANIFEST:
+            try:
+                self.manifest = CacheManifest(self.cacheDir, self.policy)
+                if time.time() - self.manifest.lastScan() > self.config.MANIFEST_SCAN_INTERVAL:
+                    log("scanning cache directory %s" % self.cacheDir)
+                    self.manifest.scan()
+            except Exception as e:
+                warning("cannot use cache manifest: %s" % str(e))
+                self.config.USE_MANIFEST = False
+                self.manifest = None
+        return self.manifest
+
+    def _updateManifest(self, method, *args):
+        manifest = self.getManifest()
+        if manifest is None:
+            return
+        try:
+            getattr(manifest, method)(*args)
+        except Exception as e:
+            warning("cannot update cache manifest: %s" % str(e))
+
+    def addCachedFile(self, filename, origin):
+        """register a new file in the cache directory"""
+        try:
+            st = os.stat(filename)
+        except OSError as e:
+            debug("cannot stat %s: %s" % (filename, str(e)))
+            return
+        self._updateManifest("add", filename, st.st_size, st.st_atime, origin)
+
+    def removeCachedFile(self, filename):
+        """remove a file from the cache directory"""
+        os.remove(filename)
+        self._updateManifest("remove", filename)
+
+    def usedSpace(self):
+        """space used in the cache directory (bytes)"""
+        manifest = self.getManifest()
+        if manifest is not None:
+            try:
+                return manifest.usedSpace()
+            except Exception as e:
+                warning("cannot read cache manifest: %s" % str(e))
+        return self.diskUsage(self.cacheDir)
+
     def calculateSpaceToFree(self, filesize, destDir, logInfo = False):
         free, total = self.diskFree(destDir)
-        used = self.diskUsage(self.cacheDir)
+        used = self.usedSpace()
         debug("free: %d B = %d MB" % (free, free/(1024*1024)))
         debug("min free: %d B = %d MB" % (self.config.MIN_FREE, self.config.MIN_FREE / (1024*1024)))
         debug("used: %d B = %d MB" % (used, used/(1024*1024)))
@@ -111,7 +255,11 @@ class FileSystem:
         return toFree
 
     def checkFreeSpace(self, filesize, destination):
+        """make sure that filesize bytes can be stored in the cache directory.
+        returns (success, removed), see removeOldFiles"""
         debug("checkFreeSpace: %d, %s" % (filesize, destination))
+        if FileSystem.cleaner is not None and FileSystem.cleaner.reserve(self.cacheDir, filesize):
+            return (True, [])
         destDir = os.path.dirname(destination)
         try:
             toFree = self.calculateSpaceToFree(filesize, destDir)
@@ -121,13 +269,56 @@ class FileSystem:
         # TODO: return toFree
         if toFree > 0:
             r = self.removeOldFiles(toFree, destination)
+            if not r[0] and self.manifest is not None:
+                # the manifest does not know about files removed by other means
+                self._updateManifest("scan")
+                if self.calculateSpaceToFree(filesize, destDir) <= 0:
+                    return (True, r[1])
             if not r[0]:
                 self.calculateSpaceToFree(filesize, destDir, True)
             return r
         else:
             return (True, [])
 
+    def openFiles(self):
+        """return the set of files in the cache directory which are opened
+        or mapped by a process, using a single pass over /proc.
+        returns None if /proc is not available"""
+        if not os.path.isdir("/proc/self/fd"):
+            return None
+        # /proc contains resolved paths
+        realDir = os.path.realpath(self.cacheDir)
+        prefix = realDir + "/"
+        result = set()
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            fdDir = "/proc/%s/fd" % pid
+            try:
+                fds = os.listdir(fdDir)
+            except OSError:
+                continue
+            for fd in fds:
+                try:
+                    target = os.readlink(os.path.join(fdDir, fd))
+                except OSError:
+                    continue
+                if target.startswith(prefix):
+                    result.add(self.cacheDir + target[len(realDir):])
+            try:
+                for line in open("/proc/%s/maps" % pid):
+                    pos = line.find(prefix)
+                    if pos >= 0:
+                        result.add(self.cacheDir + line[pos + len(realDir):].rstrip("\n"))
+            except (IOError, OSError):
+                pass
+        debug("%d open files in %s" % (len(result), self.cacheDir))
+        return result
+
     def isFileOpen(self, filename):
+        openFiles = self.openFiles()
+        if openFiles is not None:
+            return filename in openFiles
         # r = os.popen("/usr/bin/lsof -Fp %s 2> /dev/null" % filename).readlines()
         if self.lsofFailed:
             return True
@@ -142,50 +333,85 @@ class FileSystem:
         else:
             return False
 
-    def isFileOld(self, filename):
-        try:
-            age = int(time.time() - os.path.getatime(filename))
-        except Exception as e:
-            debug("debug cannot stat %s: %s" % (filename, str(e)))
-            return False
-        debug("age of %s: %d => %s" % (filename, age, str(age > self.config.MIN_AGE)))
-        return (age > self.config.MIN_AGE)
-
     def setATime(self, filename):
+        now = time.time()
         try:
-            debug("setAtime(atime=%d, mtime=%f)" % (time.time(), os.path.getmtime(filename)))
-            os.utime(filename, (time.time(), os.path.getmtime(filename)))
+            debug("setAtime(atime=%d, mtime=%f)" % (now, os.path.getmtime(filename)))
+            os.utime(filename, (now, os.path.getmtime(filename)))
         except Exception as e:
             debug("cannot set atime of %s: %s" % (filename, str(e)))
+        if filename.startswith(self.cacheDir):
+            self._updateManifest("touch", filename, now)
 
-    def removeOldFiles(self, spaceToFree, fileToKeep):
-        debug("removeOldFiles: %d, %s" % (spaceToFree, fileToKeep))
+    def _evictionCandidates(self):
+        """iterate over (path, size, atime) of the cached files in the order of eviction"""
+        manifest = self.getManifest()
+        if manifest is not None:
+            for entry in manifest.evictionCandidates():
+                yield entry
+            return
         debug("os.walk: %s" % self.cacheDir)
-        removed = []
+        heap = []
         for root, dirs, files in os.walk(self.cacheDir):
             for name in files:
                 path = os.path.join(root, name)
-                debug(" root, name: " + root + ", " + name)
-                debug(" check file: " + path)
-                if path == fileToKeep or self.isFileOpen(path) or not self.isFileOld(path):
-                    continue
                 try:
-                    size = os.path.getsize(path)
-                    os.remove(path)
-                    removed.append(path)
-                    log("removed " + path)
-                    debug("size = %d" % size)
-                    spaceToFree -= size
-                except Exception as e:
-                    log("cannot remove " + path)
-                if spaceToFree <= 0: break
-            if spaceToFree <= 0: break
-        try:
-            debug("spaceToFree: %d" % int(spaceToFree))
-        except Exception as e:
-            error("unhandled exception: spaceToFree=%s" % str(spaceToFree))
-            return (False, removed)
-        # TODO: send deleted files to the master
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                heap.append((self.policy.priority(st.st_size, st.st_atime, 1, 0), path,
+                             st.st_size, st.st_atime))
+        heapq.heapify(heap)
+        while heap:
+            priority, path, size, atime = heapq.heappop(heap)
+            yield path, size, atime
+
+    def removeOldFiles(self, spaceToFree, fileToKeep):
+        """remove files which are older than MIN_AGE and not in use until
+        spaceToFree bytes are freed. the order is given by EVICTION_POLICY.
+        returns (success, removed) with removed a list of
+        [filename, size, mtime, path] of the removed files"""
+        debug("removeOldFiles: %d, %s" % (spaceToFree, fileToKeep))
+        removed = []
+        openFiles = self.openFiles()
+        maxATime = time.time() - self.config.MIN_AGE
+        for path, size, atime in self._evictionCandidates():
+            if spaceToFree <= 0:
+                break
+            if atime > maxATime:
+                if self.policy.ordersByATime:
+                    break
+                continue
+            debug(" check file: " + path)
+            if path == fileToKeep or CacheManifest.isManifestFile(path):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                debug("file not found: " + path)
+                self._updateManifest("remove", path)
+                continue
+            if st.st_atime > maxATime:
+                # used without cache manager
+                debug("recently used: " + path)
+                self._updateManifest("touch", path, st.st_atime, 0)
+                continue
+            if (openFiles is None and self.isFileOpen(path)) or \
+                    (openFiles is not None and path in openFiles):
+                debug("in use: " + path)
+                continue
+            try:
+                os.remove(path)
+                self._updateManifest("evict", path)
+                # cached files have the path and timestamps of the original file
+                removed.append([ path[len(self.cacheDir):], str(st.st_size),
+                                 str(int(st.st_mtime)), path ])
+                log("removed " + path)
+                debug("size = %d" % st.st_size)
+                spaceToFree -= st.st_size
+            except Exception as e:
+                log("cannot remove " + path)
+        debug("spaceToFree: %d" % int(spaceToFree))
         return ((spaceToFree <= 0), removed)
 
 
@@ -201,7 +427,7 @@ class FileSystem:
             debug("attributes differ. remove. (%s - %s, %s - %s)" % (existingFile[1], fileinfo[1], existingFile[2], fileinfo[2]))
             if not self.isFileOpen(destination):
                 try:
-                    os.remove(destination)
+                    self.removeCachedFile(destination)
                     log("removed " + destination)
                     return (False, True, True)
                 except Exception as e:
@@ -215,6 +441,221 @@ class FileSystem:
             return (True, True, False)
 
 
+class CacheCleaner (threading.Thread):
+    """removes files in the background to keep the usage of the cache
+    directory between two watermarks.
+
+    the limit of the usage is given by MAX_USAGE and MIN_FREE. files are
+    removed if the space left is less than 1 - CLEANER_HIGH_WATERMARK of
+    the space allowed for caching, until 1 - CLEANER_LOW_WATERMARK is left.
+    removed files are reported using report(removed).
+
+    fetches in the same process reserve space using an in-memory
+    counter and do not need to check the disk usage.
+    """
+
+    def __init__(self, config, report):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.config = config
+        self.report = report
+        self.fileSystem = FileSystem(config)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.finished = False
+        # space left until the limit is reached (bytes)
+        self.room = 0
+        self.highWatermark = 0
+
+    def reserve(self, cacheDir, size):
+        """reserve space for a new file. returns False if the space has to
+        be checked (and freed) by the caller"""
+        with self.lock:
+            if cacheDir != self.fileSystem.cacheDir or size > self.room:
+                self.wakeup.set()
+                return False
+            self.room -= size
+            if self.room < self.highWatermark:
+                self.wakeup.set()
+            return True
+
+    def stop(self):
+        self.finished = True
+        self.wakeup.set()
+
+    def run(self):
+        while not self.finished:
+            try:
+                self.clean()
+            except Exception as e:
+                error("cleanup of %s failed: %s" % (self.fileSystem.cacheDir, str(e)))
+            self.wakeup.wait(self.config.CLEANER_INTERVAL)
+            self.wakeup.clear()
+
+    def _room(self):
+        """return (space left until the limit is reached, space allowed for caching)"""
+        fs = self.fileSystem
+        free, total = fs.diskFree(fs.cacheDir)
+        allowed = total * (self.config.MAX_USAGE / 100.0)
+        return int(min(allowed - fs.usedSpace(), free - self.config.MIN_FREE)), allowed
+
+    def clean(self):
+        fs = self.fileSystem
+        if not os.path.isdir(fs.cacheDir):
+            os.makedirs(fs.cacheDir, 0o755)
+        room, allowed = self._room()
+        highWatermark = int((1.0 - self.config.CLEANER_HIGH_WATERMARK) * allowed)
+        if room < highWatermark:
+            toFree = int((1.0 - self.config.CLEANER_LOW_WATERMARK) * allowed) - room
+            log("cleanup of %s: %0.1f MB" % (fs.cacheDir, toFree / (1024.0 * 1024)))
+            ok, removed = fs.removeOldFiles(toFree, None)
+            if removed:
+                self.report(removed)
+            room, allowed = self._room()
+        debug("space left in %s: %d MB" % (fs.cacheDir, room / (1024 * 1024)))
+        with self.lock:
+            self.room = room
+            self.highWatermark = highWatermark
+
+
+class CopyEngine (threading.local):
+    """copies files without external processes.
+
+    the destination is locked (flock, fails if it is locked by another
+    copy), the data is copied with copy_file_range, sendfile, or
+    read/write, whichever is supported by the file systems. the mode,
+    the owner (if permitted), and the timestamps of the source are
+    preserved.
+
+    progress(copied, total) is called at most every progressInterval
+    seconds during a copy. bytes and seconds of the last copy are
+    kept for the transfer rate, separately for each thread.
+    """
+
+    def __init__(self, bufferSize, progress = None, progressInterval = 5.0):
+        self.bufferSize = bufferSize
+        self.progress = progress
+        self.progressInterval = progressInterval
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def rate(self):
+        """transfer rate of the last copy (MB/s)"""
+        return self.bytes / (1024.0 * 1024) / max(self.seconds, 1e-6)
+
+    def rateInfo(self):
+        return "%0.1f MB in %0.1fs, %0.1f MB/s" % (self.bytes / (1024.0 * 1024), self.seconds, self.rate())
+
+    def _open(self, destination):
+        """open and lock the destination. returns the file descriptor"""
+        fd = os.open(destination, os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.ftruncate(fd, 0)
+        except OSError:
+            os.close(fd)
+            raise
+        return fd
+
+    def _reportProgress(self, copied, total, start):
+        self.bytes = copied
+        self.seconds = time.time() - start
+        if self.progress is not None and time.time() - self.lastProgress >= self.progressInterval:
+            self.lastProgress = time.time()
+            self.progress(copied, total)
+
+    def _setMetadata(self, fd, mode, uid, gid, atime, mtime):
+        try:
+            os.fchown(fd, uid, gid)
+        except OSError: pass
+        os.fchmod(fd, mode & 0o7777)
+        os.utime(fd, (atime, mtime))
+
+    def _copyData(self, fin, fout, total, start):
+        copied = 0
+        method = "copy_file_range"
+        while True:
+            try:
+                if method == "copy_file_range":
+                    n = os.copy_file_range(fin, fout, self.bufferSize)
+                elif method == "sendfile":
+                    n = os.sendfile(fout, fin, None, self.bufferSize)
+                else:
+                    data = os.read(fin, self.bufferSize)
+                    n = len(data)
+                    self._write(fout, data)
+            except (OSError, AttributeError) as e:
+                # not supported for these files, fall back
+                if method == "read" or (isinstance(e, OSError) and not e.errno in
+                        (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF)):
+                    raise
+                if copied > 0:
+                    # the offsets have been advanced, continue with read/write
+                    method = "read"
+                else:
+                    method = "sendfile" if method == "copy_file_range" else "read"
+                debug("copy: using %s" % method)
+                continue
+            if n == 0:
+                break
+            copied += n
+            self._reportProgress(copied, total, start)
+        return copied
+
+    def _write(self, fd, data):
+        view = memoryview(data)
+        while view:
+            n = os.write(fd, view)
+            view = view[n:]
+
+    def copyFile(self, source, destination):
+        """returns (success, message)"""
+        start = self.lastProgress = time.time()
+        self.bytes, self.seconds = 0, 0.0
+        try:
+            fin = os.open(source, os.O_RDONLY)
+        except OSError as e:
+            return (False, "cannot open %s: %s" % (source, e.strerror))
+        try:
+            st = os.fstat(fin)
+            fout = self._open(destination)
+            try:
+                copied = self._copyData(fin, fout, st.st_size, start)
+                self._setMetadata(fout, st.st_mode, st.st_uid, st.st_gid, st.st_atime, st.st_mtime)
+            finally:
+                os.close(fout)
+        except OSError as e:
+            return (False, "cannot copy %s to %s: %s" % (source, destination, e.strerror))
+        finally:
+            os.close(fin)
+        self.bytes, self.seconds = copied, time.time() - start
+        return (True, "")
+
+    def copyStream(self, stream, destination, size, mode, atime, mtime):
+        """copy size bytes read from stream (read(n)).
+        returns (success, message)"""
+        start = self.lastProgress = time.time()
+        self.bytes, self.seconds = 0, 0.0
+        copied = 0
+        try:
+            fout = self._open(destination)
+            try:
+                while copied < size:
+                    data = stream.read(min(self.bufferSize, size - copied))
+                    if not data:
+                        return (False, "cannot copy to %s: unexpected end of file" % destination)
+                    self._write(fout, data)
+                    copied += len(data)
+                    self._reportProgress(copied, size, start)
+                self._setMetadata(fout, mode, -1, -1, atime, mtime)
+            finally:
+                os.close(fout)
+        except OSError as e:
+            return (False, "cannot copy to %s: %s" % (destination, e.strerror))
+        self.bytes, self.seconds = copied, time.time() - start
+        return (True, "")
+
+
 class RemoteFileSystem:
 
 
@@ -225,18 +666,25 @@ class RemoteFileSystem:
             self.isFile = False
             self.fileSize = None
             self.mTime = None
+            self.mode = None
 
         def run(self):
             try:
                 self.isFile = os.path.isfile(self.filename)
                 if self.isFile:
-                    self.fileSize = int(os.path.getsize(self.filename))
-                    self.mTime = int(os.path.getmtime(self.filename))
+                    st = os.stat(self.filename)
+                    self.fileSize = int(st.st_size)
+                    self.mTime = int(st.st_mtime)
+                    self.mode = st.st_mode
             except Exception as e:
                 debug("error StatThread: %s" % filename)
 
     def __init__(self, config):
         self.config = config
+        self.engine = CopyEngine(config.COPY_BUFFER, self.reportProgress)
+
+    def reportProgress(self, copied, total):
+        debug("copied %d / %d MB" % (copied / (1024 * 1024), total / (1024 * 1024)))
 
     def isHostAlive(self, host):
         try:
@@ -252,38 +700,26 @@ class RemoteFileSystem:
 
 
     def getFileStat(self, host, filename):
+        """returns (size, mtime, mode), None if the file cannot be accessed"""
         # virtual method
         pass
 
-    def execWithFlock(self, file, cmd):
-        execCmd = '/usr/bin/flock -e -n %s -c "%s" 2>&1' % (file, cmd)
-        debug(execCmd)
-        msg = ""
-        r = False
-        try:
-            fd = os.popen(execCmd)
-            msg = fd.read()
-            r = (fd.close() is None)
-        except Exception as e:
-            msg = "copy failed: str(e)"
-        debug("r=%s, msg=%s" % (str(r), msg))
-        return (r, msg)
-
     def copyFile(self, host, source, destination):
         # virtual method
         pass
 
-    def copyUsingCp(self, source, destination):
-        """ cp -p doesn't handle ACLs correctly
-            therefore we set the mode using chmod. """
-        cmd = '/bin/cp --preserve=ownership,timestamps "%s" "%s"' % (source, destination)
-        r = self.execWithFlock(destination, cmd)
-        cmd = '/bin/chmod -f --reference="%s" "%s"' % (source, destination)
-        debug(cmd)
-        try:
-                os.system(cmd)
-        except Exception as e:
-            debug(str(e))
+    def readRange(self, host, filename, offset, length):
+        """return a stream of length bytes of the file starting at offset.
+        the stream has read(size) and close(), close() can be called by
+        another thread to abort a blocked read"""
+        # virtual method
+        pass
+
+    def copyLocal(self, source, destination):
+        """copy a file of a mounted file system (see CopyEngine)"""
+        debug("copyLocal: %s %s" % (source, destination))
+        r = self.engine.copyFile(source, destination)
+        debug("r=%s, %s" % (str(r), self.engine.rateInfo()))
         if self.config.SLOW_COPY:
             time.sleep(10)
         return r
@@ -307,7 +743,7 @@ class NfsRemoteFileSystem (RemoteFileSystem):
         elif not st.isFile:
             r = None
         else:
-            r = (st.fileSize, st.mTime)
+            r = (st.fileSize, st.mTime, st.mode)
         del st
         return r
 
@@ -320,7 +756,12 @@ class NfsRemoteFileSystem (RemoteFileSystem):
 
 
     def copyFile(self, host, source, destination):
-        return self.copyUsingCp(source, destination)
+        return self.copyLocal(source, destination)
+
+    def readRange(self, host, filename, offset, length):
+        f = open(filename, "rb")
+        f.seek(offset)
+        return f
 
 
 class SshRemoteFileSystem (RemoteFileSystem):
@@ -333,8 +774,6 @@ class SshRemoteFileSystem (RemoteFileSystem):
               "-o StrictHostKeyChecking=no " \
               "-o ControlPath=%s -o ConnectTimeout=7 " % (SSH_SOCKET)
 
-    SCP_OPT = SSH_OPT + " -p -q -B"
-
     MAX_CONN = 5
     # @todo: add client parameter
 
@@ -355,7 +794,7 @@ class SshRemoteFileSystem (RemoteFileSystem):
             return None
         self.connectHost(host)
         cmd =  "/usr/bin/ssh -n -x %s %s " % (self.SSH_OPT, host)
-        cmd += "'/usr/bin/stat --format=\"%%s %%Y\" %s 2>/dev/null'" % filename
+        cmd += shlex.quote("/usr/bin/stat --format='%%s %%Y %%f' %s 2>/dev/null" % shlex.quote(filename))
         debug(cmd)
         b = os.popen(cmd).readlines()
         if len(b) == 0:
@@ -363,12 +802,12 @@ class SshRemoteFileSystem (RemoteFileSystem):
             return None
         else:
             b = b[0].split()
-            return (int(b[0]), int(b[1]))
+            return (int(b[0]), int(b[1]), int(b[2], 16))
 
     def brandFile(self, host, filename):
         self.connectHost(host)
         cmd =  "/usr/bin/ssh -n -x %s %s " % (self.SSH_OPT, host)
-        cmd += "'/usr/bin/touch -a %s 2>/dev/null'" % filename
+        cmd += shlex.quote("/usr/bin/touch -a %s 2>/dev/null" % shlex.quote(filename))
         debug(cmd)
         try:
             os.popen(cmd)
@@ -376,13 +815,243 @@ class SshRemoteFileSystem (RemoteFileSystem):
             debug("cannot set atime of %s over ssh: %s" % (filename, str(e)))
 
     def copyFile(self, host, source, destination):
+        """the remote stat and cat are run in one ssh session, the output
+        is written by the CopyEngine"""
         self.connectHost(host)
-        cmd = "/usr/bin/scp %s %s:%s %s" % (self.SCP_OPT, host, source, destination)
-        r = self.execWithFlock(destination, cmd)
+        cmd = "/usr/bin/stat --format='%%s %%f %%X %%Y' %s && exec /bin/cat %s" % \
+              (shlex.quote(source), shlex.quote(source))
+        debug(cmd)
+        reader = ProcessReader(subprocess.Popen([ "/usr/bin/ssh", "-n", "-x" ] + self.SSH_OPT.split() +
+                                                [ host, cmd ], shell=False, stdout=subprocess.PIPE,
+                                                stderr=subprocess.DEVNULL))
+        try:
+            header = reader.process.stdout.readline().split()
+            if len(header) != 4:
+                r = (False, "cannot get stat of %s:%s" % (host, source))
+            else:
+                size, mode, atime, mtime = int(header[0]), int(header[1], 16), int(header[2]), int(header[3])
+                r = self.engine.copyStream(reader, destination, size, mode, atime, mtime)
+        finally:
+            reader.close()
+        debug("r=%s, %s" % (str(r), self.engine.rateInfo()))
         if self.config.SLOW_COPY:
             time.sleep(10)
         return r
 
+    def readRange(self, host, filename, offset, length):
+        self.connectHost(host)
+        cmd = "/bin/dd if=%s bs=1M iflag=skip_bytes,count_bytes skip=%d count=%d status=none" % \
+              (shlex.quote(filename), offset, length)
+        debug(cmd)
+        process = subprocess.Popen([ "/usr/bin/ssh", "-n", "-x" ] + self.SSH_OPT.split() + [ host, cmd ],
+                                   shell=False, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return ProcessReader(process)
+
+
+class PeerRemoteFileSystem (RemoteFileSystem):
+    """files on other nodes are read from their peer transfer service
+    (cm-client.py --peer, see peer.py) over plain TCP. the data can be
+    checked with a digest (PEER_CHECKSUM).
+    the cache directories are per user, so is the service: the port is
+    derived from the uid of the owner of the cache directory (see port()).
+    if the service is not running or does not serve the file, the file
+    is accessed with SshRemoteFileSystem"""
+
+    def __init__(self, config):
+        RemoteFileSystem.__init__(self, config)
+        self.cachePattern = None
+        self.ssh = None
+
+    @staticmethod
+    def port(config, uid):
+        """port of the peer transfer service of the user uid"""
+        if config.PEER_USER_PORTS > 0:
+            return config.PEER_PORT + uid % config.PEER_USER_PORTS
+        return config.PEER_PORT
+
+    def owner(self, filename):
+        """uid of the user whose cache directory contains filename. the
+        own uid if it cannot be determined"""
+        if self.cachePattern is None:
+            pattern = re.escape(settings.clientEnvironment().cacheDir(self.config).rstrip("/"))
+            pattern = pattern.replace(re.escape("$(USER)"), "(?P<user>[^/]+)")
+            pattern = pattern.replace(re.escape("$(HOST)"), "[^/]+")
+            self.cachePattern = re.compile(pattern + "/")
+        m = self.cachePattern.match(filename)
+        if m is not None and m.groupdict().get("user"):
+            try:
+                return pwd.getpwnam(m.group("user")).pw_uid
+            except KeyError:
+                debug("unknown user %s" % m.group("user"))
+        return os.getuid()
+
+    def address(self, host, filename):
+        """(address, port) of the peer transfer service of host serving
+        filename"""
+        address = self.config.PEER_HOSTS.get(host, host)
+        if ":" in address:
+            address, port = address.rsplit(":", 1)
+            return (address, int(port))
+        return (address, self.port(self.config, self.owner(filename)))
+
+    def fallback(self, host):
+        """the file system used if the peer transfer service of host is
+        not available"""
+        log("peer transfer service of %s not available, using ssh" % host)
+        if self.ssh is None:
+            self.ssh = SshRemoteFileSystem(self.config)
+            self.ssh.engine = self.engine
+        return self.ssh
+
+    @staticmethod
+    def isServed(reply):
+        """False if reply (of request() or read()) means that the service
+        is not available or does not serve the file"""
+        return reply is not None and (reply.type != Message.FILE_NOT_OK or
+                                      Message.PEER_NOT_SERVED not in reply.content)
+
+    def request(self, host, filename, msg):
+        """send msg to the peer transfer service of host. returns the
+        connection and the reply, (None, None) on failure"""
+        try:
+            s = socket.create_connection(self.address(host, filename), self.config.STAT_TIMEOUT)
+        except (socket.error, ValueError) as e:
+            log("cannot connect to %s: %s" % (host, str(e)))
+            return (None, None)
+        s.settimeout(self.config.SOCKET_TIMEOUT)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(s, host)
+        conn.setProtocolVersion(Message.PROTOCOL_V2)
+        reply = None
+        if conn.sendMessage(msg):
+            reply = conn.receiveMessage()
+        if reply is None or reply.type == Message.FILE_NOT_OK:
+            conn.close()
+            return (None, reply)
+        return (conn, reply)
+
+    def read(self, host, filename, offset, length):
+        """returns (PeerStream, PEER_FILE reply), (None, FILE_NOT_OK reply)
+        or (None, None)"""
+        debug("peer read %s:%s (%d bytes at %d)" % (host, filename, length, offset))
+        digest = self.config.PEER_CHECKSUM if length != 0 else ""
+        conn, reply = self.request(host, filename, Message(Message.PEER_READ, [ filename, str(offset),
+                                                                                str(length), digest ]))
+        if conn is None:
+            return (None, reply)
+        if reply.type != Message.PEER_FILE:
+            error("unexpected message: %s" % str(reply))
+            conn.close()
+            return (None, None)
+        return (PeerStream(conn, int(reply.content[4]), digest), reply)
+
+    def getFileStat(self, host, filename):
+        stream, reply = self.read(host, filename, 0, 0)
+        if stream is None:
+            if not self.isServed(reply):
+                return self.fallback(host).getFileStat(host, filename)
+            log("cannot get stat of %s:%s" % (host, filename))
+            return None
+        stream.close()
+        return (int(reply.content[0]), int(reply.content[3]), int(reply.content[1]))
+
+    def brandFile(self, host, filename):
+        conn, reply = self.request(host, filename, Message(Message.PEER_TOUCH, [ filename ]))
+        if conn is None:
+            if not self.isServed(reply):
+                self.fallback(host).brandFile(host, filename)
+            else:
+                debug("cannot set atime of %s:%s" % (host, filename))
+        else:
+            conn.close()
+
+    def copyFile(self, host, source, destination):
+        stream, reply = self.read(host, source, 0, -1)
+        if stream is None:
+            if not self.isServed(reply):
+                return self.fallback(host).copyFile(host, source, destination)
+            return (False, "cannot read %s:%s" % (host, source))
+        try:
+            size, mode, atime, mtime = [ int(i) for i in reply.content[:4] ]
+            r = self.engine.copyStream(stream, destination, size, mode, atime, mtime)
+        finally:
+            stream.close()
+        debug("r=%s, %s" % (str(r), self.engine.rateInfo()))
+        if self.config.SLOW_COPY:
+            time.sleep(10)
+        return r
+
+    def readRange(self, host, filename, offset, length):
+        stream, reply = self.read(host, filename, offset, length)
+        if stream is None:
+            if not self.isServed(reply):
+                return self.fallback(host).readRange(host, filename, offset, length)
+            raise IOError("cannot read %s:%s" % (host, filename))
+        return stream
+
+
+class PeerStream:
+    """data of a PEER_FILE reply. the digest sent after the data is
+    checked when the last byte has been read. close() can be called by
+    another thread to abort a blocked read"""
+
+    def __init__(self, connection, length, digest):
+        self.connection = connection
+        self.remaining = length
+        self.hash = hashlib.new(digest) if digest and length > 0 else None
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        if size <= 0:
+            return b""
+        data = bytearray(size)
+        view = memoryview(data)
+        n = 0
+        while n < size:
+            r = self.connection.receiveInto(view[n:])
+            if r == 0:
+                break
+            n += r
+        view.release()
+        if n < size:
+            del data[n:]
+        self.remaining -= n
+        if self.hash is not None:
+            self.hash.update(data)
+            if self.remaining == 0:
+                self._checkDigest()
+        return data
+
+    def _checkDigest(self):
+        msg = self.connection.receiveMessage()
+        if msg is None or msg.type != Message.PEER_DIGEST or msg.content[0] != self.hash.hexdigest():
+            raise IOError(errno.EIO, "checksum mismatch")
+
+    def close(self):
+        try:
+            self.connection.conn.shutdown(socket.SHUT_RDWR)
+        except socket.error: pass
+        self.connection.close()
+
+
+class ProcessReader:
+    """output stream of a process. close() terminates the process"""
+
+    def __init__(self, process):
+        self.process = process
+
+    def read(self, size):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.kill()
+            except OSError: pass
+        self.process.wait()
+        self.process.stdout.close()
+
+
 class SshMasterConnection:
     SSH_MASTER = [ "/usr/bin/ssh", "-M", "-N" ] + SshRemoteFileSystem.SSH_OPT.split()
     def __init__(self, host):
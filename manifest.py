@@ -0,0 +1,163 @@
+"""
+manifest of the files in a local cache directory
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from cmlogging import *
+
+
+class CacheManifest:
+    """records path, size, atime, number of accesses and origin of the
+    cached files.
+
+    the manifest is a SQLite database in the cache directory, shared
+    by all clients using the cache directory. it is updated on every
+    copy and removal, the used space is maintained by triggers. files
+    created or removed by other means are found by a scan of the cache
+    directory, which replaces the content of the manifest.
+
+    the eviction priority of each file is computed by the eviction
+    policy (see filesystem.py) when the file is added or accessed.
+    """
+
+    FILENAME = ".cm-manifest"
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, "
+        "atime REAL, origin TEXT, hits INTEGER, priority REAL)",
+        "CREATE INDEX IF NOT EXISTS files_priority ON files (priority, path)",
+        "CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value)",
+        "INSERT OR IGNORE INTO info VALUES ('used', 0)",
+        "INSERT OR IGNORE INTO info VALUES ('scanned', 0)",
+        "INSERT OR IGNORE INTO info VALUES ('policy', '')",
+        "INSERT OR IGNORE INTO info VALUES ('inflation', 0)",
+        "CREATE TRIGGER IF NOT EXISTS files_insert AFTER INSERT ON files BEGIN "
+        "UPDATE info SET value = value + NEW.size WHERE key = 'used'; END",
+        "CREATE TRIGGER IF NOT EXISTS files_delete AFTER DELETE ON files BEGIN "
+        "UPDATE info SET value = value - OLD.size WHERE key = 'used'; END",
+        "CREATE TRIGGER IF NOT EXISTS files_update AFTER UPDATE OF size ON files BEGIN "
+        "UPDATE info SET value = value - OLD.size + NEW.size WHERE key = 'used'; END"
+    ]
+
+    def __init__(self, cacheDir, policy, timeout = 30):
+        self.cacheDir = cacheDir
+        self.filename = os.path.join(cacheDir, self.FILENAME)
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.filename, timeout = timeout, check_same_thread = False,
+                                  isolation_level = None)
+        # the manifest can be rebuilt by a scan, no need to wait for the disk
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.create_function("priority", 4, policy.priority, deterministic = True)
+        with self.lock, self.db:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+        if self._info("policy") != policy.name:
+            self.reprioritize()
+
+    @staticmethod
+    def isManifestFile(filename):
+        return os.path.basename(filename).startswith(CacheManifest.FILENAME)
+
+    def close(self):
+        self.db.close()
+
+    def _execute(self, statement, args = ()):
+        with self.lock, self.db:
+            return self.db.execute(statement, args).fetchall()
+
+    def _info(self, key):
+        return self._execute("SELECT value FROM info WHERE key = ?", (key,))[0][0]
+
+    def add(self, path, size, atime, origin):
+        self._execute("INSERT INTO files SELECT ?1, ?2, ?3, ?4, 1, priority(?2, ?3, 1, value) "
+                      "FROM info WHERE key = 'inflation' ON CONFLICT (path) DO UPDATE SET "
+                      "size = excluded.size, atime = excluded.atime, origin = excluded.origin, "
+                      "hits = 1, priority = excluded.priority",
+                      (path, size, atime, origin))
+
+    def remove(self, path):
+        self._execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def evict(self, path):
+        """remove an evicted file. updates the inflation value of the policy"""
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            row = self.db.execute("SELECT priority FROM files WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                return
+            inflation = self.db.execute("SELECT value FROM info WHERE key = 'inflation'").fetchone()[0]
+            self.db.execute("UPDATE info SET value = ? WHERE key = 'inflation'",
+                            (self.policy.inflation(row[0], inflation),))
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def touch(self, path, atime, hits = 1):
+        """record an access of the file (hits = 0: update atime only)"""
+        self._execute("UPDATE files SET atime = ?1, hits = hits + ?2, priority = "
+                      "priority(size, ?1, hits + ?2, (SELECT value FROM info WHERE key = 'inflation')) "
+                      "WHERE path = ?3", (atime, hits, path))
+
+    def reprioritize(self):
+        """recompute the priorities after a change of the eviction policy"""
+        debug("eviction policy: %s" % self.policy.name)
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("UPDATE info SET value = 0 WHERE key = 'inflation'")
+            self.db.execute("UPDATE files SET priority = priority(size, atime, hits, 0)")
+            self.db.execute("UPDATE info SET value = ? WHERE key = 'policy'", (self.policy.name,))
+
+    def usedSpace(self):
+        """total size of the cached files (bytes)"""
+        return self._info("used")
+
+    def lastScan(self):
+        return self._info("scanned")
+
+    def __len__(self):
+        return self._execute("SELECT COUNT(*) FROM files")[0][0]
+
+    def files(self):
+        """return (path, size, atime, origin, hits) of all files in the order of eviction"""
+        return self._execute("SELECT path, size, atime, origin, hits FROM files ORDER BY priority, path")
+
+    def evictionCandidates(self, batchSize = 1000):
+        """iterate over (path, size, atime) of all files in the order of eviction.
+        the files are read in batches using the priority index"""
+        priority, path = float("-inf"), ""
+        while True:
+            rows = self._execute("SELECT path, size, atime, priority FROM files "
+                                 "WHERE (priority, path) > (?, ?) ORDER BY priority, path LIMIT ?",
+                                 (priority, path, batchSize))
+            for row in rows:
+                yield row[:3]
+            if len(rows) < batchSize:
+                break
+            path, size, atime, priority = rows[-1]
+
+    def scan(self):
+        """replace the content of the manifest by the files found in the cache directory"""
+        start = time.time()
+        entries = []
+        for root, dirs, files in os.walk(self.cacheDir):
+            for name in files:
+                path = os.path.join(root, name)
+                if self.isManifestFile(path):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, st.st_size, st.st_atime, path[len(self.cacheDir):]))
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            # keep the number of accesses of known files
+            hits = dict(self.db.execute("SELECT path, hits FROM files"))
+            inflation = self.db.execute("SELECT value FROM info WHERE key = 'inflation'").fetchone()[0]
+            self.db.execute("DELETE FROM files")
+            self.db.executemany("INSERT INTO files VALUES (?1, ?2, ?3, ?4, ?5, priority(?2, ?3, ?5, ?6))",
+                                [ e + (hits.get(e[0], 1), inflation) for e in entries ])
+            self.db.execute("UPDATE info SET value = ? WHERE key = 'scanned'", (start,))
+        debug("manifest scan: %d files in %0.2fs" % (len(entries), time.time() - start))
@@ -0,0 +1,160 @@
+"""
+peer transfer service for the cache manager client.
+serves the files of the local cache directory to other nodes over
+plain TCP (see filesystem.PeerRemoteFileSystem)
+"""
+
+import os
+import time
+import fcntl
+import socket
+import hashlib
+import threading
+from shared import Message, Connection
+from cmlogging import *
+from filesystem import FileSystem, PeerRemoteFileSystem
+
+
+class PeerThread (threading.Thread):
+    """handle the requests of one connection"""
+
+    BLOCK = 1024 * 1024
+
+    def __init__(self, server, conn):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = server
+        self.conn = conn
+
+    def run(self):
+        try:
+            while True:
+                msg = self.conn.receiveMessage()
+                if msg is None:
+                    break
+                if msg.type == Message.PEER_READ:
+                    ok = self.read(*msg.content[:4])
+                elif msg.type == Message.PEER_TOUCH:
+                    ok = self.touch(msg.content[0])
+                else:
+                    error("unexpected message: %s" % str(msg))
+                    break
+                if not ok:
+                    break
+        except Exception as e:
+            debug("peer connection failed: %s" % str(e))
+        finally:
+            self.conn.close()
+
+    def touch(self, filename):
+        path = self.server.resolve(filename)
+        if path is None:
+            debug("cannot set atime of %s: not in %s" % (filename, self.server.root))
+            return self.conn.sendMessage(Message(Message.FILE_NOT_OK, [ Message.PEER_NOT_SERVED ]))
+        try:
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except OSError as e:
+            debug("cannot set atime of %s: %s" % (filename, str(e)))
+            return self.conn.sendMessage(Message(Message.FILE_NOT_OK))
+        return self.conn.sendMessage(Message(Message.FILE_OK))
+
+    def read(self, filename, offset, length, digest):
+        """send length bytes of the file starting at offset. the file is
+        share-locked, files being copied to the cache are not sent"""
+        offset, length = int(offset), int(length)
+        path = self.server.resolve(filename)
+        if path is None:
+            warning("rejected request for %s (not in %s)" % (filename, self.server.root))
+            return self.conn.sendMessage(Message(Message.FILE_NOT_OK, [ Message.PEER_NOT_SERVED ]))
+        try:
+            f = open(path, "rb")
+        except OSError as e:
+            debug("cannot open %s: %s" % (path, e.strerror))
+            return self.conn.sendMessage(Message(Message.FILE_NOT_OK))
+        try:
+            st = os.fstat(f.fileno())
+            if length < 0:
+                length = st.st_size - offset
+            length = max(0, min(length, st.st_size - offset))
+            try:
+                if length > 0:
+                    fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                h = hashlib.new(digest) if digest and length > 0 else None
+            except (OSError, ValueError) as e:
+                debug("cannot read %s: %s" % (path, str(e)))
+                return self.conn.sendMessage(Message(Message.FILE_NOT_OK))
+            if not self.conn.sendMessage(Message(Message.PEER_FILE, [ str(st.st_size), str(st.st_mode),
+                                                                      str(int(st.st_atime)),
+                                                                      str(int(st.st_mtime)),
+                                                                      str(length) ])):
+                return False
+            if length == 0:
+                return True
+            debug("sending %s (%d bytes at %d)" % (path, length, offset))
+            if h is None:
+                sent = self.conn.conn.sendfile(f, offset, length)
+            else:
+                sent = self._sendHashed(f, offset, length, h)
+            if sent < length:
+                # the file has been truncated, the client detects the short read
+                return False
+            if h is not None:
+                return self.conn.sendMessage(Message(Message.PEER_DIGEST, [ h.hexdigest() ]))
+            return True
+        finally:
+            f.close()
+
+    def _sendHashed(self, f, offset, length, h):
+        sent = 0
+        while sent < length:
+            data = os.pread(f.fileno(), min(self.BLOCK, length - sent), offset + sent)
+            if not data:
+                break
+            h.update(data)
+            self.conn.conn.sendall(data)
+            sent += len(data)
+        return sent
+
+
+class PeerServer:
+    """serve the files below PEER_ROOT (default: the cache directory) on
+    the port of the user (see PeerRemoteFileSystem.port). requests for
+    other files are answered with FILE_NOT_OK [PEER_NOT_SERVED], clients
+    then use ssh. the service has no authentication and should only be
+    run on trusted networks.
+    """
+
+    QUEUE = 64
+
+    def __init__(self, config):
+        self.config = config
+        self.port = PeerRemoteFileSystem.port(config, os.getuid())
+        self.root = os.path.realpath(config.PEER_ROOT or FileSystem(config).cacheDir)
+
+    def resolve(self, filename):
+        """real path of filename, None if it is not below the root"""
+        path = os.path.realpath(filename)
+        if path.startswith(self.root.rstrip(os.sep) + os.sep):
+            return path
+        return None
+
+    def serve(self):
+        serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            serverSocket.bind(("", self.port))
+        except socket.error as e:
+            error("cannot bind port %d: %s" % (self.port, str(e)))
+            return False
+        serverSocket.listen(self.QUEUE)
+        log("serving %s on port %d" % (self.root, self.port))
+        try:
+            while True:
+                conn, address = serverSocket.accept()
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                connection = Connection(conn, address)
+                connection.setProtocolVersion(Message.PROTOCOL_V2)
+                PeerThread(self, connection).start()
+        finally:
+            serverSocket.close()
+        return True
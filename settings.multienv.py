@@ -63,6 +63,35 @@ class ClientDefaultConfiguration (Configuration):
     """ minimum age (in terms of atime) of a file to be deleted (seconds) """
     MIN_AGE             = 24 * 60 * 60
 
+    """ keep track of the cached files in a manifest in the cache directory
+        instead of running du to get the used disk space """
+    USE_MANIFEST        = True
+
+    """ interval between scans of the cache directory, which rebuild the
+        manifest (seconds) """
+    MANIFEST_SCAN_INTERVAL = 24 * 60 * 60
+
+    """ interval between cleanups of the cache directory by the node agent
+        (cm-client.py --agent) (seconds). 0: no cleanup in the background """
+    CLEANER_INTERVAL    = 60
+
+    """ the node agent starts to remove files if the used space exceeds
+        this fraction of the space available for caching (see MAX_USAGE
+        and MIN_FREE) ... """
+    CLEANER_HIGH_WATERMARK = 0.95
+
+    """ ... and removes files until the used space is below this fraction """
+    CLEANER_LOW_WATERMARK  = 0.85
+
+    """ order in which cached files are deleted: "lru" (least recently used),
+        "lfu" (least frequently used), "gdsf" (greedy dual size frequency,
+        prefers to delete large and rarely used files) """
+    EVICTION_POLICY     = "lru"
+
+    """ file to which each requested file is appended as "time size filename"
+        (see benchmarks/eviction-policies.py). empty: disabled """
+    FETCH_LOG           = ""
+
     """ time out for the connection to the master (seconds) """
     SOCKET_TIMEOUT      = 2 * 60.0
 
@@ -72,9 +101,70 @@ class ClientDefaultConfiguration (Configuration):
     """ ignore special meaning of bundle archives (*.bundle) """
     IGNORE_BUNDLE       = False
 
+    """ number of parallel transfers for bundle archives and batch requests
+        (see also cm-client.py --jobs) """
+    FETCH_JOBS          = 4
+
+    """ priority class of the requests (see PRIORITY_CLASSES of the server,
+        cm-client.py --priority) """
+    PRIORITY            = "normal"
+
+    """ size of the parts of a file copied from several nodes at once
+        (see MAX_STRIPE_SOURCES of the server) (bytes) """
+    STRIPE_CHUNK        = 64 * 1024 * 1024
+
+    """ the parts of a striped copy from a node which makes no progress
+        for this time are copied from the other nodes (seconds) """
+    STRIPE_STALL_TIMEOUT = 60
+
+    """ buffer size of file copies (bytes) """
+    COPY_BUFFER         = 16 * 1024 * 1024
+
+    """ access to copies on other nodes: "ssh" (scp), "nfs" (mounted file
+        system) or "peer" (peer transfer service, see PEER_PORT)
+        (see environment.py) """
+    REMOTE_FILE_SYSTEM  = "ssh"
+
+    """ port number of the peer transfer service (cm-client.py --peer) """
+    PEER_PORT           = 10323
+
+    """ the cache directories are per user, so is the peer transfer
+        service: the service of a user listens on
+        PEER_PORT + uid % PEER_USER_PORTS. clients derive the user from
+        the cache directory of the file. files which are not served (e.g.
+        no service or a colliding uid) are accessed with ssh.
+        0: one service on PEER_PORT """
+    PEER_USER_PORTS     = 1000
+
+    """ address of the peer transfer service of hosts, as "address" or
+        "address:port" by host name. hosts not listed use their name and
+        the port of the user (see PEER_USER_PORTS) """
+    PEER_HOSTS          = {}
+
+    """ directory served by the peer transfer service. empty: the cache
+        directory """
+    PEER_ROOT           = ""
+
+    """ digest (hashlib algorithm, e.g. "md5") which checks files copied
+        by the peer transfer service. empty: no check """
+    PEER_CHECKSUM       = ""
+
     """ slow down file copies (for regression tests only) """
     SLOW_COPY           = False
 
+    """ highest protocol version used. 1 skips the protocol negotiation
+        (for servers older than the protocol version 2), 2: binary lengths
+        and UTF-8 file names, 3: user and priority class of the requests
+        (PRIORITY), 4: copies from several nodes at once """
+    PROTOCOL_VERSION    = 4
+
+    """ time to wait for the reply to the protocol negotiation (seconds) """
+    HANDSHAKE_TIMEOUT   = 5
+
+    """ time after which idle server connections of the node agent
+        (cm-client.py --agent) are closed (seconds) """
+    AGENT_MAX_IDLE      = 10 * 60
+
 
 class ServerConfiguration (Configuration):
     """ default configuration for CacheManager server"""
@@ -97,6 +187,21 @@ class ServerConfiguration (Configuration):
     """ interval between database writes (seconds) """
     DB_SAVE_INTERVAL    = 60 * 60
 
+    """ interval between commits of the database log (seconds).
+        changes of the database are appended to DB_FILE.log.<n>.
+        0: no log, changes are saved every DB_SAVE_INTERVAL only """
+    DB_LOG_COMMIT_INTERVAL = 1.0
+
+    """ size of the database log which triggers a database write (bytes) """
+    DB_LOG_MAX_SIZE     = 256 * 1024 * 1024
+
+    """ write the database in a forked process. the database is locked
+        only during fork(), otherwise while copying all records """
+    DB_FORK_WRITER      = True
+
+    """ number of independently locked parts of the database """
+    DB_SHARDS           = 16
+
     """ interval between statistics writes (seconds) """
     STAT_INTERVAL       = 60 * 60
 
@@ -112,6 +217,61 @@ class ServerConfiguration (Configuration):
     """ time a client has to wait before next copy attempt (seconds) """
     CLIENT_WAIT         = 10
 
+    """ maximum time a request waits in the queue for a copy slot (seconds).
+        has to be less than SOCKET_TIMEOUT of the clients. 0: no queue """
+    QUEUE_WAIT          = 60
+
+    """ maximum number of parallel transfers from/to a host used by one user.
+        0: no limit """
+    MAX_COPY_USER       = 0
+
+    """ MAX_COPY_USER of individual users, e.g. { "alice" : 10 }.
+        the user name is sent by the client and not verified, users are
+        distinguished per node """
+    USER_MAX_COPY       = {}
+
+    """ maximum number of parallel transfers from/to a host used by all
+        users of one client node. 0: no limit """
+    MAX_COPY_CLIENT     = 0
+
+    """ priority classes of the requests, highest priority first """
+    PRIORITY_CLASSES    = [ "high", "normal", "low" ]
+
+    """ priority class of requests without class """
+    DEFAULT_PRIORITY    = "normal"
+
+    """ hosts (short names) allowed to request a class higher than
+        DEFAULT_PRIORITY, e.g. { "high" : [ "node1" ] }. the requests of
+        other hosts get DEFAULT_PRIORITY """
+    PRIORITY_HOSTS      = {}
+
+    """ requests for a file copied from the file server by another client
+        wait for this copy and use it or the copies made from it """
+    COALESCE_REQUESTS   = True
+
+    """ distribution of a file requested by many nodes.
+        random: requests finding busy node copies read the file from the
+        file server, unless it has just been copied from there.
+        tree: while the file is copied, requests finding busy node copies
+        wait for the next copy that finishes """
+    DISTRIBUTION        = "random"
+
+    """ maximum number of nodes a file is copied from at once (striped
+        copy, clients with protocol version 4). 1: disabled """
+    MAX_STRIPE_SOURCES  = 1
+
+    """ minimum size of files copied from several nodes (bytes) """
+    STRIPE_MIN_SIZE     = 1024 ** 3
+
     """ time after a record in the database is deleted (seconds) """
     MAX_AGE             = 60 * 60 * 24 * 14
 
+    """ hosts (short names) allowed to remove the copies of other hosts and
+        the files below a prefix from the database. other clients may only
+        remove their own copies """
+    ADMIN_HOSTS         = []
+
+    """ client connection handling: "threads" (one thread per connection)
+        or "async" (single event loop) """
+    SERVER_MODE         = "threads"
+
@@ -3,16 +3,109 @@ network communication classes, configuration and auxilary functions
 for cm-client.py and cm-server.py
 """
 
+import os
+import stat
+import socket
+import struct
+import threading
 from cmlogging import *
 
 __version__ = "$Rev: 821 $"
 __author__  = "rybach@cs.rwth-aachen.de (David Rybach)"
 __copyright__ = "Copyright 2012, RWTH Aachen University"
 
+def encodeVarint(value, buffer):
+    """append value as unsigned LEB128 varint to buffer"""
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def isPrivateDir(path):
+    """path is a directory (not a link) owned by the user and
+    not accessible by others"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not (st.st_mode & 0o077)
+
+
+def agentSocket(create = False):
+    """path of the Unix socket of the node agent (cm-client.py --agent):
+    CM_AGENT_SOCKET or a socket in a directory accessible by the user
+    only, $XDG_RUNTIME_DIR or /tmp/cm-agent-<uid>. the latter is created
+    if create is True. returns None if there is no such directory"""
+    if os.getenv("CM_AGENT_SOCKET"):
+        return os.getenv("CM_AGENT_SOCKET")
+    runtimeDir = os.getenv("XDG_RUNTIME_DIR")
+    if runtimeDir and isPrivateDir(runtimeDir):
+        return os.path.join(runtimeDir, "cm-agent.socket")
+    directory = "/tmp/cm-agent-%d" % os.getuid()
+    if create:
+        try:
+            os.mkdir(directory, 0o700)
+        except OSError:
+            pass
+    if not isPrivateDir(directory):
+        if create:
+            error("%s is not a private directory of the user" % directory)
+        return None
+    return os.path.join(directory, "agent.socket")
+
+
+def peerUid(sock):
+    """uid of the process connected to a Unix socket, None if unknown"""
+    try:
+        pid, uid, gid = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                            struct.calcsize("3i")))
+    except (AttributeError, socket.error):
+        return None
+    return uid
+
+
 class Message:
+    """protocol messages.
+
+    protocol version 1: 2 digit ASCII message type, each part as
+    4 digit ASCII length followed by the ASCII string. the number of
+    parts is given by the message type.
+
+    protocol version 2: varint message type, varint number of parts,
+    each part as varint length followed by the UTF-8 encoded string.
+    messages may have more parts than required by version 1 (optional
+    parts), message types with a variable number of parts are available
+    in version 2 only.
+
+    protocol version 3: version 2 with REQUEST_CLASS.
+
+    protocol version 4: version 3 with COPY_FROM_NODES. the replies
+    COPY_OK and COPY_FAILED list the invalid sources as optional parts.
+
+    the version is negotiated using HELLO, which is sent in version 1
+    format. peers which do not send HELLO use version 1.
+
+    the peer transfer service (peer.py) uses version 2 without
+    negotiation. the data of PEER_FILE follows the message unframed.
+    FILE_NOT_OK with PEER_NOT_SERVED means that the file is not below the
+    served directory (e.g. the cache of another user).
+    """
     SIZE_MSG_TYPE = 2
     SIZE_STRLEN   = 4
 
+    PROTOCOL_V1      = 1
+    PROTOCOL_V2      = 2
+    PROTOCOL_V3      = 3
+    PROTOCOL_V4      = 4
+    PROTOCOL_VERSION = PROTOCOL_V4
+    ENCODING         = 'utf-8'
+    # maximum size of the content of a message (bytes). the connection
+    # is closed if a received message exceeds it
+    MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+    # maximum number of bytes of a length (64 bit value)
+    MAX_VARINT_SIZE  = 10
+
     REQUEST_FILE     = 1
     CHECK_LOCAL      = 2
     CHECK_REMOTE     = 3
@@ -32,15 +125,55 @@ class Message:
     GET_LOCATIONS    = 17
     IS_ACTIVE        = 18
     PING             = 19
+    HELLO            = 20
+    REQUEST_FILES      = 21
+    GET_LOCATIONS_MANY = 22
+    FETCH_PLAN         = 23
+    FETCH_RESULT       = 24
+    LOCATIONS          = 25
+    INVALID_COPY       = 26
+    AGENT_REQUEST      = 27
+    AGENT_RESULT       = 28
+    DELETED_COPIES     = 29
+    HOST_FILES         = 30
+    REMOVE_HOST        = 31
+    HOST_USAGE         = 32
+    PREFIX_FILES       = 33
+    REMOVE_PREFIX      = 34
+    REQUEST_CLASS      = 35
+    COPY_FROM_NODES    = 36
+    PEER_READ          = 37
+    PEER_FILE          = 38
+    PEER_DIGEST        = 39
+    PEER_TOUCH         = 40
+
+    # actions of FETCH_PLAN
+    PLAN_LOCAL    = "local"
+    PLAN_NODE     = "node"
+    PLAN_SERVER   = "server"
+    PLAN_WAIT     = "wait"
+    PLAN_FALLBACK = "fallback"
 
+    # results of FETCH_RESULT
+    RESULT_OK      = "ok"
+    RESULT_FAILED  = "failed"
+    RESULT_INVALID = "invalid"
+
+    # optional part of FILE_NOT_OK sent by the peer transfer service
+    PEER_NOT_SERVED = "not served"
+
+    # (minimum) number of parts. None: variable, protocol version 2 only
     nMessageParts = { REQUEST_FILE     : 6 ,
                       CHECK_LOCAL      : 1 ,
                       CHECK_REMOTE     : 2 ,
                       FILE_OK          : 0 ,
+                      # [PEER_NOT_SERVED] (optional, peer transfer service)
                       FILE_NOT_OK      : 0 ,
                       COPY_FROM_NODE   : 2 ,
                       COPY_FROM_SERVER : 0 ,
+                      # [destination, (invalid host, path)*]
                       COPY_OK          : 1 ,
+                      # [(invalid host, path)*]
                       COPY_FAILED      : 0 ,
                       FALLBACK         : 0 ,
                       HAVE_FILE        : 4 ,
@@ -51,47 +184,235 @@ class Message:
                       KEEP_ALIVE       : 0 ,
                       GET_LOCATIONS    : 4 ,
                       IS_ACTIVE        : 1 ,
-                      PING             : 0
+                      PING             : 0 ,
+                      HELLO            : 1 ,
+                      # [locateLimit, parallel, (filename, size, mtime, fileserver, destination)*]
+                      REQUEST_FILES      : None ,
+                      # [locateLimit, (filename, size, mtime)*]
+                      GET_LOCATIONS_MANY : None ,
+                      # [index, action, (host, path)]
+                      FETCH_PLAN         : None ,
+                      # [index, result, destination]
+                      FETCH_RESULT       : None ,
+                      # [index, (host, path, isLocal)*]
+                      LOCATIONS          : None ,
+                      # [filename, size, mtime, host, path]
+                      INVALID_COPY       : None ,
+                      # [argument*] (cm-client.py to node agent)
+                      AGENT_REQUEST      : None ,
+                      # [exit status, stdout, stderr]
+                      AGENT_RESULT       : 3 ,
+                      # [(filename, size, mtime, path)*]
+                      DELETED_COPIES     : None ,
+                      # request: [host], reply: [(filename, path, size, mtime)*]
+                      HOST_FILES         : None ,
+                      # request: [host], reply: [number of removed locations]
+                      REMOVE_HOST        : None ,
+                      # request: [], reply: [(host, locations, bytes)*]
+                      HOST_USAGE         : None ,
+                      # request: [prefix], reply: [(filename, locations)*]
+                      PREFIX_FILES       : None ,
+                      # request: [prefix], reply: [number of removed files]
+                      REMOVE_PREFIX      : None ,
+                      # [user, priority class] of the following requests
+                      REQUEST_CLASS      : 2 ,
+                      # [(host, path)*] sources of a striped copy
+                      COPY_FROM_NODES    : None ,
+                      # [path, offset, length, digest] length -1: until the end
+                      # of the file, 0: stat only. digest: hashlib algorithm or ""
+                      PEER_READ          : 4 ,
+                      # [size, mode, atime, mtime, length] followed by length bytes
+                      # and PEER_DIGEST if requested
+                      PEER_FILE          : 5 ,
+                      # [hex digest of the data of PEER_FILE]
+                      PEER_DIGEST        : 1 ,
+                      # [path] set the access time, reply: FILE_OK or FILE_NOT_OK
+                      PEER_TOUCH         : 1
                     }
 
     def __init__(self, type, content = []):
-        assert(Message.nMessageParts[type] == len(content))
+        nParts = Message.nMessageParts[type]
+        assert(nParts is None or nParts <= len(content))
         self.type = type
         self.content = content
 
     def __str__(self):
         return str([self.type, self.content])
 
+    def serialize(self, version = PROTOCOL_V1):
+        """return the wire format of the message as a single buffer"""
+        if version == Message.PROTOCOL_V1:
+            return self._serializeV1()
+        else:
+            return self._serializeV2()
+
+    def _serializeV1(self):
+        nParts = Message.nMessageParts[self.type]
+        if nParts is None:
+            raise ValueError("message type %d requires protocol version 2" % self.type)
+        buffer = bytearray(("%%0%dd" % Message.SIZE_MSG_TYPE) % self.type, 'ascii')
+        # optional parts are not supported
+        for m in self.content[:nParts]:
+            m = m.encode('ascii')
+            l = ("%%0%dd" % Message.SIZE_STRLEN) % len(m)
+            if len(l) > Message.SIZE_STRLEN:
+                raise ValueError("message part exceeds %d bytes" % (10**Message.SIZE_STRLEN - 1))
+            buffer += l.encode('ascii')
+            buffer += m
+        return buffer
+
+    def _serializeV2(self):
+        buffer = bytearray()
+        encodeVarint(self.type, buffer)
+        encodeVarint(len(self.content), buffer)
+        for m in self.content:
+            m = m.encode(Message.ENCODING, 'surrogateescape')
+            encodeVarint(len(m), buffer)
+            buffer += m
+        return buffer
+
+    @staticmethod
+    def create(msgType, content):
+        """create a received message. returns None for
+        unknown message types or missing parts"""
+        try:
+            nParts = Message.nMessageParts[msgType]
+        except KeyError:
+            error("unknown message type: '%d'" % msgType)
+            return None
+        if nParts is not None and len(content) < nParts:
+            error("message type %d: %d parts, expected %d" % (msgType, len(content), nParts))
+            return None
+        return Message(msgType, content)
+
 
 class Connection:
+    """message transfer on a blocking socket.
+
+    incoming data is read with recv_into into a reusable buffer, which
+    usually holds several message fields (or messages) after one call.
+    fields are decoded directly from the buffer. outgoing messages are
+    sent using a single sendall call. messages may be sent from several
+    threads.
+    """
+
+    BUFFER_SIZE = 64 * 1024
 
     def __init__(self, socket, address = ""):
         self.conn = socket
         self.address = address
+        self.buffer = bytearray(self.BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.version = Message.PROTOCOL_V1
+        self.sendLock = threading.Lock()
 
     def __del__(self):
         self.conn.close()
 
-    def _readAll(self, size):
-        # debug("_readAll(%d)" % size)
-        result = ""
-        while size > 0:
+    def _fill(self, size):
+        """make sure that at least size bytes are available in the buffer"""
+        if self.start + size > len(self.buffer):
+            # move the remaining data to the beginning of the buffer
+            available = self.end - self.start
+            if size > len(self.buffer):
+                buffer = bytearray(max(size, 2 * len(self.buffer)))
+                buffer[:available] = self.view[self.start:self.end]
+                self.view.release()
+                self.buffer = buffer
+                self.view = memoryview(self.buffer)
+            else:
+                self.view[:available] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = available
+        while self.end - self.start < size:
             try:
-                buffer = self.conn.recv(size)
-                buffer = str(buffer.decode('ascii'))
+                n = self.conn.recv_into(self.view[self.end:])
             except Exception as e:
                 error("cannot receive: " + str(e))
-                return None
-            if buffer == None or buffer == 0 or len(buffer) == 0:
+                return False
+            if n == 0:
                 # error("lost connection to %s" % str(self.address))
-                return None
-            size -= len(buffer)
-            result += buffer
-        # debug("_readAll() -> %s" % result)
+                return False
+            self.end += n
+        return True
+
+    def _read(self, size):
+        """return the next size bytes as memoryview. it is valid
+        until the next call of _fill()"""
+        if not self._fill(size):
+            return None
+        result = self.view[self.start:self.start + size]
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
         return result
 
+    def _readAll(self, size):
+        r = self._read(size)
+        if r is None:
+            return None
+        return str(r, 'ascii')
+
+    def _readVarint(self):
+        value = 0
+        shift = 0
+        for i in range(Message.MAX_VARINT_SIZE):
+            b = self._read(1)
+            if b is None:
+                return None
+            value |= (b[0] & 0x7f) << shift
+            if b[0] < 0x80:
+                return value
+            shift += 7
+        error("invalid length from %s" % str(self.address))
+        self.close()
+        return None
+
+    def receiveInto(self, view):
+        """read unframed data following a message into view. returns the
+        number of bytes read, 0 if the connection has been closed"""
+        available = self.end - self.start
+        if available == 0:
+            return self.conn.recv_into(view)
+        n = min(available, len(view))
+        view[:n] = self.view[self.start:self.start + n]
+        self.start += n
+        if self.start == self.end:
+            self.start = self.end = 0
+        return n
+
+    def setProtocolVersion(self, version):
+        self.version = version
+
+    def handshake(self, timeout = None, maxVersion = Message.PROTOCOL_VERSION):
+        """negotiate the protocol version (client side), using at most maxVersion.
+        returns False if the peer does not support the handshake.
+        in this case the connection is closed by the peer, which may
+        take some time. timeout limits the time waiting for the reply."""
+        maxVersion = min(maxVersion, Message.PROTOCOL_VERSION)
+        if not self.sendMessage(Message(Message.HELLO, [ str(maxVersion) ])):
+            return False
+        socketTimeout = self.conn.gettimeout()
+        if timeout is not None:
+            self.conn.settimeout(timeout)
+        msg = self.receiveMessage()
+        self.conn.settimeout(socketTimeout)
+        if msg is None or msg.type != Message.HELLO:
+            return False
+        self.setProtocolVersion(min(int(msg.content[0]), maxVersion))
+        debug("protocol version %d" % self.version)
+        return True
+
     def receiveMessage(self):
         # debug("receiveMessage()")
+        if self.version == Message.PROTOCOL_V1:
+            return self._receiveMessageV1()
+        else:
+            return self._receiveMessageV2()
+
+    def _receiveMessageV1(self):
         try:
             msgType = int(self._readAll(Message.SIZE_MSG_TYPE))
         except TypeError:
@@ -101,41 +422,57 @@ class Connection:
         except KeyError:
             error("unknown message type: '%d'" % msgType)
             return None
+        if nParts is None:
+            error("message type %d requires protocol version 2" % msgType)
+            return None
         msg = []
         for i in range(nParts):
             len = self._readAll(Message.SIZE_STRLEN)
             if len == None:
                 return None
-            len = int(len)
-            s = self._readAll(len)
+            s = self._readAll(int(len))
             if s == None:
                 return None
             msg.append(s)
         # debug("receiveMessage() -> " + str((msgType, msg)))
         return Message(msgType, msg)
 
+    def _receiveMessageV2(self):
+        msgType = self._readVarint()
+        nParts = self._readVarint()
+        if nParts is None:
+            return None
+        msg = []
+        # each part counts at least one byte, its length
+        size = nParts
+        for i in range(nParts):
+            if size > Message.MAX_MESSAGE_SIZE:
+                break
+            len = self._readVarint()
+            if len is None:
+                return None
+            size += len
+            if size > Message.MAX_MESSAGE_SIZE:
+                break
+            s = self._read(len)
+            if s is None:
+                return None
+            msg.append(str(s, Message.ENCODING, 'surrogateescape'))
+        if size > Message.MAX_MESSAGE_SIZE:
+            error("message from %s exceeds %d bytes" % (str(self.address), Message.MAX_MESSAGE_SIZE))
+            self.close()
+            return None
+        return Message.create(msgType, msg)
+
     def sendMessage(self, msg):
         # debug("send " + str(msg))
-        mbuf = ("%%0%dd" % Message.SIZE_MSG_TYPE) % msg.type
-        mbuf = mbuf.encode('ascii')
-        if self.conn.sendall(mbuf) == 0:
-            error("send message type failed")
+        try:
+            buffer = msg.serialize(self.version)
+            with self.sendLock:
+                self.conn.sendall(buffer)
+        except Exception as e:
+            error("send failed: " + str(e))
             return False
-        for m in msg.content:
-            l = ("%%0%dd" % Message.SIZE_STRLEN) % len(m)
-            l = l.encode('ascii')
-            m = m.encode('ascii')
-            assert(len(l) <= Message.SIZE_STRLEN)
-            try:
-                if self.conn.sendall(l) == 0:
-                    error("send length failed")
-                    return False
-                if self.conn.sendall(m) == 0:
-                    error("send string failed")
-                    return False
-            except Exception as e:
-                error("send failed: " + str(e))
-                return False
         return True
 
     def getPeerName(self):
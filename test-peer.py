@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+local check of the peer transfer service (peer.py, PeerRemoteFileSystem).
+
+starts two PeerServer instances on different local ports, each serving
+its own directory, and checks stat and copies from both instances,
+the rejection of files outside of the served directory (with the
+fallback to ssh), an unreachable service, and the detection of
+corrupted data (PEER_CHECKSUM).
+
+  test-peer.py [--port P] [directory]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+import settings
+import filesystem
+import peer
+from shared import Message
+
+failed = []
+
+
+def check(name, ok):
+    print("%-40s %s" % (name, "ok" if ok else "FAILED"))
+    if not ok:
+        failed.append(name)
+
+
+def startServers(config, roots, port):
+    """one PeerServer per root, the hosts node0, node1 are mapped to
+    their ports"""
+    hosts = []
+    for i, root in enumerate(roots):
+        c = settings.ClientDefaultConfiguration()
+        c.PEER_ROOT = root
+        c.PEER_PORT = port + i
+        c.PEER_USER_PORTS = 0
+        threading.Thread(target=peer.PeerServer(c).serve, daemon=True).start()
+        config.PEER_HOSTS["node%d" % i] = "127.0.0.1:%d" % (port + i)
+        hosts.append("node%d" % i)
+    time.sleep(0.5)
+    return hosts
+
+
+def corruptedSend(self, f, offset, length, h):
+    """PeerThread._sendHashed which sends wrong data"""
+    data = os.pread(f.fileno(), length, offset)
+    h.update(data)
+    self.conn.conn.sendall(bytes(b ^ 0xff for b in data))
+    return len(data)
+
+
+def main(argv):
+    port = 10500
+    directory = None
+    i = 1
+    while i < len(argv):
+        if argv[i] == "--port":
+            port = int(argv[i + 1])
+            i += 1
+        else:
+            directory = argv[i]
+        i += 1
+    tmpdir = tempfile.mkdtemp(prefix="cm-test-peer-", dir=directory)
+    roots = [ os.path.join(tmpdir, "node%d" % n) for n in range(2) ]
+    data = []
+    for root in roots:
+        os.mkdir(root)
+        data.append(os.urandom(256 * 1024))
+        with open(os.path.join(root, "file"), "wb") as fp:
+            fp.write(data[-1])
+        os.chmod(os.path.join(root, "file"), 0o640)
+    outside = os.path.join(tmpdir, "outside")
+    with open(outside, "wb") as fp:
+        fp.write(b"outside")
+    config = settings.ClientDefaultConfiguration()
+    config.PEER_HOSTS = {}
+    config.PEER_CHECKSUM = "sha1"
+    hosts = startServers(config, roots, port)
+    config.PEER_HOSTS["down"] = "127.0.0.1:%d" % (port + len(roots))
+    fs = filesystem.PeerRemoteFileSystem(config)
+    destination = os.path.join(tmpdir, "copy")
+    try:
+        for host, root, content in zip(hosts, roots, data):
+            source = os.path.join(root, "file")
+            st = os.stat(source)
+            check("stat %s" % host, fs.getFileStat(host, source) == (st.st_size, int(st.st_mtime), st.st_mode))
+            ok, msg = fs.copyFile(host, source, destination)
+            with open(destination, "rb") as fp:
+                check("copy %s" % host, ok and fp.read() == content)
+            check("mode %s" % host, os.stat(destination).st_mode & 0o777 == 0o640)
+            os.remove(destination)
+            stream = fs.readRange(host, source, 1000, 5000)
+            check("range %s" % host, stream.read(5000) == content[1000:6000])
+            stream.close()
+        # node1 does not serve the files of node0
+        stream, reply = fs.read(hosts[1], os.path.join(roots[0], "file"), 0, 0)
+        check("other root not served", stream is None and not fs.isServed(reply))
+        stream, reply = fs.read(hosts[0], outside, 0, 0)
+        check("outside not served", stream is None and reply is not None and
+              reply.content == [ Message.PEER_NOT_SERVED ])
+        stream, reply = fs.read(hosts[0], os.path.join(tmpdir, "node0", "..", "outside"), 0, 0)
+        check("outside (..) not served", stream is None and not fs.isServed(reply))
+        stream, reply = fs.read(hosts[0], os.path.join(roots[0], "missing"), 0, 0)
+        check("missing file", stream is None and fs.isServed(reply))
+        check("missing file stat", fs.getFileStat(hosts[0], os.path.join(roots[0], "missing")) is None)
+        stream, reply = fs.read("down", os.path.join(roots[0], "file"), 0, 0)
+        check("service down", stream is None and not fs.isServed(reply))
+        check("fallback to ssh", fs.getFileStat(hosts[0], outside) is None and fs.ssh is not None)
+        template = settings.clientEnvironment().cacheDir(config)
+        if "$(USER)" in template:
+            path = template.replace("$(HOST)", hosts[0]).replace("$(USER)", "root")
+            check("owner of cache directory", fs.owner(path + "/file") == 0)
+        # digest mismatch
+        peer.PeerThread._sendHashed = corruptedSend
+        ok, msg = fs.copyFile(hosts[0], os.path.join(roots[0], "file"), destination)
+        check("checksum mismatch (copy)", not ok)
+        stream = fs.readRange(hosts[1], os.path.join(roots[1], "file"), 0, 1000)
+        try:
+            stream.read(1000)
+            check("checksum mismatch (range)", False)
+        except IOError as e:
+            check("checksum mismatch (range)", "checksum mismatch" in str(e))
+        stream.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    if failed:
+        print("%d checks failed" % len(failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -864,6 +864,16 @@ function readPlainServerDb()
 }
 
 
+function peerService()
+{
+    echo "********** $FUNCNAME **********"
+    python3 $(dirname $0)/test-peer.py --port $[SERVERPORT+1] $CACHEDIR &> $(getLogFile $FUNCNAME $HOST)
+    if [ $? -ne 0 ];then
+        grep FAILED $(getLogFile $FUNCNAME $HOST)
+        echo "verify failed in $FUNCNAME:$HOST 'test-peer.py'"
+    fi
+}
+
 
 # set -x
 startServer
@@ -912,5 +922,6 @@ else
     waitActive
     waitActiveSlowCopy
     readServerDb
+    peerService
 fi
 